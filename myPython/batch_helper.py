@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+# Python functions that feed several images into the network with a single forward pass
+# usage: extract_rmac_features(net, load_fn, items, features, end_layer='rmac/normalized', batch_size=8, num_workers=4)
+#        where load_fn(item) returns the (I, R) pair of one image, as ImageHelper.prepare_image_and_grid_regions_for_network
+#        extract_rmac_features_multiscale(net, load_fn, items, features_list, ...) does the same when load_fn(item)
+#        returns one (I, R) pair per scale, so that each image is decoded only once for all the scales
+
+'''
+Note:
+    Images are only batched together when their resized shapes are the same, since the 'data' blob is a single
+    N x 3 x H x W array. For datasets with a uniform resolution (e.g. cover images of 280 x 496) every batch is full,
+    while for the original Oxford/Paris images the batcher keeps one pending group per shape and flushes them as they
+    get full. The rois of the i-th image in a batch have i in column 0, which is the format ROIPooling expects and
+    the same as 'pack_regions_for_network' produces for a list of images.
+    With a fixed input shape (uni-oxford 384 x 512, cover 280 x 496, landmark 288 x 384), the image helpers return
+    the same (cached) rois array for every image, so InputBlobs packs the rois of a batch once and reuses them as
+    long as the next batch has the same rois, and the blobs are only reshaped when the batch shape changes. The
+    images are copied straight into the data blob.
+'''
+
+import sys
+import numpy as np
+from tqdm import tqdm
+from collections import OrderedDict
+from prefetch_helper import Prefetcher
+
+
+# stack the rois of the images of a batch and set the batch index of every roi in column 0
+def pack_regions(regions):
+    R = np.vstack(regions).astype(np.float32)
+    cnt = 0
+    for k, r in enumerate(regions):
+        R[cnt: cnt + r.shape[0], 0] = k
+        cnt += r.shape[0]
+    return R
+
+
+# stack the images (1 x 3 x H x W each) into one blob and set the batch index of every roi in column 0
+def pack_batch(images, regions):
+    I = np.concatenate(images, axis=0)
+    if regions[0] is None:
+        return I, None
+    return I, pack_regions(regions)
+
+
+# writes a batch into the 'data' and 'rois' blobs, reshaping them and packing the rois only when they change
+class InputBlobs:
+    def __init__(self):
+        self.regions = None  # rois of the images of the last batch
+        self.R = None  # and their packed array
+
+    def set(self, net, images, regions):
+        shape = (len(images), ) + tuple(int(v) for v in images[0].shape[1:])
+        if net.blobs['data'].data.shape != shape:
+            net.blobs['data'].reshape(*shape)
+        data = net.blobs['data'].data
+        for k, I in enumerate(images):
+            data[k] = I[0]
+        if regions[0] is None:
+            return None
+        if self.regions is None or len(self.regions) != len(regions) or \
+                any(r is not r_last for r, r_last in zip(regions, self.regions)):
+            self.regions = list(regions)
+            self.R = pack_regions(regions)
+        if net.blobs['rois'].data.shape != self.R.shape:
+            net.blobs['rois'].reshape(*self.R.shape)
+        net.blobs['rois'].data[:] = self.R
+        return self.R
+
+
+# feed a batch of images of the same shape into the network and return one row of 'end_layer' per image
+# the rois blob is left untouched if regions are None (the deployed network generates the ROIs itself)
+def forward_batch(net, images, regions, end_layer='rmac/normalized', inputs=None):
+    (inputs if inputs is not None else InputBlobs()).set(net, images, regions)
+    net.forward(end=end_layer)
+    return np.array(net.blobs[end_layer].data).reshape(len(images), -1)
+
+
+class BatchForward:
+    def __init__(self, net, end_layer='rmac/normalized', batch_size=1, max_pending=None):
+        self.net = net
+        self.end_layer = end_layer
+        self.batch_size = batch_size
+        # upper bound of images waiting for a batch, over all the shapes
+        self.max_pending = max_pending if max_pending is not None else 4 * batch_size
+        self.pending = OrderedDict()  # key: image shape; value: list of (idx, I, R)
+        self.num_pending = 0
+        self.inputs = InputBlobs()
+
+    # add an image to the group of its shape and return the (idx, feature) pairs of the batches that are run
+    def push(self, idx, I, R=None):
+        key = I.shape
+        if key not in self.pending:
+            self.pending[key] = []
+        self.pending[key].append((idx, I, R))
+        self.num_pending += 1
+        if len(self.pending[key]) >= self.batch_size:
+            return self.run_group(key)
+        if self.num_pending > self.max_pending:
+            # too many different shapes, run the largest group even if it is not full
+            return self.run_group(max(self.pending.keys(), key=lambda k: len(self.pending[k])))
+        return []
+
+    # run all the images left
+    def flush(self):
+        results = []
+        for key in list(self.pending.keys()):
+            results.extend(self.run_group(key))
+        return results
+
+    def run_group(self, key):
+        group = self.pending.pop(key)
+        self.num_pending -= len(group)
+        features = self.forward([g[1] for g in group], [g[2] for g in group])
+        return [(g[0], features[k]) for k, g in enumerate(group)]
+
+    # one output per image of the batch (overridden by extraction_engine to read several blobs)
+    def forward(self, images, regions):
+        return forward_batch(self.net, images, regions, self.end_layer, self.inputs)
+
+
+# load the items in the main thread, or with a pool of 'num_workers' threads ahead of the network
+def load_items(load_fn, items, num_workers=0, queue_size=None):
+    if num_workers > 0:
+        return Prefetcher(load_fn, items, num_workers, queue_size if queue_size is not None else 4 * num_workers)
+    return (load_fn(item) for item in items)
+
+
+# writer that sums up the features of several scales into the same row instead of overwriting it
+class SumWriter:
+    def __init__(self, features):
+        self.features = features
+
+    def __setitem__(self, idx, feature):
+        self.features[idx] += feature
+
+
+# extract the features of all the items and store the feature of the i-th item into features[i]
+# (or into features[rows[i]] if the items are only a part of the rows, e.g. when resuming)
+def extract_rmac_features(net, load_fn, items, features, end_layer='rmac/normalized', batch_size=1, num_workers=0,
+                          rows=None):
+    extract_rmac_features_multiscale(net, lambda item: [load_fn(item)], items, [features], end_layer, batch_size,
+                                     num_workers, rows)
+    return features
+
+
+# load_fn(item) returns a list of (I, R) with one pair per scale, and the feature of the i-th item at the s-th scale
+# is stored into features_list[s][i]. Images of the same scale are batched together, as their shapes usually match
+def extract_rmac_features_multiscale(net, load_fn, items, features_list, end_layer='rmac/normalized', batch_size=1,
+                                     num_workers=0, rows=None, verbose=True):
+    # the network may also be a pool of CPU worker processes (cpu_helper.CpuNets), which shares out the items itself
+    if hasattr(net, 'extract_rmac_features_multiscale'):
+        return net.extract_rmac_features_multiscale(load_fn, items, features_list, end_layer, batch_size, num_workers,
+                                                    rows)
+    if rows is None:
+        rows = np.arange(len(items))
+    batcher = BatchForward(net, end_layer, batch_size, max_pending=4 * batch_size * len(features_list))
+    loaded = load_items(load_fn, items, num_workers, queue_size=max(4 * num_workers, 2 * batch_size))
+    for i, scales in enumerate(tqdm(loaded, total=len(items), file=sys.stdout, leave=False, dynamic_ncols=True,
+                                    disable=not verbose)):
+        for s, (I, R) in enumerate(scales):
+            for (s_, k), f in batcher.push((s, rows[i]), I, R):
+                features_list[s_][k] = f
+    for (s_, k), f in batcher.flush():
+        features_list[s_][k] = f
+    return features_list
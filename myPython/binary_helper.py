@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# Python class of binary hash codes of the gallery descriptors (sign of the PCA projection, rotated by ITQ), searched
+# by Hamming distance and re-ranked with the float descriptors
+# usage: codes = BinaryCodes.train(features, nbits=256)  # features: gallery descriptors, e.g. memory-mapped
+#        codes.add(features)
+#        ids, scores = codes.search(features_queries, k=100, num_candidates=1000, features=features)
+#        codes.save('features.bin.npz')  # and BinaryCodes.load('features.bin.npz')
+
+'''
+Note:
+    The descriptors are projected on their nbits first principal components (PCA of sklearn, as in offline/pca_*,
+    without whitening) and rotated by the orthogonal matrix of ITQ (iterative quantization, which alternates the
+    codes B = sign(V R) and the Procrustes fit of R to them to lower the quantization error; itq_iters=0 keeps the
+    plain sign of the PCA). The bits are packed into nbits / 64 uint64 words per image, so 256 bits take 32 bytes.
+    The Hamming distance of a query to the codes is the popcount of the xor, counted with a table of the 256 bytes
+    by blocks of codes. The num_candidates nearest codes are scored again with the float descriptors (which can be
+    a memory-mapped .npy) and the k best are returned; without them, the score is 1 - 2 * hamming / nbits.
+'''
+
+import os
+import time
+import argparse
+import numpy as np
+from sklearn.decomposition import PCA
+import rank_helper
+import index_eval
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint16)
+
+
+# Hamming distances (n x N) between packed codes (n x words and N x words, uint64)
+def hamming(codes_a, codes_b):
+    dist = np.zeros((len(codes_a), len(codes_b)), dtype=np.uint16)
+    for i in range(len(codes_a)):
+        dist[i] = POPCOUNT[np.bitwise_xor(codes_b, codes_a[i]).view(np.uint8)].sum(axis=1)
+    return dist
+
+
+class BinaryCodes:
+    def __init__(self, mean, components, rotation):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)  # nbits x dim
+        self.rotation = np.asarray(rotation, dtype=np.float32)  # nbits x nbits
+        self.nbits = len(self.components)
+        self.codes = np.zeros((0, self.nbits // 64), dtype=np.uint64)
+
+    # PCA and ITQ trained on at most num_train random rows of features
+    @staticmethod
+    def train(features, nbits=256, itq_iters=50, num_train=100000, seed=0):
+        assert nbits % 64 == 0, 'nbits should be a multiple of 64'
+        assert nbits <= features.shape[1], 'nbits should not exceed the dimension'
+        rng = np.random.RandomState(seed)
+        rows = np.sort(rng.choice(features.shape[0], min(num_train, features.shape[0]), replace=False))
+        X = np.asarray(features[rows], dtype=np.float32)
+        pca = PCA(n_components=nbits, copy=True, whiten=False)
+        pca.fit(X)
+        V = (X - pca.mean_).dot(pca.components_.T)
+        R, _ = np.linalg.qr(rng.randn(nbits, nbits))  # random orthogonal start
+        for _ in range(itq_iters):
+            B = np.sign(V.dot(R))
+            U, _, Wt = np.linalg.svd(B.T.dot(V))
+            R = Wt.T.dot(U.T)
+        return BinaryCodes(pca.mean_, pca.components_, R)
+
+    def project(self, X):
+        return (np.asarray(X, dtype=np.float32) - self.mean).dot(self.components.T).dot(self.rotation)
+
+    # packed codes of every row of features, by blocks of rows
+    def encode(self, features, block_rows=65536):
+        codes = np.zeros((features.shape[0], self.nbits // 64), dtype=np.uint64)
+        for start in range(0, features.shape[0], block_rows):
+            bits = self.project(features[start: start + block_rows]) > 0
+            codes[start: start + block_rows] = np.packbits(bits, axis=1).view(np.uint64)
+        return codes
+
+    def add(self, features):
+        self.codes = np.vstack((self.codes, self.encode(features)))
+        return self
+
+    # ids and scores of the k best images of every query, among its num_candidates nearest codes
+    def search(self, queries, k, num_candidates=1000, features=None, block_rows=1048576):
+        k = min(k, len(self.codes))
+        num_candidates = min(max(k, num_candidates), len(self.codes))
+        query_codes = self.encode(queries)
+        ids = np.zeros((len(queries), k), dtype=np.int64)
+        scores = np.zeros((len(queries), k), dtype=np.float32)
+        for q in range(len(queries)):
+            dist = np.hstack([hamming(query_codes[q: q + 1], self.codes[start: start + block_rows])[0]
+                              for start in range(0, len(self.codes), block_rows)])
+            cand = rank_helper.top_k(-dist[None, :].astype(np.int32), num_candidates)[0]
+            if features is not None:
+                cand = np.sort(cand)
+                s = np.asarray(features[cand], dtype=np.float32).dot(np.asarray(queries[q], dtype=np.float32))
+            else:
+                s = 1 - 2 * dist[cand].astype(np.float32) / self.nbits
+            top = rank_helper.top_k(s[None, :], k)[0]
+            ids[q], scores[q] = cand[top], s[top]
+        return ids, scores
+
+    def save(self, fname):
+        np.savez(fname, mean=self.mean, components=self.components, rotation=self.rotation, codes=self.codes)
+
+    @staticmethod
+    def load(fname):
+        data = np.load(fname)
+        codes = BinaryCodes(data['mean'], data['components'], data['rotation'])
+        codes.codes = data['codes']
+        return codes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Encode the gallery with binary codes and compare it with the brute force')
+    parser.add_argument('--features_queries', type=str, required=True, help='Features of the queries (.npy)')
+    parser.add_argument('--features_dataset', type=str, required=True, help='Features of the gallery (.npy, memory-mapped)')
+    parser.add_argument('--codes', type=str, required=False, help='Path of the codes (.npz), loaded if it exists')
+    parser.add_argument('--nbits', type=int, required=False, help='Number of bits per descriptor (multiple of 64)')
+    parser.add_argument('--itq_iters', type=int, required=False, help='Number of ITQ iterations (0 for the sign of the PCA)')
+    parser.add_argument('--num_candidates', type=str, required=False, help='Comma-separated numbers of re-ranked candidates to compare')
+    parser.add_argument('--k', type=int, required=False, help='Number of results per query')
+    parser.add_argument('--dataset', type=str, required=False, help='Path to the Oxford / Paris directory, to report the mAP')
+    parser.add_argument('--eval_binary', type=str, required=False, help='Path to the compute_ap binary to evaluate Oxford / Paris')
+    parser.add_argument('--cover_dir', type=str, required=False, help='Path to the cover dataset, to report its mAP instead')
+    parser.add_argument('--temp_dir', type=str, required=False, help='Path to a temporary directory to store the scores')
+    parser.set_defaults(codes=None, nbits=256, itq_iters=50, num_candidates='100,1000,10000', k=100, dataset=None,
+                        cover_dir=None, temp_dir='tmp')
+    args = parser.parse_args()
+
+    features_queries = np.load(args.features_queries)
+    features_dataset = np.load(args.features_dataset, mmap_mode='r')
+    t = time.time()
+    if args.codes is not None and os.path.exists(args.codes):
+        codes = BinaryCodes.load(args.codes)
+    else:
+        codes = BinaryCodes.train(features_dataset, args.nbits, args.itq_iters).add(features_dataset)
+        if args.codes is not None:
+            codes.save(args.codes)
+    print("%d codes of %d bits ready in %.1f s" % (len(codes.codes), codes.nbits, time.time() - t))
+    score_fn = None
+    if args.dataset is not None:
+        score_fn = index_eval.oxford_score_fn(args.dataset, args.eval_binary, args.temp_dir)
+    elif args.cover_dir is not None:
+        score_fn = index_eval.cover_score_fn(args.cover_dir)
+    index_eval.benchmark(lambda queries, num: codes.search(queries, args.k, num, features_dataset),
+                         [int(v) for v in args.num_candidates.split(',')], features_queries, features_dataset, args.k,
+                         score_fn)
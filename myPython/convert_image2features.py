@@ -12,6 +12,12 @@ python ./myPython/convert_image2features.py \
     --img_dir ~/data/cover/training/img/ \
     --features_npy ~/data/cover/training/ \
     --features_txt ~/data/cover/training/training.txt
+(add --shard i/n to convert only a part of the images on every machine, then merge the parts by
+ merge_image2features.py; the index is written in the order of the sorted images, so pass --shuffle to
+ convert_imageset if the training order should be random;
+ add --incremental [--check_changed] to only convert the images added (or changed) since the last run;
+ add --store_dtype float16 or int8 to also write a smaller copy of the features, e.g. 'features.int8.npy';
+ add --index_file features.fidx to also write the single-file index read by the serving processes (feature_index.py))
 '''
 
 
@@ -22,7 +28,14 @@ import caffe
 import cv2
 import argparse
 from tqdm import tqdm
-import random
+import batch_helper
+import feature_store
+import descriptor_cache
+import cpu_helper
+import shard_helper
+import ingest_helper
+import quant_helper
+import feature_index
 
 
 if __name__ == '__main__':
@@ -37,7 +50,33 @@ if __name__ == '__main__':
                         help='Path to save the features')
     parser.add_argument('--features_txt', type=str, required=False,
                         help='Path to the file to record the feature index')
+    parser.add_argument('--batch_size', type=int, required=False, help='Number of images of the same shape per forward pass')
+    parser.add_argument('--num_workers', type=int, required=False, help='Number of threads decoding images ahead of the network')
+    parser.add_argument('--shard', type=str, required=False,
+                        help='Only convert the i-th of n blocks of the sorted images (i/n, 0 <= i < n), '
+                             'see merge_image2features.py')
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+                        help='Only convert the images missing from the existing features and index, and append them')
+    parser.add_argument('--check_changed', dest='check_changed', action='store_true',
+                        help='With --incremental, also convert again the images whose size or mtime changed')
+    parser.add_argument('--cache_dir', type=str, required=False, help='Path to a descriptor cache shared between runs')
+    parser.add_argument('--store_dtype', type=str, required=False,
+                        help='Also store the features as float16 or int8 (with the scales), next to the float32 ones')
+    parser.add_argument('--cpu', dest='cpu', action='store_true', help='Run the network on the CPU with several worker processes')
+    parser.add_argument('--cpu_workers', type=int, required=False, help='Number of worker processes with --cpu (default: number of cores / cpu_threads)')
+    parser.add_argument('--cpu_threads', type=int, required=False, help='Number of BLAS threads of every worker process with --cpu')
     parser.set_defaults(gpu=0)
+    parser.set_defaults(cpu=False)
+    parser.set_defaults(cpu_workers=0)
+    parser.set_defaults(cpu_threads=1)
+    parser.set_defaults(batch_size=8)
+    parser.set_defaults(incremental=False)
+    parser.set_defaults(check_changed=False)
+    parser.add_argument('--index_file', type=str, required=False,
+                        help='Also write the features, image names and model fingerprint into a single index file')
+    parser.set_defaults(store_dtype='float32')
+    parser.set_defaults(index_file=None)
+    parser.set_defaults(num_workers=4)
     parser.set_defaults(proto='/home/processyuan/NetworkOptimization/deep-retrieval/proto/'
                               'distilling/deploy_resnet101_teacher.prototxt')
     parser.set_defaults(weights='/home/processyuan/NetworkOptimization/deep-retrieval/'
@@ -49,36 +88,78 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     # Configure caffe and load the network ResNet-101
-    caffe.set_device(args.gpu)
-    caffe.set_mode_gpu()
+    if args.cpu:
+        caffe.set_mode_cpu()
+    else:
+        caffe.set_device(args.gpu)
+        caffe.set_mode_gpu()
     net = caffe.Net(args.proto, args.weights, caffe.TEST)
+    if args.cpu:
+        # the features are extracted by worker processes, each of them with its own network
+        net = cpu_helper.CpuNets(net, args.proto, args.weights, args.cpu_workers, args.cpu_threads)
 
     # Output of ResNet-101
     output_layer = 'rmac/eltwise/normalized'  # suppose that the layer name is always the same as the blob name
     dim_features = net.blobs[output_layer].data.shape[1]
-    images = os.listdir(args.img_dir)
-    features = np.zeros((len(images), dim_features), dtype=np.float32)
-    f_txt = open(args.features_txt, 'w')
-    img_idx = 0
-    f_lines = []
+    # sorted so that the rows of an interrupted run still match the images when resuming
+    images = sorted(os.listdir(args.img_dir))
+    features_txt = args.features_txt
+    # features are written into a memory-mapped file with checkpoints, the rows done are skipped when resuming
+    features_fname = args.features_npy if args.features_npy.endswith('.npy') else args.features_npy + '.npy'
+    if args.shard:
+        # every shard writes its own features and index, merged afterwards in the order of the shards
+        shard_i, shard_n = shard_helper.parse_shard(args.shard)
+        images = images[shard_helper.shard_slice(len(images), shard_i, shard_n)]
+        features_fname = shard_helper.shard_fname(features_fname, shard_i, shard_n)
+        features_txt = shard_helper.shard_fname(features_txt, shard_i, shard_n)
+    incremental = args.incremental and os.path.exists(features_fname) and os.path.exists(features_txt)
+    if incremental:
+        # only the new (or changed) images are converted, into a separate file appended at the end
+        names, images = ingest_helper.find_new_images(features_fname, features_txt, args.img_dir, images,
+                                                      args.check_changed)
+        print("Incremental mode: %d image(s) already converted, %d to convert" % (len(names), len(images)))
+        features_fname, features_npy = os.path.splitext(features_fname)[0] + '.increment.npy', features_fname
+    features = feature_store.ResumableFeatures(features_fname, len(images), dim_features)
+    rows = features.pending()
+    output = features
+    if args.cache_dir:
+        # only the images which are not in the descriptor cache yet go through the network
+        # (the images are not resized, hence S=None, and the means are not subtracted)
+        digests = descriptor_cache.file_digests([os.path.join(args.img_dir, f) for f in images], args.num_workers)
+        output = descriptor_cache.CachedWriter(features, descriptor_cache.DescriptorCache(
+            args.cache_dir, descriptor_cache.model_fingerprint(args.proto, args.weights), None, args.L, output_layer,
+            dim_features, 'no_means'), digests)
+        rows, num_hits = output.fill(rows)
+        print("Descriptor cache: %d/%d image(s) found" % (num_hits, num_hits + len(rows)))
+
+    # the rigid grid is generated by the network, so only the image itself is fed
+    def load_image(img_file):
+        img_temp = cv2.imread(os.path.join(args.img_dir, img_file)).transpose(2, 0, 1)
+        return np.expand_dims(img_temp, axis=0), None
 
     # convert the images into features vectors by ResNet-101 and R-MAC and save them into numpy array
-    for img_file in tqdm(images, file=sys.stdout, leave=False, dynamic_ncols=True):
-        img_path = os.path.join(args.img_dir, img_file)
-        img_temp = cv2.imread(img_path).transpose(2, 0, 1)
-        img = np.expand_dims(img_temp, axis=0)
-        net.blobs['data'].reshape(img.shape[0], int(img.shape[1]), int(img.shape[2]), int(img.shape[3]))
-        net.blobs['data'].data[:] = img
-        net.forward(end=output_layer)
-        features[img_idx, :] = np.squeeze(net.blobs[output_layer].data)
-        label = img_file + ' ' + str(img_idx) + '\n'
-        f_lines.append(label)
-        img_idx += 1
+    batch_helper.extract_rmac_features(net, load_image, [images[i] for i in rows], output, output_layer,
+                                       args.batch_size, args.num_workers, rows)
+    if args.cache_dir:
+        output.close()
 
-    # save the features and write the txt file
-    features_fname = args.features_npy
-    np.save(features_fname, features)
-    random.shuffle(f_lines)
-    for line in f_lines:
-        f_txt.write(line)
-    f_txt.close()
+    # save the features and write the txt file ('image_name row' per line, in the order of the rows)
+    features.finish()
+    if incremental:
+        num = ingest_helper.append_features(features_npy, features_txt, args.img_dir, names, images, features_fname)
+        os.remove(features_fname)
+        print("%d image(s) in %s" % (num, features_npy))
+    else:
+        shard_helper.write_index(features_txt, images)
+        ingest_helper.write_stats(features_fname, args.img_dir, images)
+        features_npy = features_fname
+    if args.store_dtype != 'float32':
+        # the float32 features stay the reference (incremental runs and merges), the copy is written again from them
+        quant_fname = '{0}.{1}.npy'.format(os.path.splitext(features_npy)[0], args.store_dtype)
+        quant_helper.save_quantized(quant_fname, np.load(features_npy, mmap_mode='r'), args.store_dtype)
+        print("Features stored as %s in %s" % (args.store_dtype, quant_fname))
+    if args.index_file is not None:
+        feature_index.write_index(args.index_file, np.load(features_npy, mmap_mode='r'),
+                                  shard_helper.read_index(features_txt),
+                                  descriptor_cache.model_fingerprint(args.proto, args.weights), args.store_dtype)
+        print("Index written into %s" % args.index_file)
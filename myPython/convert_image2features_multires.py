@@ -10,8 +10,12 @@ import numpy as np
 import caffe
 import cv2
 import argparse
-import random
-import region_generator as rg
+import batch_helper
+import feature_store
+import descriptor_cache
+import cpu_helper
+import shard_helper
+from oxford_helper import ImageHelper
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Converting the images into embedding vector using multi-resolution')
@@ -25,56 +29,90 @@ if __name__ == '__main__':
                         help='Path to save the features')
     parser.add_argument('--features_txt', type=str, required=False,
                         help='Path to the file to record the feature index')
+    parser.add_argument('--batch_size', type=int, required=False, help='Number of images of the same shape per forward pass')
+    parser.add_argument('--num_workers', type=int, required=False, help='Number of threads decoding images ahead of the network')
+    parser.add_argument('--shard', type=str, required=False,
+                        help='Only convert the i-th of n blocks of the sorted images (i/n, 0 <= i < n), '
+                             'see merge_image2features.py')
+    parser.add_argument('--cache_dir', type=str, required=False, help='Path to a descriptor cache shared between runs')
+    parser.add_argument('--cpu', dest='cpu', action='store_true', help='Run the network on the CPU with several worker processes')
+    parser.add_argument('--cpu_workers', type=int, required=False, help='Number of worker processes with --cpu (default: number of cores / cpu_threads)')
+    parser.add_argument('--cpu_threads', type=int, required=False, help='Number of BLAS threads of every worker process with --cpu')
     parser.set_defaults(gpu=0)
+    parser.set_defaults(cpu=False)
+    parser.set_defaults(cpu_workers=0)
+    parser.set_defaults(cpu_threads=1)
     parser.set_defaults(L=2)
+    parser.set_defaults(batch_size=8)
+    parser.set_defaults(num_workers=4)
 
     args = parser.parse_args()
 
     # Configure caffe and load the network ResNet-101
-    caffe.set_device(args.gpu)
-    caffe.set_mode_gpu()
+    if args.cpu:
+        caffe.set_mode_cpu()
+    else:
+        caffe.set_device(args.gpu)
+        caffe.set_mode_gpu()
     net = caffe.Net(args.proto, args.weights, caffe.TEST)
+    if args.cpu:
+        # the features are extracted by worker processes, each of them with its own network
+        net = cpu_helper.CpuNets(net, args.proto, args.weights, args.cpu_workers, args.cpu_threads)
 
     # Output of ResNet-101
     output_layer = 'rmac/normalized'
     dim_features = net.blobs[output_layer].data.shape[1]
-    images = os.listdir(args.img_dir)
-    features = np.zeros((len(images), dim_features), dtype=np.float32)
-    f_lines = []
+    # sorted so that the rows of an interrupted run still match the images when resuming
+    images = sorted(os.listdir(args.img_dir))
+    features_txt = args.features_txt
     Ss = [256, 512, 768]
-    means = np.array([103.93900299, 116.77899933, 123.68000031], dtype=np.float32)[None, :, None, None]
+    image_helper = ImageHelper(Ss[1], args.L)
+    # features are written into a memory-mapped file with checkpoints, the rows done are skipped when resuming
+    features_fname = args.features_npy if args.features_npy.endswith('.npy') else args.features_npy + '.npy'
+    if args.shard:
+        # every shard writes its own features and index, merged afterwards in the order of the shards
+        shard_i, shard_n = shard_helper.parse_shard(args.shard)
+        images = images[shard_helper.shard_slice(len(images), shard_i, shard_n)]
+        features_fname = shard_helper.shard_fname(features_fname, shard_i, shard_n)
+        features_txt = shard_helper.shard_fname(features_txt, shard_i, shard_n)
+    features = feature_store.ResumableFeatures(features_fname, len(images), dim_features)
+    rows = features.pending()
+    chunk_size = 1000  # rows normalized and written together
+    image_paths = [os.path.join(args.img_dir, img_file) for img_file in images]
+    if args.cache_dir:
+        # one cache per scale, since the summed features depend on the set of scales
+        digests = descriptor_cache.file_digests(image_paths, args.num_workers)
+        model_fp = descriptor_cache.model_fingerprint(args.proto, args.weights)
+        caches = [descriptor_cache.DescriptorCache(args.cache_dir, model_fp, S, args.L, output_layer, dim_features,
+                                                   'imagenet_means') for S in Ss]
 
     # convert the images into features vectors by ResNet-101 and R-MAC and save them into numpy array
-    for l, img_file in enumerate(images):
-        img_path = os.path.join(args.img_dir, img_file)
-        im = cv2.imread(img_path)
-        im_size_hw = np.array(im.shape[0:2])
-        features_temp = []
-        for k, S in enumerate(Ss):
-            ratio = float(S) / np.max(im_size_hw)
-            new_size = tuple(np.round(im_size_hw * ratio).astype(np.int32))
-            im_resized = cv2.resize(im, (new_size[1], new_size[0]))
-            # Transpose for network and subtract mean
-            I = im_resized.transpose(2, 0, 1) - means
-            all_regions = [rg.get_rmac_region_coordinates(new_size[0], new_size[1], args.L)]
-            R = rg.pack_regions_for_network(all_regions)
-            net.blobs['data'].reshape(I.shape[0], int(I.shape[1]), int(I.shape[2]), int(I.shape[3]))
-            net.blobs['data'].data[:] = I
-            net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-            net.blobs['rois'].data[:] = R.astype(np.float32)
-            net.forward(end=output_layer)
-            features_temp.append(np.squeeze(net.blobs[output_layer].data))
-        features_sum = np.dstack(features_temp).sum(axis=2)
-        features[l, :] = features_sum / np.sqrt((features_sum * features_sum).sum(axis=1))
-        label = img_file + ' ' + str(l) + '\n'
-        f_lines.append(label)
-        print("Finished converting %s image(s)" % l)
+    # every image is decoded once and resized to all the scales, whose features are summed up into the same row
+    for start in range(0, len(rows), chunk_size):
+        chunk_rows = rows[start: start + chunk_size]
+        features_chunk = np.zeros((len(chunk_rows), dim_features), dtype=np.float32)
+        outputs = [batch_helper.SumWriter(features_chunk)] * len(Ss)
+        chunk_missing = np.arange(len(chunk_rows))
+        if args.cache_dir:
+            # the scales found in the cache are summed up directly and skipped by the extraction
+            outputs = [descriptor_cache.CachedWriter(o, cache, [digests[i] for i in chunk_rows])
+                       for o, cache in zip(outputs, caches)]
+            filled = [o.fill(chunk_missing) for o in outputs]
+            for missing, num_hits in filled:
+                print("Descriptor cache: %d/%d image(s) found" % (num_hits, num_hits + len(missing)))
+            chunk_missing = reduce(np.union1d, [missing for missing, _ in filled])
+        batch_helper.extract_rmac_features_multiscale(
+            net, lambda img_path: image_helper.prepare_image_and_grid_regions_for_network_multiscale(img_path, Ss),
+            [image_paths[chunk_rows[k]] for k in chunk_missing], outputs, output_layer, args.batch_size,
+            args.num_workers, chunk_missing)
+        if args.cache_dir:
+            for o in outputs:
+                o.close()
+        features_chunk /= np.sqrt((features_chunk * features_chunk).sum(axis=1))[:, None]
+        for k, i in enumerate(chunk_rows):
+            features[i] = features_chunk[k]
+        print("Finished converting %d/%d image(s)" % (start + len(chunk_rows), len(rows)))
 
-    # save the features and write the txt file
-    features_fname = args.features_npy
-    np.save(features_fname, features)
-    random.shuffle(f_lines)
-    f_txt = open(args.features_txt, 'w')
-    for line in f_lines:
-        f_txt.write(line)
-    f_txt.close()
+    # save the features and write the txt file ('image_name row' per line, in the order of the rows)
+    features.finish()
+    shard_helper.write_index(features_txt, images)
@@ -9,6 +9,7 @@ import random
 import cv2
 import shutil
 from region_generator import *
+import rank_helper
 
 
 class CoverDataset:
@@ -27,6 +28,7 @@ class CoverDataset:
         self.L = 2
         # calculates the mean on training set in advance
         self.mean = np.array([117.80904, 130.27611, 134.65074], dtype=np.float32)[:, None, None]
+        self.regions_cache = {}  # key: (H, W) of the resized image; value: grid regions
         self.dataset = []  # list of image names
         self.q_fname = []  # list of image names
         self.a_fname = []  # list of image names in list of classes
@@ -238,30 +240,47 @@ class CoverDataset:
             img_cls_start = img_cls_end
 
     def load_image(self, fname):
-        img = cv2.imread(fname)
-        if self.S is not None:
+        return self.resize_image(cv2.imread(fname), self.S)
+
+    # resize the image so that the longer side equals S (kept as it is if S is None)
+    def resize_image(self, img, S):
+        if S is not None:
             img_size_hw = np.array(img.shape[0:2])
-            ratio = float(self.S) / np.max(img_size_hw)
+            ratio = float(S) / np.max(img_size_hw)
             new_size = tuple(np.round(img_size_hw * ratio).astype(np.int32))
             img = cv2.resize(img, (new_size[1], new_size[0]))
         return img.transpose(2, 0, 1) - self.mean
 
     def prepare_image_and_grid_regions_for_network(self, img_dir, fname):
         img = self.load_image(os.path.join(self.clean_dir, img_dir, fname))
-        all_regions = [get_rmac_region_coordinates(img.shape[1], img.shape[2], self.L)]
-        regions = pack_regions_for_network(all_regions)
-        return np.expand_dims(img, axis=0), regions
+        return self.get_image_and_grid_regions(img)
+
+    # the image is decoded only once and a pair of (image, regions) is returned for every scale in Ss
+    def prepare_image_and_grid_regions_for_network_multiscale(self, img_dir, fname, Ss):
+        img = cv2.imread(os.path.join(self.clean_dir, img_dir, fname))
+        return [self.get_image_and_grid_regions(self.resize_image(img, S)) for S in Ss]
+
+    # the grid only depends on the image size, so it is computed once per size and shared by the images of that size
+    def get_image_and_grid_regions(self, img):
+        H, W = img.shape[1], img.shape[2]
+        if (H, W) not in self.regions_cache:
+            self.regions_cache[(H, W)] = pack_regions_for_network([get_rmac_region_coordinates(H, W, self.L)])
+        return np.expand_dims(img, axis=0), self.regions_cache[(H, W)]
 
     # Calculates the mean precision when number of prediction is equal to GT
     def cal_precision(self, sim, output_img=True):
         assert len(sim.shape) == 2, 'This is a 2-dim similarity matrix'
         assert sim.shape[0] == self.num_queries, 'number of rows should be equal to number of queries'
         assert sim.shape[1] == self.num_dataset, 'number of columns should be equal to number of dataset'
+        return self.cal_precision_ids(rank_helper.top_k(sim, max(len(q_ans) for q_ans in self.a_idx)), output_img)
+
+    # Same with the ranked dataset indices of every query (e.g. the ids of search_helper.search, -1 for no result)
+    def cal_precision_ids(self, idx, output_img=True):
+        assert idx.shape[0] == self.num_queries, 'number of rows should be equal to number of queries'
         q_precision = np.zeros(self.num_queries, dtype=np.float32)
-        idx = np.argsort(sim, axis=1)[:, ::-1]
         for q in range(self.num_queries):
             top_k = len(self.a_idx[q])  # choose the top-k prediction
-            top_idx = list(idx[q, : top_k])
+            top_idx = [i for i in idx[q, : top_k] if i >= 0]
             cnt_correct = len([i for i in top_idx if i in self.a_idx[q]])  # intersection
             q_precision[q] = float(cnt_correct) / float(top_k)
             # output image to 'cls' directory to make a comparison
@@ -290,31 +309,27 @@ class CoverDataset:
         return q_precision.mean(axis=0) * 100.0
 
     # Calculates the value of mAP according to the standard of VOC2010 and later
-    def cal_mAP(self, sim):
+    # only the ranks up to the last answer are needed (k, if given, ranks the top k images only)
+    def cal_mAP(self, sim, k=None):
         assert len(sim.shape) == 2, 'This is a 2-dim similarity matrix'
         assert sim.shape[0] == self.num_queries, 'number of rows should be equal to number of queries'
         assert sim.shape[1] == self.num_dataset, 'number of columns should be equal to number of dataset'
+        return self.cal_mAP_ids(rank_helper.top_k(sim, k if k is not None else rank_helper.rank_depth(sim, self.a_idx)))
+
+    # Same with the ranked dataset indices of every query (e.g. the ids of search_helper.search, -1 for no result):
+    # the answers which are not in the ranking count as never retrieved
+    def cal_mAP_ids(self, idx):
+        assert idx.shape[0] == self.num_queries, 'number of rows should be equal to number of queries'
         q_AP = np.zeros(self.num_queries, dtype=np.float32)
-        idx = np.argsort(sim, axis=1)[:, ::-1]
         for q in range(self.num_queries):
-            cnt_correct_last = 0
             q_ans = self.a_idx[q]
+            # ranks (from 1) of the answers found in the ranking, from a relevance mask of the ranking, and the
+            # precision under the recall of every answer (cumulated number of answers / rank)
+            ranks = np.flatnonzero(np.in1d(idx[q], q_ans))[:len(q_ans)] + 1
             recall = np.zeros(len(q_ans), dtype=np.float32)
-            for d in range(self.num_dataset):
-                top_k = d+1
-                top_idx = list(idx[q, : top_k])
-                cnt_correct = len([i for i in top_idx if i in q_ans])
-                assert cnt_correct >= cnt_correct_last
-                assert cnt_correct <= len(q_ans)
-                if cnt_correct > cnt_correct_last:
-                    recall[cnt_correct-1] = float(cnt_correct) / float(top_k)  # precision under the given recall
-                    cnt_correct_last = cnt_correct
-                if cnt_correct == len(q_ans):
-                    break
+            recall[:len(ranks)] = np.arange(1, len(ranks) + 1, dtype=np.float32) / ranks
             # calculates the maximum precision when no less than given recall
-            recall_max = np.zeros(len(q_ans), dtype=np.float32)
-            for r in range(len(q_ans)):
-                recall_max[r] = np.max(recall[r:])
+            recall_max = np.maximum.accumulate(recall[::-1])[::-1]
             q_AP[q] = recall_max.mean(axis=0)
             print("AP of query %d: %f" % (q, q_AP[q]))  # print for checking as the function is too slow ...
         return q_AP.mean(axis=0) * 100.0
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# Python class that runs the feature extraction on the CPU with several worker processes, each of them with its own
+# network and a bounded number of BLAS threads
+# usage: caffe.set_mode_cpu()
+#        net = caffe.Net(proto, weights, caffe.TEST)
+#        net = CpuNets(net, proto, weights, num_procs=8, num_threads=2)
+#        batch_helper.extract_rmac_features(net, ...)  # the same call as with a GPU network
+
+'''
+Note:
+    A single caffe process on the CPU leaves most of the cores idle between the BLAS calls, and several processes
+    with the default number of BLAS threads fight over the cores. So the items are split into interleaved shards
+    (the k-th worker takes the items k, k + n, k + 2n, ...), which keeps the shards balanced even if the image sizes
+    change along the list, and every worker is limited to 'num_threads' BLAS threads. The workers are forked, so
+    load_fn can be any function (e.g. a lambda), and they send back (scale, row, feature) to the main process,
+    which writes them into the usual features arrays (or writers), so the rows end up in order whatever the order
+    the workers finish in.
+'''
+
+import os
+import sys
+import ctypes
+import traceback
+import multiprocessing
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import numpy as np
+import caffe
+from tqdm import tqdm
+import batch_helper
+
+
+# limit the number of threads of the BLAS library used by caffe in the current process
+def set_blas_threads(num_threads):
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(num_threads)
+    # the library is already loaded along with caffe, so the environment alone comes too late
+    for lib_name, fn_name in (('libopenblas.so.0', 'openblas_set_num_threads'),
+                              ('libopenblas.so', 'openblas_set_num_threads'),
+                              ('libmkl_rt.so', 'MKL_Set_Num_Threads')):
+        try:
+            getattr(ctypes.CDLL(lib_name), fn_name)(ctypes.c_int(num_threads))
+        except (OSError, AttributeError):
+            continue
+
+
+# writer that sends the features of one scale to the main process
+class _QueueWriter:
+    def __init__(self, results, s):
+        self.results = results
+        self.s = s
+
+    def __setitem__(self, idx, feature):
+        self.results.put(('feature', self.s, idx, np.array(feature)))
+
+
+class CpuNets:
+    def __init__(self, net, proto, weights, num_procs=0, num_threads=1):
+        self.blobs = net.blobs  # the network of the main process only answers the shapes of the blobs
+        self.proto = proto
+        self.weights = weights
+        self.num_threads = max(1, num_threads)
+        self.num_procs = num_procs if num_procs > 0 else max(1, multiprocessing.cpu_count() // self.num_threads)
+        self.timeout = 1  # seconds between the checks that the workers are still alive
+
+    def work(self, load_fn, items, rows, num_scales, end_layer, batch_size, num_workers, results):
+        try:
+            set_blas_threads(self.num_threads)
+            caffe.set_mode_cpu()
+            net = caffe.Net(self.proto, self.weights, caffe.TEST)
+            batch_helper.extract_rmac_features_multiscale(
+                net, load_fn, items, [_QueueWriter(results, s) for s in range(num_scales)], end_layer, batch_size,
+                num_workers, rows, verbose=False)
+            results.put(('done', ))
+        except Exception:
+            results.put(('error', traceback.format_exc()))
+
+    # same as batch_helper.extract_rmac_features_multiscale, with the items shared among the worker processes
+    def extract_rmac_features_multiscale(self, load_fn, items, features_list, end_layer='rmac/normalized',
+                                         batch_size=1, num_workers=0, rows=None):
+        if rows is None:
+            rows = np.arange(len(items))
+        rows = np.asarray(rows)
+        num_procs = max(1, min(self.num_procs, len(items)))
+        num_scales = len(features_list)
+        results = multiprocessing.Queue(maxsize=64 * num_procs * num_scales)
+        # one thread per worker is enough to decode the images ahead of a network running on a few cores
+        procs = [multiprocessing.Process(target=self.work, args=(
+            load_fn, [items[i] for i in range(k, len(items), num_procs)], rows[k::num_procs], num_scales, end_layer,
+            batch_size, min(num_workers, 1), results)) for k in range(num_procs)]
+        for p in procs:
+            p.daemon = True
+            p.start()
+        pbar = tqdm(total=len(items) * num_scales, file=sys.stdout, leave=False, dynamic_ncols=True)
+        num_done = 0
+        try:
+            while num_done < num_procs:
+                try:
+                    result = results.get(timeout=self.timeout)
+                except queue.Empty:
+                    dead = [p for p in procs if p.exitcode not in (None, 0)]
+                    if len(dead) > 0:
+                        raise RuntimeError('a CPU worker exited with code %d' % dead[0].exitcode)
+                    continue
+                if result[0] == 'feature':
+                    features_list[result[1]][result[2]] = result[3]
+                    pbar.update(1)
+                elif result[0] == 'done':
+                    num_done += 1
+                else:
+                    raise RuntimeError('a CPU worker failed:\n' + result[1])
+        finally:
+            pbar.close()
+            for p in procs:
+                if p.is_alive():
+                    p.terminate()
+                p.join()
+        return features_list
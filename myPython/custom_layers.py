@@ -44,6 +44,8 @@ class AggregateLayer(caffe.Layer):
         self.batch_size = (bottom[0].data.shape[0]) / self.num_rois
 
     def reshape(self, bottom, top):
+        # the batch size may change between forward passes when images are batched
+        self.batch_size = (bottom[0].data.shape[0]) / self.num_rois
         tmp_shape = list(bottom[0].data.shape)
         tmp_shape[0] = self.batch_size
         top[0].reshape(*tmp_shape)
@@ -137,6 +139,7 @@ class RigidGridLayer(caffe.Layer):
                                     [0., 192., 96., 383., 287.]])
 
     def reshape(self, bottom, top):
+        self.batch_size = bottom[0].data.shape[0]
         top[0].reshape(*[self.batch_size * self.num_region, self.dim_rois])
 
     def forward(self, bottom, top):
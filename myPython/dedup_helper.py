@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+# Python script that mines the groups of duplicate images of a gallery: all the pairs of descriptors with a
+# similarity >= threshold are found by blocks, merged into groups (union-find), and every group is written as a line
+# 'anchor<TAB>item:score item:score ...' of the mapped file read by check_on_cover.py
+# usage: python ./myPython/dedup_helper.py --index_file features.fidx --threshold 0.65 \
+#            --output ~/data/cover/full/mapped/newsimfea512_0.65_res_mapped.txt
+#        (or --features_npy features.npy --features_txt training.txt instead of --index_file)
+#        offsets, members, scores = load_groups('newsimfea512_0.65_res_mapped.npz')  # the binary version
+
+'''
+Note:
+    The gallery is cut into tiles of rows and only the tiles (a, b) with b >= a are multiplied (a similarity matrix
+    is symmetric), so the whole gallery is compared with itself in N^2 / 2 dot products, and a tile pair keeps only
+    the indices of its similarities >= threshold: the memory holds two tiles and their similarities (mem_mb) plus
+    the union-find, whatever the number of images. The pairs are merged into the sets by arrays of a few million
+    (hooking and pointer jumping in numpy), and the pairs per image are counted over the span of their tile, so the
+    bookkeeping grows with the number of pairs, not with the number of tiles times N. The matrix products go to the
+    BLAS of numpy, which uses all the cores of the box (the bulk of the time for a million images); the stores of
+    quant_helper (float16, int8 with scale) are searched the same way, the tiles being cast to float32. The
+    descriptors are supposed L2-normalized.
+    The anchor of a group is its image with the most pairs >= threshold (the center of the group), and the score of
+    an item is its similarity to the anchor, so an item joined through another one can score < threshold. The anchor
+    is the first item of its own line (score of about 1), so the group directory made by check_on_cover.py contains
+    it. The image names are written without their extension. The binary version (.npz next to the mapped file)
+    holds the rows of the members of every group in CSR form, anchor first: members[offsets[g]: offsets[g + 1]].
+'''
+
+import os
+import time
+import argparse
+import numpy as np
+import quant_helper
+import feature_index
+
+
+# disjoint sets of the rows 0..n-1, merged by arrays of pairs: every row points directly to the root of its set,
+# which is the smallest row of the set
+class UnionFind:
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.int64)
+
+    # merge the sets of i[p] and j[p] for every p: the larger root of every pair is hooked under the smaller one (under
+    # one of them if it is in several pairs), and the paths are compressed by pointer jumping, until all the pairs are
+    # in the same sets
+    def union(self, i, j):
+        parent = self.parent
+        while len(i) > 0:
+            ri, rj = parent[i], parent[j]
+            keep = ri != rj
+            i, j, ri, rj = i[keep], j[keep], ri[keep], rj[keep]
+            if len(i) == 0:
+                break
+            parent[np.maximum(ri, rj)] = np.minimum(ri, rj)
+            self.compress()
+
+    def compress(self):
+        parent = self.parent
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent[:] = grand
+
+    # root of every row
+    def labels(self):
+        return self.parent.copy()
+
+
+# rows per tile such that two float32 tiles and their similarities fit in mem_mb: 2 * rows * dim + rows^2 floats
+def tile_rows(num_rows, dim, mem_mb=256):
+    budget = mem_mb * 1024 * 1024 // 4
+    rows = int(np.sqrt(dim * dim + budget) - dim)
+    return max(1, min(num_rows, rows))
+
+
+# (rows i, rows j, similarities) of the pairs i < j with a similarity >= threshold, one tile pair at a time
+def similar_pairs(data, threshold, mem_mb=256, scale=None):
+    N = data.shape[0]
+    rows = tile_rows(N, data.shape[1], mem_mb)
+    for a in range(0, N, rows):
+        left = np.ascontiguousarray(data[a: a + rows], dtype=np.float32)
+        if scale is not None:
+            left *= scale * scale  # x_i . x_j = sum_d scale_d^2 q_id q_jd
+        for b in range(a, N, rows):
+            right = left if b == a and scale is None else np.ascontiguousarray(data[b: b + rows], dtype=np.float32)
+            sim = left.dot(right.T)
+            i, j = np.nonzero(sim >= threshold)
+            if b == a:
+                keep = i < j
+                i, j = i[keep], j[keep]
+            yield i + a, j + b, sim[i, j]
+
+
+# add 1 to counts[r] for every r of rows, which all come from one tile (bincount over the span of the tile only)
+def add_counts(counts, rows):
+    lo = rows.min()
+    counts[lo: rows.max() + 1] += np.bincount(rows - lo)
+
+
+# groups of at least 2 rows linked by similarities >= threshold, as a list of arrays of rows, and the number of
+# pairs >= threshold of every row (the pairs are merged into the sets merge_every pairs at a time)
+def find_groups(data, threshold, mem_mb=256, scale=None, verbose=False, merge_every=1 << 22):
+    N = data.shape[0]
+    uf = UnionFind(N)
+    degree = np.zeros(N, dtype=np.int64)
+    waiting_i, waiting_j, num_waiting = [], [], 0
+    num_pairs = 0
+    start = last = time.time()
+    for i, j, _ in similar_pairs(data, threshold, mem_mb, scale):
+        if len(i) > 0:
+            add_counts(degree, i)
+            add_counts(degree, j)
+            waiting_i.append(i)
+            waiting_j.append(j)
+            num_waiting += len(i)
+            num_pairs += len(i)
+        if num_waiting >= merge_every:
+            uf.union(np.hstack(waiting_i), np.hstack(waiting_j))
+            waiting_i, waiting_j, num_waiting = [], [], 0
+        if verbose and time.time() - last > 60:
+            print("%d pairs >= %g found so far (%.0f s)" % (num_pairs, threshold, time.time() - start))
+            last = time.time()
+    if num_waiting > 0:
+        uf.union(np.hstack(waiting_i), np.hstack(waiting_j))
+    labels = uf.labels()
+    # the rows of the sets of at least 2 rows, grouped by set
+    rows = np.flatnonzero(np.bincount(labels, minlength=N)[labels] > 1)
+    order = rows[np.argsort(labels[rows], kind='mergesort')]
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    groups = np.split(order, bounds) if len(order) > 0 else []
+    return groups, degree
+
+
+# (anchor first, then the other members by decreasing similarity to the anchor, and these similarities)
+def rank_group(data, members, degree, scale=None):
+    anchor = members[np.argmax(degree[members])]
+    scores = quant_helper.dequantize(data[members], scale).dot(quant_helper.dequantize(data[anchor], scale))
+    order = np.lexsort((-scores, members != anchor))
+    return members[order], scores[order]
+
+
+# CSR arrays of the ranked groups: members[offsets[g]: offsets[g + 1]] and their scores, anchor first
+def mine_groups(data, threshold, mem_mb=256, scale=None, verbose=False):
+    groups, degree = find_groups(data, threshold, mem_mb, scale, verbose)
+    ranked = [rank_group(data, members, degree, scale) for members in groups]
+    offsets = np.r_[0, np.cumsum([len(members) for members in groups])].astype(np.int64)
+    members = np.hstack([m for m, _ in ranked]) if ranked else np.zeros(0, dtype=np.int64)
+    scores = np.hstack([s for _, s in ranked]) if ranked else np.zeros(0, dtype=np.float32)
+    return offsets, members.astype(np.int64), scores.astype(np.float32)
+
+
+def write_mapped(fname, offsets, members, scores, names):
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        for g in range(len(offsets) - 1):
+            items = [(os.path.splitext(names[m])[0], s) for m, s in
+                     zip(members[offsets[g]: offsets[g + 1]], scores[offsets[g]: offsets[g + 1]])]
+            f.write("{0}\t{1}\n".format(items[0][0], " ".join("%s:%.4f" % item for item in items)))
+    os.rename(tmp_fname, fname)
+
+
+def save_groups(fname, offsets, members, scores):
+    tmp_fname = fname + '.tmp.npz'
+    # rows in uint32 (galleries of less than 4 billion images) and scores in float16
+    np.savez(tmp_fname, offsets=offsets, members=members.astype(np.uint32), scores=scores.astype(np.float16))
+    os.rename(tmp_fname, fname)
+
+
+def load_groups(fname):
+    groups = np.load(fname)
+    return groups['offsets'], groups['members'].astype(np.int64), groups['scores'].astype(np.float32)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mine the groups of duplicate images and write the mapped file')
+    parser.add_argument('--index_file', type=str, required=False, help='Index of the gallery written by feature_index.py')
+    parser.add_argument('--features_npy', type=str, required=False, help='Features (.npy, float32 or written by quant_helper)')
+    parser.add_argument('--features_txt', type=str, required=False, help="Text index of the features ('name row' or 'row<TAB>name' lines)")
+    parser.add_argument('--threshold', type=float, required=False, help='Similarity threshold of the duplicates')
+    parser.add_argument('--output', type=str, required=True, help='Path of the mapped file (the binary version goes next to it, .npz)')
+    parser.add_argument('--mem_mb', type=int, required=False, help='Memory budget in MB of the tiles and their similarities')
+    parser.set_defaults(index_file=None, features_npy=None, features_txt=None, threshold=0.65, mem_mb=1024)
+    args = parser.parse_args()
+
+    if args.index_file is not None:
+        index = feature_index.FeatureIndex(args.index_file)
+        data, scale, names = index.vectors, index.scale, [index.name(row) for row in range(index.count)]
+    else:
+        assert args.features_npy is not None and args.features_txt is not None, \
+            'give --index_file or --features_npy and --features_txt'
+        data, scale = quant_helper.load_quantized(args.features_npy)
+        names = feature_index.read_names(args.features_txt)
+    assert len(names) == data.shape[0], 'one name per row is needed'
+
+    start = time.time()
+    offsets, members, scores = mine_groups(data, args.threshold, args.mem_mb, scale, verbose=True)
+    write_mapped(args.output, offsets, members, scores, names)
+    save_groups(os.path.splitext(args.output)[0] + '.npz', offsets, members, scores)
+    print("%d groups of %d images (of %d) written into %s in %.0f s" % (len(offsets) - 1, len(members), data.shape[0],
+                                                                        args.output, time.time() - start))
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# Python class of a descriptor cache shared by the extraction scripts, where the descriptor of an image is
+# looked up by the hash of the image content, so only new or changed images are fed into the network
+# usage: cache = DescriptorCache(cache_dir, model_fingerprint(proto, weights), S, L, 'rmac/normalized', dim)
+#        features = CachedWriter(features, cache, file_digests(fnames))
+#        rows, num_hits = features.fill(rows)  # copy the cached descriptors and return the rows still missing
+#        ... extract the rows into features ...
+#        features.close()
+
+'''
+Note:
+    A cache is a sub-directory of 'cache_dir' named after the hash of (model fingerprint, S, L, output blob,
+    preprocessing), where the model fingerprint is the hash of the prototxt and the caffemodel. So changing the
+    weights, the prototxt or the output layer never reuses stale descriptors. Inside the sub-directory,
+    'vectors.bin' holds the raw descriptors appended row by row and 'index.txt' maps the sha1 of an image file
+    to its row ('<sha1> <row>' per line). The rows are appended before the index, so a crash in between only
+    loses the last descriptors, which are extracted again on the next run.
+'''
+
+import os
+import json
+import hashlib
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+
+# sha1 of the content of a file
+def file_digest(fname, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            sha1.update(block)
+            block = f.read(block_size)
+    return sha1.hexdigest()
+
+
+# sha1 of many files, hashed by a pool of threads (hashlib releases the GIL)
+def file_digests(fnames, num_workers=4):
+    if num_workers <= 1:
+        return [file_digest(f) for f in fnames]
+    pool = ThreadPool(num_workers)
+    digests = pool.map(file_digest, fnames, chunksize=64)
+    pool.close()
+    return digests
+
+
+# identifies the model by the content of both the prototxt and the caffemodel
+def model_fingerprint(proto, weights):
+    return hashlib.sha1(file_digest(proto) + file_digest(weights)).hexdigest()
+
+
+class DescriptorCache:
+    def __init__(self, cache_dir, model_fp, S, L, blob, dim, preprocess='', dtype=np.float32, flush_every=1000):
+        self.meta = {'model': model_fp, 'S': S, 'L': L, 'blob': blob, 'dim': dim, 'preprocess': preprocess,
+                     'dtype': np.dtype(dtype).name}
+        key = hashlib.sha1('{0}|S{1}|L{2}|{3}|{4}'.format(model_fp, S, L, blob, preprocess)).hexdigest()
+        self.cache_dir = os.path.join(cache_dir, key)
+        self.vectors_fname = os.path.join(self.cache_dir, 'vectors.bin')
+        self.index_fname = os.path.join(self.cache_dir, 'index.txt')
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.flush_every = flush_every
+        self.index = {}  # key: sha1 of the image; value: row in vectors.bin
+        self.num_rows = 0
+        self.waiting_digests = []
+        self.waiting_features = []
+        self.vectors = None
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        meta_fname = os.path.join(self.cache_dir, 'meta.json')
+        if not os.path.exists(meta_fname):
+            with open(meta_fname, 'w') as f:
+                json.dump(self.meta, f)
+        if not os.path.exists(self.index_fname):
+            return
+        # rows of the index beyond the end of vectors.bin come from an interrupted write and are ignored
+        row_bytes = self.dim * self.dtype.itemsize
+        self.num_rows = os.path.getsize(self.vectors_fname) // row_bytes if os.path.exists(self.vectors_fname) else 0
+        with open(self.index_fname, 'r') as f:
+            for line in f:
+                line_split = line.split()
+                if len(line_split) == 2 and int(line_split[1]) < self.num_rows:
+                    self.index[line_split[0]] = int(line_split[1])
+
+    def __contains__(self, digest):
+        return digest in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    # descriptors of the given digests, which should all be in the cache
+    def get(self, digests):
+        if self.vectors is None or self.vectors.shape[0] != self.num_rows:
+            self.vectors = np.memmap(self.vectors_fname, dtype=self.dtype, mode='r', shape=(self.num_rows, self.dim))
+        return np.array(self.vectors[[self.index[d] for d in digests]])
+
+    def put(self, digest, feature):
+        if digest in self.index:
+            return
+        self.waiting_digests.append(digest)
+        self.waiting_features.append(np.asarray(feature, dtype=self.dtype).reshape(self.dim))
+        if len(self.waiting_digests) >= self.flush_every:
+            self.flush()
+
+    # append the waiting descriptors to vectors.bin and then record them in the index
+    def flush(self):
+        if len(self.waiting_digests) == 0:
+            return
+        # the same image may be put twice before a flush (e.g. duplicated files)
+        rows = {}
+        for k, d in enumerate(self.waiting_digests):
+            rows.setdefault(d, k)
+        order = sorted(rows.values())
+        with open(self.vectors_fname, 'ab') as f:
+            np.vstack([self.waiting_features[k] for k in order]).tofile(f)
+        with open(self.index_fname, 'a') as f:
+            for n, k in enumerate(order):
+                f.write('{0} {1}\n'.format(self.waiting_digests[k], self.num_rows + n))
+                self.index[self.waiting_digests[k]] = self.num_rows + n
+        self.num_rows += len(order)
+        self.waiting_digests = []
+        self.waiting_features = []
+
+
+# writer that copies the descriptors found in the cache into 'features' and puts the extracted ones into the cache
+# digests[i] is the sha1 of the image of row i
+class CachedWriter:
+    def __init__(self, features, cache, digests):
+        self.features = features
+        self.cache = cache
+        self.digests = digests
+        self.filled = set()  # rows copied from the cache, which are not overwritten by the extraction
+
+    # fill the rows found in the cache and return the rows which still have to be extracted, and the number of rows found
+    def fill(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        hit = np.array([self.digests[i] in self.cache for i in rows], dtype=bool)
+        if hit.any():
+            cached = self.cache.get([self.digests[i] for i in rows[hit]])
+            for k, i in enumerate(rows[hit]):
+                self.features[i] = cached[k]
+                self.filled.add(i)
+        return rows[~hit], int(hit.sum())
+
+    def __setitem__(self, idx, feature):
+        if idx in self.filled:
+            return
+        self.features[idx] = feature
+        self.cache.put(self.digests[idx], feature)
+
+    def close(self):
+        self.cache.flush()
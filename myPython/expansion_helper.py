@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# Python functions for the database-side expansion (DBE) and the average query expansion (AQE) of the retrieval, on
+# galleries too large for an all-pairs similarity matrix
+# usage: features_dataset = database_side_expansion(features_dataset, k=20)
+#        features_dataset = database_side_expansion(features_dataset, k=20, fname='tmp/Oxford_dataset_dbe20.npy')
+#        features_queries = average_query_expansion(features_queries, features_dataset, k=1, alpha=3., rounds=2)
+
+'''
+Note:
+    DBE replaces every gallery descriptor with the weighted average of its k+1 nearest neighbors (the first one
+    being the image itself, weight 1, then weights k/k, (k-1)/k, ..., 1/k), as in test.py. The neighbor graph is
+    found with the tiled search of search_helper, so the N x N similarities are never built, and the averages are
+    computed by blocks of images, each with one gather of the neighbor descriptors. With fname, the expanded
+    gallery is written there (memory-mapped, renamed once complete) together with a digest of the input features in
+    '<fname>.sha1', and a later call with the same features and k loads it instead of computing it again.
+    AQE replaces every query with the average of itself and its k nearest gallery images, found with the same
+    search. With alpha > 0 (alpha-QE) a neighbor is weighted by its similarity to the power alpha (negative ones
+    count as 0) and the query by 1, and alpha = 0 is the plain average of test.py. Every round searches again with
+    the expanded queries, which are L2-normalized in between (this does not change their ranking but keeps the
+    weights of the next round comparable). The queries are expanded by batches, each with one gather of the
+    neighbor descriptors.
+'''
+
+import os
+import hashlib
+import numpy as np
+import search_helper
+
+
+# sha1 of the values of the features (read by blocks of rows, so a memory-mapped array is not loaded at once)
+def features_digest(features, block_rows=10000):
+    h = hashlib.sha1(str(features.shape) + str(features.dtype))
+    for start in range(0, features.shape[0], block_rows):
+        h.update(np.ascontiguousarray(features[start: start + block_rows]).tobytes())
+    return h.hexdigest()
+
+
+def dbe_weights(k):
+    return np.hstack(([1], (k - np.arange(0, k)) / float(k))).astype(np.float32)
+
+
+# ids (N x (k+1)) of the k+1 nearest neighbors of every gallery image (itself included)
+def knn_graph(features, k, mem_mb=256):
+    ids, _ = search_helper.search(features, features, k + 1, mem_mb)
+    return ids
+
+
+# weighted average of the rows ids[i] of features (weights of the columns of ids) for every i, by blocks of rows
+def weighted_neighbor_average(features, ids, weights, out, block_rows=1024):
+    weights = weights / weights.sum()
+    for start in range(0, ids.shape[0], block_rows):
+        neighbors = np.asarray(features[ids[start: start + block_rows]], dtype=np.float32)  # block x (k+1) x dim
+        out[start: start + block_rows] = np.tensordot(neighbors, weights, axes=([1], [0]))
+    return out
+
+
+# weights of the neighbors for alpha-QE (similarities to the power alpha, 1 for alpha = 0)
+def aqe_weights(scores, alpha):
+    if alpha == 0:
+        return np.ones(scores.shape, dtype=np.float32)
+    return np.power(np.maximum(scores, 0), alpha).astype(np.float32)
+
+
+def average_query_expansion(queries, gallery, k, alpha=0., rounds=1, mem_mb=256, batch_size=4096):
+    k = min(k, gallery.shape[0])
+    queries = np.array(queries, dtype=np.float32)
+    for r in range(rounds):
+        if r > 0:
+            queries /= np.sqrt((queries * queries).sum(axis=1))[:, None]
+        expanded = np.zeros(queries.shape, dtype=np.float32)
+        for start in range(0, queries.shape[0], batch_size):
+            Q = queries[start: start + batch_size]
+            ids, scores = search_helper.search(Q, gallery, k, mem_mb)
+            weights = aqe_weights(scores, alpha)  # batch x k
+            neighbors = np.asarray(gallery[ids.ravel()], dtype=np.float32).reshape(ids.shape[0], k, -1)
+            expanded[start: start + batch_size] = (Q + (neighbors * weights[:, :, None]).sum(axis=1)) / (
+                1 + weights.sum(axis=1))[:, None]
+        queries = expanded
+    return queries
+
+
+def database_side_expansion(features, k, fname=None, mem_mb=256):
+    if fname is None:
+        ids = knn_graph(features, k, mem_mb)
+        out = np.zeros((features.shape[0], features.shape[1]), dtype=np.float32)
+        return weighted_neighbor_average(features, ids, dbe_weights(k), out)
+    digest = features_digest(features) + ' dbe' + str(k)
+    digest_fname = fname + '.sha1'
+    if os.path.exists(fname) and os.path.exists(digest_fname) and open(digest_fname, 'r').read() == digest:
+        return np.load(fname, mmap_mode='r')
+    ids = knn_graph(features, k, mem_mb)
+    tmp_fname = fname + '.tmp.npy'
+    out = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=np.float32, shape=(features.shape[0], features.shape[1]))
+    weighted_neighbor_average(features, ids, dbe_weights(k), out)
+    out.flush()
+    del out
+    if os.path.exists(digest_fname):
+        os.remove(digest_fname)  # so that an interrupted run never pairs the new file with the old digest
+    os.rename(tmp_fname, fname)
+    with open(digest_fname, 'w') as f:
+        f.write(digest)
+    return np.load(fname, mmap_mode='r')
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Python class that captures several blobs of the network from a single forward pass and streams every blob into
+# its own writer
+# usage: engine = ExtractionEngine(net, ['rmac/normalized', 'rmac_branch_16/normalized'], batch_size=8, num_workers=4)
+#        engine.run(image_helper.prepare_image_and_grid_regions_for_network, fnames, [features_master, features_16])
+#        where writers[b][i] = output of blobs[b] for fnames[i] (any array or object with __setitem__)
+
+'''
+Note:
+    The network is run up to the layer producing the last of the requested blobs (in the order of the network), so
+    all of them are computed by one forward pass, whatever the order they are requested in. Most blobs have one row
+    per image (e.g. 'rmac/normalized'), and each image gets its row flattened. Blobs with one row per roi
+    (e.g. 'pooled_rois_branch_16/normalized') are listed in 'per_roi', and each image gets the (num_rois x dim)
+    block of its own rois, found from the batch index in column 0 of the rois blob. Images of the same shape are
+    batched together as in batch_helper.
+'''
+
+import sys
+import numpy as np
+from tqdm import tqdm
+import batch_helper
+
+
+# name of the layer producing the last of the blobs (the layers are usually named after their top blob)
+def end_layer_of(net, blobs):
+    names = list(net.blobs.keys())
+    last = max(blobs, key=names.index)
+    end = last
+    for layer, tops in getattr(net, 'top_names', {}).items():
+        if last in tops:
+            end = layer  # in-place layers write the blob again, so the last one wins
+    return end
+
+
+# feed a batch of images and return, for every image, the list of its outputs (one per blob)
+def forward_blobs(net, images, regions, blobs, end, per_roi=(), inputs=None):
+    R = (inputs if inputs is not None else batch_helper.InputBlobs()).set(net, images, regions)
+    net.forward(end=end)
+    outputs = [[] for _ in images]
+    for blob in blobs:
+        data = np.array(net.blobs[blob].data)
+        if blob in per_roi:
+            assert R is not None and data.shape[0] == R.shape[0], '%s does not have one row per roi' % blob
+            data = data.reshape(data.shape[0], -1)
+            for k in range(len(images)):
+                outputs[k].append(data[R[:, 0] == k])
+        else:
+            data = data.reshape(len(images), -1)
+            for k in range(len(images)):
+                outputs[k].append(data[k])
+    return outputs
+
+
+class _MultiBlobForward(batch_helper.BatchForward):
+    def __init__(self, net, blobs, end, per_roi, batch_size):
+        batch_helper.BatchForward.__init__(self, net, end, batch_size)
+        self.blobs = blobs
+        self.per_roi = per_roi
+
+    def forward(self, images, regions):
+        return forward_blobs(self.net, images, regions, self.blobs, self.end_layer, self.per_roi, self.inputs)
+
+
+class ExtractionEngine:
+    def __init__(self, net, blobs, per_roi=(), batch_size=1, num_workers=0):
+        self.net = net
+        self.blobs = list(blobs)
+        self.per_roi = set(per_roi)
+        self.end = end_layer_of(net, self.blobs)
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+
+    # load_fn(item) returns the (I, R) pair of an item, and the output of blobs[b] for items[i] goes to
+    # writers[b][i] (or writers[b][rows[i]])
+    def run(self, load_fn, items, writers, rows=None):
+        assert len(writers) == len(self.blobs), 'one writer per blob is needed'
+        if rows is None:
+            rows = np.arange(len(items))
+        batcher = _MultiBlobForward(self.net, self.blobs, self.end, self.per_roi, self.batch_size)
+        loaded = batch_helper.load_items(load_fn, items, self.num_workers,
+                                         queue_size=max(4 * self.num_workers, 2 * self.batch_size))
+        for i, (I, R) in enumerate(tqdm(loaded, total=len(items), file=sys.stdout, leave=False, dynamic_ncols=True)):
+            for k, outputs in batcher.push(rows[i], I, R):
+                self.write(writers, k, outputs)
+        for k, outputs in batcher.flush():
+            self.write(writers, k, outputs)
+        return writers
+
+    @staticmethod
+    def write(writers, k, outputs):
+        for writer, output in zip(writers, outputs):
+            writer[k] = output
+
+
+# writer that applies fn to the output before storing it (e.g. scaling, or aggregating the rois of an image)
+class MapWriter:
+    def __init__(self, features, fn):
+        self.features = features
+        self.fn = fn
+
+    def __setitem__(self, idx, output):
+        self.features[idx] = self.fn(output)
+
+
+# writer that keeps the per-roi outputs of every image (writer[i] is the block of the i-th image),
+# stacked in the order of the images by result()
+class RoiWriter:
+    def __init__(self):
+        self.outputs = {}
+
+    def __setitem__(self, idx, output):
+        self.outputs[idx] = output
+
+    def __getitem__(self, idx):
+        return self.outputs[idx]
+
+    def result(self):
+        return np.vstack([self.outputs[idx] for idx in sorted(self.outputs.keys())])
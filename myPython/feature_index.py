@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# Python class of the on-disk index of the descriptors: a single file with a header (dim, dtype, count, model
+# fingerprint), the vectors (memory-mapped, never loaded at once) and a table of the image names sorted for a binary
+# search, so that a reader opens it in constant time and maps rows to image names and back
+# usage: write_index('features.fidx', np.load('features.npy', mmap_mode='r'), names, model_fp, dtype='float32')
+#        index = FeatureIndex('features.fidx')
+#        index.vectors  # count x dim memory-mapped array (float32, float16 or int8 with index.scale)
+#        index[rows]  # float32 descriptors of some rows, index.name(row), index.row('all_souls_000013')
+#        python ./myPython/feature_index.py --features_npy features.npy --features_txt training.txt --output features.fidx
+
+'''
+Note:
+    Layout of the file (all integers little-endian):
+        [0, 4096)   magic 'RMACIDX1' then the header as json, padded with spaces: dim, dtype ('float32', 'float16' or
+                    'int8'), count, model_fingerprint and the byte offsets of the blocks below
+        vectors     count x dim values of dtype, row-major, starting at 4096 so that the block is page-aligned
+        scale       dim float32, only for int8 (a descriptor is scale * its int8 values, see quant_helper)
+        names       the utf-8 names of the images concatenated in sorted order
+        offsets     count + 1 uint64, the name of the i-th sorted image is names[offsets[i]: offsets[i + 1]]
+        rows        count uint64, row of the i-th sorted image
+        order       count uint64, position in the sorted order of the image of every row
+    A name is found by a binary search on the sorted names (log(count) names read from the memory map), and the
+    name of a row through 'order'. The writer reads the features by blocks and renames the file once complete.
+    The text index files of the repo ('name row' of shard_helper, 'row<TAB>name' of test_image2features.py) are
+    both read by read_names.
+'''
+
+import os
+import json
+import argparse
+import numpy as np
+import quant_helper
+
+MAGIC = b'RMACIDX1'
+HEADER_SIZE = 4096
+
+
+# image names in the order of the rows of a text index, 'name row' or 'row<TAB>name' per line
+def read_names(features_txt):
+    rows = {}
+    for line in open(features_txt, 'r'):
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        if '\t' in line:
+            row, name = line.split('\t', 1)
+        else:
+            name, row = line.rsplit(' ', 1)
+        rows[int(row)] = name
+    assert sorted(rows.keys()) == list(range(len(rows))), 'rows of %s are not 0..n-1' % features_txt
+    return [rows[i] for i in range(len(rows))]
+
+
+def write_index(fname, features, names, model_fingerprint='', dtype='float32', block_rows=65536):
+    assert len(names) == features.shape[0], 'one name per row is needed'
+    assert len(set(names)) == len(names), 'the names should be unique'
+    count, dim = features.shape
+    scale = quant_helper.int8_scale(features, block_rows) if dtype == 'int8' else None
+    keys = [name.encode('utf-8') if not isinstance(name, bytes) else name for name in names]
+    sorted_rows = np.array(sorted(range(count), key=lambda i: keys[i]), dtype=np.uint64)
+    order = np.zeros(count, dtype=np.uint64)
+    order[sorted_rows.astype(np.int64)] = np.arange(count, dtype=np.uint64)
+    blob = b''.join(keys[i] for i in sorted_rows)
+    offsets = np.r_[0, np.cumsum([len(keys[i]) for i in sorted_rows])].astype(np.uint64)
+    vectors_offset = HEADER_SIZE
+    scale_offset = vectors_offset + count * dim * np.dtype(dtype).itemsize
+    names_offset = scale_offset + (dim * 4 if scale is not None else 0)
+    offsets_offset = names_offset + len(blob) + (-len(blob)) % 8
+    rows_offset = offsets_offset + 8 * (count + 1)
+    order_offset = rows_offset + 8 * count
+    header = json.dumps({'dim': dim, 'dtype': dtype, 'count': count, 'model_fingerprint': model_fingerprint,
+                         'vectors': vectors_offset, 'scale': scale_offset if scale is not None else None,
+                         'names': names_offset, 'offsets': offsets_offset, 'rows': rows_offset,
+                         'order': order_offset}).encode('utf-8')
+    assert len(MAGIC) + len(header) <= HEADER_SIZE, 'header too long'
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(MAGIC + header + b' ' * (HEADER_SIZE - len(MAGIC) - len(header)))
+        for start in range(0, count, block_rows):
+            block = features[start: start + block_rows]
+            block = quant_helper.quantize(block, dtype, scale) if dtype != 'float32' else np.asarray(block, np.float32)
+            f.write(np.ascontiguousarray(block).astype(np.dtype(dtype).newbyteorder('<')).tobytes())
+        if scale is not None:
+            f.write(scale.astype('<f4').tobytes())
+        f.write(blob + b'\0' * ((-len(blob)) % 8))
+        for array in (offsets, sorted_rows, order):
+            f.write(array.astype('<u8').tobytes())
+    os.rename(tmp_fname, fname)
+
+
+class FeatureIndex:
+    def __init__(self, fname):
+        with open(fname, 'rb') as f:
+            head = f.read(HEADER_SIZE)
+        assert head[:len(MAGIC)] == MAGIC, '%s is not a feature index' % fname
+        self.header = json.loads(head[len(MAGIC):].decode('utf-8').strip())
+        self.dim = self.header['dim']
+        self.dtype = self.header['dtype']
+        self.count = self.header['count']
+        self.model_fingerprint = self.header['model_fingerprint']
+        self.data = np.memmap(fname, dtype=np.uint8, mode='r')
+        self.vectors = self.array(self.header['vectors'], np.dtype(self.dtype).newbyteorder('<'),
+                                  self.count * self.dim).reshape(self.count, self.dim)
+        self.scale = None
+        if self.header['scale'] is not None:
+            self.scale = np.array(self.array(self.header['scale'], '<f4', self.dim))
+        self.offsets = self.array(self.header['offsets'], '<u8', self.count + 1)
+        self.rows = self.array(self.header['rows'], '<u8', self.count)
+        self.order = self.array(self.header['order'], '<u8', self.count)
+
+    # view of count values of dtype at a byte offset of the file
+    def array(self, offset, dtype, count):
+        dtype = np.dtype(dtype)
+        return self.data[offset: offset + count * dtype.itemsize].view(dtype)
+
+    def __len__(self):
+        return self.count
+
+    # float32 descriptors of the rows (an int, a slice or an array of rows)
+    def __getitem__(self, rows):
+        return quant_helper.dequantize(self.vectors[rows], self.scale)
+
+    # utf-8 bytes of the i-th name in the sorted order
+    def sorted_key(self, i):
+        start = self.header['names']
+        return self.data[start + int(self.offsets[i]): start + int(self.offsets[i + 1])].tobytes()
+
+    def sorted_name(self, i):
+        return self.sorted_key(i).decode('utf-8')
+
+    def name(self, row):
+        return self.sorted_name(int(self.order[row]))
+
+    # row of an image name (binary search on the sorted utf-8 names, as write_index sorts them), -1 if not in the index
+    def row(self, name):
+        key = name.encode('utf-8') if not isinstance(name, bytes) else name
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sorted_key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.sorted_key(lo) == key:
+            return int(self.rows[lo])
+        return -1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert features.npy and its text index into a single index file')
+    parser.add_argument('--features_npy', type=str, required=True, help='Features (.npy, memory-mapped)')
+    parser.add_argument('--features_txt', type=str, required=True, help="Text index ('name row' or 'row<TAB>name' lines)")
+    parser.add_argument('--output', type=str, required=True, help='Path of the index file')
+    parser.add_argument('--dtype', type=str, required=False, help='Storage type of the vectors (float32, float16 or int8)')
+    parser.add_argument('--proto', type=str, required=False, help='Prototxt of the model, for the fingerprint')
+    parser.add_argument('--weights', type=str, required=False, help='Caffemodel of the model, for the fingerprint')
+    parser.set_defaults(dtype='float32', proto=None, weights=None)
+    args = parser.parse_args()
+
+    model_fp = ''
+    if args.proto is not None and args.weights is not None:
+        import descriptor_cache
+        model_fp = descriptor_cache.model_fingerprint(args.proto, args.weights)
+    features = np.load(args.features_npy, mmap_mode='r')
+    write_index(args.output, features, read_names(args.features_txt), model_fp, args.dtype)
+    print("Index of %d images (%d-dim %s) written into %s" % (features.shape[0], features.shape[1], args.dtype,
+                                                             args.output))
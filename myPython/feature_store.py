@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Python class that writes the features into a memory-mapped .npy file and can resume an interrupted extraction
+# usage: writer = ResumableFeatures('Oxford_S512_L2_dataset.npy', num, dim)
+#        rows = writer.pending()  # rows not extracted yet (all of them on the first run)
+#        for i in rows: writer[i] = ...
+#        writer.finish()  # renames the file to 'Oxford_S512_L2_dataset.npy'
+
+'''
+Note:
+    While running, the features live in '<fname>.partial', which is already a valid .npy file (header + rows), and
+    the rows that are done are recorded in '<fname>.progress', a small json file with a list of [start, end) ranges.
+    The memory map is flushed before the progress file is (atomically) rewritten, so a row is never recorded as done
+    before its data is on disk. On restart, the rows recorded in the progress file are skipped. When all the rows
+    are done the partial file is renamed to 'fname', which can be loaded by np.load as before.
+'''
+
+import os
+import json
+import numpy as np
+
+
+class ResumableFeatures:
+    def __init__(self, fname, num, dim, dtype=np.float32, checkpoint_every=1000):
+        self.fname = fname
+        self.partial_fname = fname + '.partial'
+        self.progress_fname = fname + '.progress'
+        self.shape = (num, dim)
+        self.dtype = np.dtype(dtype)
+        self.checkpoint_every = checkpoint_every
+        self.num_since_checkpoint = 0
+        self.done = np.zeros(num, dtype=bool)
+        self.features = None
+        self.open()
+
+    def open(self):
+        if os.path.exists(self.partial_fname) and os.path.exists(self.progress_fname):
+            progress = json.load(open(self.progress_fname, 'r'))
+            if tuple(progress['shape']) == self.shape and progress['dtype'] == self.dtype.name:
+                self.features = np.lib.format.open_memmap(self.partial_fname, mode='r+')
+                for start, end in progress['done']:
+                    self.done[start: end] = True
+                print("Resuming %s: %d/%d rows done" % (self.fname, self.done.sum(), self.shape[0]))
+                return
+            print("WARNING: progress of %s does not match, start from scratch" % self.fname)
+        self.features = np.lib.format.open_memmap(self.partial_fname, mode='w+', dtype=self.dtype, shape=self.shape)
+        self.checkpoint()
+
+    # indices of the rows which are not extracted yet
+    def pending(self):
+        return np.where(~self.done)[0]
+
+    def __setitem__(self, idx, feature):
+        self.features[idx] = feature
+        self.done[idx] = True
+        self.num_since_checkpoint += 1
+        if self.num_since_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+
+    # flush the rows to disk and then record them as done
+    def checkpoint(self):
+        self.features.flush()
+        # the done rows are saved as [start, end) ranges, which are few as the rows are mostly done in order
+        edges = np.diff(np.concatenate(([0], self.done.astype(np.int8), [0])))
+        ranges = np.vstack((np.where(edges == 1)[0], np.where(edges == -1)[0])).T
+        progress = {'shape': list(self.shape), 'dtype': self.dtype.name, 'done': ranges.tolist()}
+        tmp_fname = self.progress_fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(progress, f)
+        os.rename(tmp_fname, self.progress_fname)
+        self.num_since_checkpoint = 0
+
+    # rename the partial file to the final name once every row is done
+    def finish(self):
+        self.checkpoint()
+        assert self.done.all(), '%d rows of %s are not extracted' % ((~self.done).sum(), self.fname)
+        del self.features
+        self.features = None
+        os.rename(self.partial_fname, self.fname)
+        os.remove(self.progress_fname)
+        return self.fname
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+# Python class of an HNSW graph index (hierarchical navigable small world) of L2-normalized descriptors, such as the
+# 'rmac/normalized' outputs, for approximate top-k searches in a sub-linear number of similarities
+# usage: index = HnswIndex(dim=2048, M=16, ef_construction=100)
+#        index.add(features_dataset)  # can be called again with more images, which get the next ids
+#        ids, scores = index.search(features_queries, k=10, ef=64)
+#        index.save('features.hnsw.npz')  # and HnswIndex.load('features.hnsw.npz')
+
+'''
+Note:
+    Every image is a node of the layer 0 and of the layers 1..l above it, l being drawn at random with
+    P(l >= i) = M^-i, so every layer holds about 1/M of the nodes of the layer below. A search goes down greedily
+    from the entry point (the node of the top layer) to the layer 1, and runs a best-first search keeping the ef
+    best nodes on the layer 0. An inserted node is linked to M nodes of every layer it belongs to (2 * M on the
+    layer 0), chosen among the ef_construction nodes found by the same search with the heuristic of the paper (a
+    candidate is skipped if it is more similar to an already chosen neighbor than to the new node), and the links
+    of a neighbor with too many links are pruned the same way. The similarity is the dot product, which ranks like
+    the euclidean distance on L2-normalized descriptors. A larger ef gives a better recall for a slower search.
+    The search of a layer expands all the new nodes of its ef best at once and scores their unseen neighbors in one
+    product (visited nodes are marked in an array, not a set), and the pruning of the links scores the candidates
+    against each other in one product, but the graph is still walked and built one node at a time in Python: a build
+    inserts a few hundred images per second, so this index suits galleries of up to a few hundred thousand images
+    (about 1-3 ms per query at ef=64); a million-scale build needs the C++ library of the paper (hnswlib) or the IVF
+    of ivf_helper.py. The state of the level generator is saved with the index, so inserts after a reload go on drawing
+    new levels.
+    Run this script to compare recall, mAP and time per query with the brute force for several ef.
+'''
+
+import os
+import time
+import itertools
+import argparse
+import numpy as np
+import index_eval
+
+
+class HnswIndex:
+    def __init__(self, dim, M=16, ef_construction=100, seed=0):
+        self.dim = dim
+        self.M = M
+        self.ef_construction = ef_construction
+        self.vectors = np.zeros((1024, dim), dtype=np.float32)  # grown by doubling, the first count rows are used
+        self.count = 0
+        self.links = []  # links[i][l] = list of the neighbors of node i on layer l
+        self.entry = -1
+        self.max_level = -1
+        self.rng = np.random.RandomState(seed)
+        self.visited = np.zeros(len(self.vectors), dtype=np.int64)  # visited[i] == stamp if node i is seen by the search
+        self.stamp = 0
+
+    def max_links(self, level):
+        return 2 * self.M if level == 0 else self.M
+
+    def similarities(self, q, nodes):
+        return self.vectors[nodes].dot(q)
+
+    # ef best nodes of a layer from the entry nodes, as arrays (similarities, nodes), best first: all the nodes of the
+    # current ef best that are not expanded yet are expanded together, and their new neighbors are scored in one product
+    def search_layer(self, q, entries, ef, level):
+        if len(self.visited) < len(self.vectors):
+            self.visited = np.zeros(len(self.vectors), dtype=np.int64)
+            self.stamp = 0
+        self.stamp += 1
+        nodes = np.unique(np.asarray(entries, dtype=np.int64))
+        self.visited[nodes] = self.stamp
+        sims = self.similarities(q, nodes)
+        expanded = np.zeros(len(nodes), dtype=bool)
+        while True:
+            if len(nodes) > ef:
+                best = np.argpartition(-sims, ef - 1)[:ef]
+                nodes, sims, expanded = nodes[best], sims[best], expanded[best]
+            frontier = nodes[~expanded]
+            if len(frontier) == 0:
+                break
+            expanded[:] = True
+            neighbors = np.fromiter(itertools.chain.from_iterable(self.links[c][level] for c in frontier.tolist()),
+                                    dtype=np.int64)
+            neighbors = np.unique(neighbors)
+            neighbors = neighbors[self.visited[neighbors] != self.stamp]
+            if len(neighbors) == 0:
+                break
+            self.visited[neighbors] = self.stamp
+            nodes = np.r_[nodes, neighbors]
+            sims = np.r_[sims, self.similarities(q, neighbors)]
+            expanded = np.r_[expanded, np.zeros(len(neighbors), dtype=bool)]
+        order = np.argsort(-sims, kind='mergesort')
+        return sims[order], nodes[order]
+
+    # at most num of the candidates (similarities, nodes, best first), keeping the ones that are not closer to a chosen
+    # one: the similarities between the candidates are computed in one product
+    def select_neighbors(self, sims, nodes, num):
+        vectors = self.vectors[nodes]
+        between = vectors.dot(vectors.T)
+        selected = []
+        for i in range(len(nodes)):
+            if len(selected) >= num:
+                break
+            if not selected or np.all(between[i, selected] < sims[i]):
+                selected.append(i)
+        return nodes[selected].tolist()
+
+    def insert(self, v):
+        node = self.count
+        if node == len(self.vectors):
+            self.vectors = np.vstack((self.vectors, np.zeros_like(self.vectors)))
+        self.vectors[node] = v
+        self.count += 1
+        level = int(-np.log(1.0 - self.rng.random_sample()) / np.log(self.M))
+        self.links.append([[] for _ in range(level + 1)])
+        if self.entry < 0:
+            self.entry, self.max_level = node, level
+            return node
+        entries = [self.entry]
+        for l in range(self.max_level, level, -1):
+            entries = self.search_layer(v, entries, 1, l)[1]
+        for l in range(min(level, self.max_level), -1, -1):
+            sims, found = self.search_layer(v, entries, self.ef_construction, l)
+            neighbors = self.select_neighbors(sims, found, self.M)
+            self.links[node][l] = neighbors
+            for n in neighbors:
+                links = self.links[n][l]
+                links.append(node)
+                if len(links) > self.max_links(l):
+                    links = np.array(links, dtype=np.int64)
+                    link_sims = self.similarities(self.vectors[n], links)
+                    order = np.argsort(-link_sims)
+                    self.links[n][l] = self.select_neighbors(link_sims[order], links[order], self.max_links(l))
+            entries = found
+        if level > self.max_level:
+            self.entry, self.max_level = node, level
+        return node
+
+    # insert the rows of features, which get the ids count, count + 1, ...
+    def add(self, features):
+        for i in range(features.shape[0]):
+            self.insert(np.asarray(features[i], dtype=np.float32))
+        return self
+
+    # ids and similarities of the k best images of every query (-1 / -inf if the index has less than k images)
+    def search(self, queries, k, ef=64):
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        if self.entry < 0:
+            return ids, scores
+        for q in range(len(queries)):
+            v = np.asarray(queries[q], dtype=np.float32)
+            entries = [self.entry]
+            for l in range(self.max_level, 0, -1):
+                entries = self.search_layer(v, entries, 1, l)[1]
+            sims, found = self.search_layer(v, entries, max(ef, k), 0)
+            ids[q, :min(k, len(found))] = found[:k]
+            scores[q, :min(k, len(found))] = sims[:k]
+        return ids, scores
+
+    # the links are saved flat: for every node in order, for every layer of the node, its number of links, then them;
+    # the state of the level generator is saved too, so that the inserts after a reload draw new levels
+    def save(self, fname):
+        levels = np.array([len(links) - 1 for links in self.links], dtype=np.int32)
+        counts = np.array([len(layer) for links in self.links for layer in links], dtype=np.int32)
+        flat = np.array([n for links in self.links for layer in links for n in layer], dtype=np.int32)
+        _, keys, pos, has_gauss, cached_gaussian = self.rng.get_state()
+        np.savez(fname, vectors=self.vectors[:self.count], levels=levels, counts=counts, links=flat,
+                 params=np.array([self.M, self.ef_construction, self.entry, self.max_level], dtype=np.int64),
+                 rng_keys=keys, rng_params=np.array([pos, has_gauss], dtype=np.int64),
+                 rng_gaussian=np.array([cached_gaussian], dtype=np.float64))
+
+    @staticmethod
+    def load(fname):
+        data = np.load(fname)
+        M, ef_construction, entry, max_level = [int(v) for v in data['params']]
+        index = HnswIndex(data['vectors'].shape[1], M, ef_construction)
+        index.vectors = np.array(data['vectors'], dtype=np.float32)
+        index.count = len(index.vectors)
+        index.entry, index.max_level = entry, max_level
+        if 'rng_keys' in data.files:
+            pos, has_gauss = [int(v) for v in data['rng_params']]
+            index.rng.set_state(('MT19937', data['rng_keys'], pos, has_gauss, float(data['rng_gaussian'][0])))
+        else:
+            # index saved without the state of the generator: seeded from the number of nodes instead of 0, so that
+            # the next levels are not the ones of the first nodes again
+            index.rng = np.random.RandomState(index.count)
+        counts, flat = data['counts'], data['links'].tolist()
+        offsets = np.r_[0, np.cumsum(counts)]
+        layer = 0
+        for level in data['levels']:
+            index.links.append([flat[offsets[layer + l]: offsets[layer + l + 1]] for l in range(level + 1)])
+            layer += level + 1
+        return index
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build an HNSW index of the gallery and compare it with the brute force')
+    parser.add_argument('--features_queries', type=str, required=True, help='Features of the queries (.npy)')
+    parser.add_argument('--features_dataset', type=str, required=True, help='Features of the gallery (.npy)')
+    parser.add_argument('--index', type=str, required=False, help='Path of the index (.npz), loaded if it exists')
+    parser.add_argument('--M', type=int, required=False, help='Number of links per node and layer (2 * M on layer 0)')
+    parser.add_argument('--ef_construction', type=int, required=False, help='Size of the search list when inserting')
+    parser.add_argument('--ef', type=str, required=False, help='Comma-separated sizes of the search list to compare')
+    parser.add_argument('--k', type=int, required=False, help='Number of results per query')
+    parser.add_argument('--dataset', type=str, required=False, help='Path to the Oxford / Paris directory, to report the mAP')
+    parser.add_argument('--eval_binary', type=str, required=False, help='Path to the compute_ap binary to evaluate Oxford / Paris')
+    parser.add_argument('--cover_dir', type=str, required=False, help='Path to the cover dataset, to report its mAP instead')
+    parser.add_argument('--temp_dir', type=str, required=False, help='Path to a temporary directory to store the scores')
+    parser.set_defaults(index=None, M=16, ef_construction=100, ef='16,32,64,128,256', k=10, dataset=None,
+                        cover_dir=None, temp_dir='tmp')
+    args = parser.parse_args()
+
+    features_queries = np.load(args.features_queries)
+    features_dataset = np.load(args.features_dataset, mmap_mode='r')
+    t = time.time()
+    if args.index is not None and os.path.exists(args.index):
+        index = HnswIndex.load(args.index)
+    else:
+        index = HnswIndex(features_dataset.shape[1], args.M, args.ef_construction).add(features_dataset)
+        if args.index is not None:
+            index.save(args.index)
+    print("Index of %d images ready in %.1f s" % (index.count, time.time() - t))
+    score_fn = None
+    if args.dataset is not None:
+        score_fn = index_eval.oxford_score_fn(args.dataset, args.eval_binary, args.temp_dir)
+    elif args.cover_dir is not None:
+        score_fn = index_eval.cover_score_fn(args.cover_dir)
+    index_eval.benchmark(lambda queries, ef: index.search(queries, args.k, ef),
+                         [int(v) for v in args.ef.split(',')], features_queries, features_dataset, args.k, score_fn)
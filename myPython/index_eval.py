@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# Python functions that compare an approximate search (an index of the gallery) with the exact brute-force search:
+# time per query, recall of the exact top k, and optionally the mAP of the retrieval (e.g. Oxford)
+# usage: score_fn = oxford_score_fn('datasets/Oxford', 'datasets/evaluation/compute_ap', 'tmp')  # or cover_score_fn
+#        benchmark(lambda queries, nprobe: index.search(queries, 100, nprobe), [1, 4, 16, 64],
+#                  features_queries, features_dataset, k=100, score_fn=score_fn)
+
+'''
+Note:
+    The recall is the mean fraction of the exact top k of a query that the index returns in its own top k. The mAP
+    is computed on the returned ids only (score_ids / cal_mAP_ids), the relevant images which are not returned
+    counting as not retrieved, and the brute force is scored on its own top k, so that the mAPs of the table compare
+    the searches at the same depth. A dense similarity matrix is scored through its full ranking (sim_to_ids).
+    The rows of the queries should be in the order of the dataset queries (dataset.q_names for Oxford, q_fname
+    for cover).
+'''
+
+import time
+import numpy as np
+import search_helper
+import rank_helper
+
+
+# mean fraction of ids_true[q] found in ids[q]
+def recall(ids, ids_true):
+    found = [len(np.intersect1d(a[a >= 0], b[b >= 0])) / float(max(1, np.count_nonzero(b >= 0)))
+             for a, b in zip(ids, ids_true)]
+    return float(np.mean(found))
+
+
+# full ranking of every query by dense similarities (queries x num_gallery), for a score_fn
+def sim_to_ids(sim):
+    return rank_helper.top_k(sim, sim.shape[1])
+
+
+# mAP of the ranked ids (-1 for no result) on the Oxford / Paris dataset (rank files written in temp_dir)
+def oxford_score_fn(dataset_path, eval_binary, temp_dir):
+    from oxford_helper import OxfordDataset
+    dataset = OxfordDataset(dataset_path)
+    return lambda ids: dataset.score_ids(ids, temp_dir, eval_binary)
+
+
+# mAP of the ranked ids (-1 for no result) on the cover dataset (cal_mAP_ids gives a percentage)
+def cover_score_fn(root_dir):
+    from cover_helper import CoverDataset
+    dataset = CoverDataset(root_dir)
+    dataset.get_queries_answer_list()
+    return lambda ids: dataset.cal_mAP_ids(ids) / 100.0
+
+
+# search_fn(queries, param) returns (ids, scores) of shape n x k for every param of params
+def benchmark(search_fn, params, queries, gallery, k, score_fn=None, mem_mb=256):
+    t = time.time()
+    ids_true, scores_true = search_helper.search(queries, gallery, k, mem_mb)
+    rows = [('brute force', (time.time() - t) / len(queries), 1.0,
+             score_fn(ids_true) if score_fn else None)]
+    for param in params:
+        t = time.time()
+        ids, scores = search_fn(queries, param)
+        t = (time.time() - t) / len(queries)
+        rows.append((param, t, recall(ids, ids_true),
+                     score_fn(ids) if score_fn else None))
+    print("{0:>12} {1:>12} {2:>10} {3:>8}".format('param', 'ms/query', 'recall@' + str(k), 'mAP'))
+    for param, t, r, m in rows:
+        print("{0:>12} {1:>12.3f} {2:>10.4f} {3:>8}".format(
+            str(param), 1000 * t, r, '{0:.2f}'.format(100 * m) if m is not None else '-'))
+    return rows
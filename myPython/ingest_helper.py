@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+# Python functions for the incremental mode of convert_image2features.py, which only converts the images that are
+# not in the existing features/index yet (or whose file changed) and appends them
+# usage: names, todo = find_new_images(features_npy, features_txt, img_dir, images, check_changed=True)
+#        ... extract the features of todo into increment_npy ...
+#        append_features(features_npy, features_txt, img_dir, names, todo, increment_npy)
+
+'''
+Note:
+    The index file ('image_name row' per line) tells which images are already converted. The size and mtime of
+    every converted image are kept next to the features in '<features_npy>.stat' (json), so that a changed file can
+    be noticed without reading it. New images get new rows at the end, in sorted order, and changed images are
+    converted again into their old rows, so the rows of the other images never move. The features file grows in
+    place: the shape in its .npy header is rewritten (in the padding of the header, which has room for more digits)
+    and only the new and changed rows are written, so a run costs the size of the increment, not of the collection.
+    The index and the stats are then written into temporary files renamed over the old ones. An interrupted run
+    leaves the features with more rows than the index (the extra rows are simply overwritten by the next run) and
+    the changed images without their new stats (they are converted again). The whole file is copied only if the
+    header has no room left (or the array is in Fortran order), and nothing is written without images to append.
+'''
+
+import os
+import json
+import numpy as np
+import shard_helper
+
+
+def stats_fname(features_npy):
+    return features_npy + '.stat'
+
+
+# [size, mtime] of an image file
+def image_stat(path):
+    st = os.stat(path)
+    return [st.st_size, int(st.st_mtime)]
+
+
+def read_stats(features_npy):
+    fname = stats_fname(features_npy)
+    return json.load(open(fname, 'r')) if os.path.exists(fname) else {}
+
+
+# record the size and mtime of the images (on top of the stats already recorded)
+def write_stats(features_npy, img_dir, images, stats=None):
+    stats = dict(stats) if stats is not None else {}
+    for name in images:
+        stats[name] = image_stat(os.path.join(img_dir, name))
+    tmp_fname = stats_fname(features_npy) + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(stats, f)
+    os.rename(tmp_fname, stats_fname(features_npy))
+
+
+# images already converted (in the order of the rows) and images to convert (new ones, and changed ones if asked)
+def find_new_images(features_npy, features_txt, img_dir, images, check_changed=False):
+    names = shard_helper.read_index(features_txt)
+    assert np.load(features_npy, mmap_mode='r').shape[0] >= len(names), '%s has less rows than %s' % (
+        features_npy, features_txt)
+    converted = set(names)
+    stats = read_stats(features_npy) if check_changed else {}
+    todo = []
+    for name in images:
+        if name not in converted:
+            todo.append(name)
+        elif check_changed and name in stats and stats[name] != image_stat(os.path.join(img_dir, name)):
+            # images converted before the stats were kept are taken as unchanged (and recorded by the append)
+            todo.append(name)
+    return names, todo
+
+
+# (byte offset of the data, version, shape, fortran_order, dtype) of a .npy file
+def npy_header(fname):
+    with open(fname, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        return f.tell(), version, shape, fortran_order, dtype
+
+
+# resize a 2-dim .npy file to num_rows rows in place (header rewritten in its own space), False if it does not fit
+def grow_npy(fname, num_rows):
+    offset, version, shape, fortran_order, dtype = npy_header(fname)
+    if fortran_order:
+        return False
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d, %d), }" % (
+        str(np.lib.format.dtype_to_descr(dtype)), num_rows, shape[1])
+    start = 10 if version == (1, 0) else 12  # magic string, version and length of the header
+    if len(header) + 1 > offset - start:
+        return False
+    with open(fname, 'r+b') as f:
+        f.truncate(offset + num_rows * shape[1] * dtype.itemsize)
+        f.seek(start)
+        f.write((header.ljust(offset - start - 1) + '\n').encode('latin1'))
+    return True
+
+
+# copy the first num_rows rows of a .npy file into a new one of new_rows rows, renamed over it
+def copy_npy(fname, num_rows, new_rows, chunk_size=10000):
+    old = np.load(fname, mmap_mode='r')
+    tmp_fname = fname + '.tmp.npy'
+    features = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=old.dtype, shape=(new_rows, old.shape[1]))
+    for start in range(0, num_rows, chunk_size):
+        end = min(start + chunk_size, num_rows)
+        features[start: end] = old[start: end]
+    features.flush()
+    del features, old
+    os.rename(tmp_fname, fname)
+
+
+# write the features of todo (rows of increment_npy) into features_npy, and update the index and the stats
+def append_features(features_npy, features_txt, img_dir, names, todo, increment_npy, chunk_size=10000):
+    rows = dict((name, idx) for idx, name in enumerate(names))
+    names_new = names + [name for name in todo if name not in rows]
+    for name in names_new[len(names):]:
+        rows[name] = len(rows)
+    if todo:
+        if not grow_npy(features_npy, len(names_new)):
+            copy_npy(features_npy, len(names), len(names_new), chunk_size)
+        increment = np.load(increment_npy, mmap_mode='r')
+        features = np.load(features_npy, mmap_mode='r+')
+        for start in range(0, len(todo), chunk_size):
+            features[[rows[name] for name in todo[start: start + chunk_size]]] = increment[start: start + chunk_size]
+        features.flush()
+        del features
+        shard_helper.write_index(features_txt, names_new)
+    stats = read_stats(features_npy)
+    todo_set = set(todo)
+    write_stats(features_npy, img_dir, [name for name in names_new if name in todo_set or (
+        name not in stats and os.path.exists(os.path.join(img_dir, name)))], stats)
+    return len(names_new)
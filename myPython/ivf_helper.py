@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+# Python class of an inverted-file (IVF) index of the gallery descriptors: the descriptors are grouped in the lists
+# of their nearest k-means centroid and a query only scores the images of its nprobe nearest lists
+# usage: features = np.load('features.npy', mmap_mode='r')
+#        index = IvfIndex.train(features, nlist=1024)
+#        index.build(features)
+#        ids, scores = index.search(features_queries, k=100, nprobe=16)
+#        index.save('features.ivf.npz')  # and IvfIndex.load('features.ivf.npz', features)
+
+'''
+Note:
+    The descriptors are L2-normalized, so the k-means assigns a descriptor to the centroid of largest dot product
+    and the centroids are normalized after every step (spherical k-means; spherical=False gives the usual k-means
+    on the euclidean distance, as needed by the sub-vectors of pq_helper). The training is a mini-batch k-means
+    in numpy: each step draws batch_size random rows of the features (read from the disk if memory-mapped) and
+    moves every centroid towards the mean of its rows with a step of (its rows in the batch) / (its rows so far).
+    The index only keeps the centroids and the lists (gallery rows sorted by list, with the offsets of every list),
+    the scores are computed exactly from the gallery descriptors of the probed lists, so a larger nprobe only
+    trades speed for recall. Run this script to compare recall and mAP with the brute force for several nprobe.
+'''
+
+import os
+import time
+import argparse
+import numpy as np
+import rank_helper
+import index_eval
+
+
+def normalize(X):
+    return X / np.maximum(np.sqrt((X * X).sum(axis=1)), 1e-12)[:, None]
+
+
+# nearest centroid of every row of X (largest dot product, or smallest euclidean distance if not spherical)
+def nearest(X, centroids, spherical=True):
+    if spherical:
+        return np.argmax(X.dot(centroids.T), axis=1)
+    return np.argmax(X.dot(centroids.T) - 0.5 * (centroids * centroids).sum(axis=1)[None, :], axis=1)
+
+
+# nearest centroid of every row of features, by blocks of rows
+def assign(features, centroids, block_rows=100000, spherical=True):
+    labels = np.zeros(features.shape[0], dtype=np.int64)
+    for start in range(0, features.shape[0], block_rows):
+        X = np.asarray(features[start: start + block_rows], dtype=np.float32)
+        labels[start: start + block_rows] = nearest(X, centroids, spherical)
+    return labels
+
+
+def train_kmeans(features, nlist, iters=50, batch_size=10000, seed=0, spherical=True):
+    N = features.shape[0]
+    assert N >= nlist, 'less features than centroids'
+    rng = np.random.RandomState(seed)
+    centroids = np.asarray(features[np.sort(rng.choice(N, nlist, replace=False))], dtype=np.float32)
+    centroids = normalize(centroids) if spherical else centroids.copy()
+    counts = np.zeros(nlist, dtype=np.float64)
+    for _ in range(iters):
+        X = np.asarray(features[np.unique(rng.randint(0, N, batch_size))], dtype=np.float32)
+        labels = nearest(X, centroids, spherical)
+        # sum of the rows of every centroid in the batch
+        order = np.argsort(labels, kind='mergesort')
+        labels = labels[order]
+        starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+        hit = labels[starts]
+        sums = np.add.reduceat(X[order], starts, axis=0)
+        num = np.diff(np.r_[starts, len(labels)]).astype(np.float64)
+        counts[hit] += num
+        eta = (num / counts[hit]).astype(np.float32)[:, None]
+        centroids[hit] = (1 - eta) * centroids[hit] + eta * sums / num.astype(np.float32)[:, None]
+        if spherical:
+            centroids[hit] = normalize(centroids[hit])
+    return centroids
+
+
+class IvfIndex:
+    def __init__(self, centroids):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)  # gallery rows sorted by list
+        self.offsets = np.zeros(len(self.centroids) + 1, dtype=np.int64)  # list c is ids[offsets[c]: offsets[c + 1]]
+        self.features = None
+
+    @staticmethod
+    def train(features, nlist, iters=50, batch_size=10000, seed=0):
+        return IvfIndex(train_kmeans(features, nlist, iters, batch_size, seed))
+
+    # put every row of features (the gallery) into the list of its nearest centroid
+    def build(self, features):
+        labels = assign(features, self.centroids)
+        self.ids = np.argsort(labels, kind='mergesort').astype(np.int64)  # rows stay in order inside a list
+        self.offsets = np.r_[0, np.cumsum(np.bincount(labels, minlength=len(self.centroids)))].astype(np.int64)
+        self.features = features
+        return self
+
+    # ids and exact scores of the k best images of the nprobe nearest lists of every query (-1 / -inf if less)
+    def search(self, queries, k, nprobe=8):
+        queries = np.asarray(queries, dtype=np.float32)
+        probes = rank_helper.top_k(queries.dot(self.centroids.T), nprobe)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q in range(len(queries)):
+            cand = np.sort(np.concatenate([self.ids[self.offsets[c]: self.offsets[c + 1]] for c in probes[q]]))
+            if len(cand) == 0:
+                continue
+            s = np.asarray(self.features[cand], dtype=np.float32).dot(queries[q])
+            top = rank_helper.top_k(s[None, :], k)[0]
+            ids[q, :len(top)] = cand[top]
+            scores[q, :len(top)] = s[top]
+        return ids, scores
+
+    def save(self, fname):
+        np.savez(fname, centroids=self.centroids, ids=self.ids, offsets=self.offsets)
+
+    # the index of fname, scoring with the gallery descriptors features (the ones it was built from)
+    @staticmethod
+    def load(fname, features):
+        data = np.load(fname)
+        index = IvfIndex(data['centroids'])
+        index.ids = data['ids']
+        index.offsets = data['offsets']
+        assert index.offsets[-1] == features.shape[0], 'the index was built from another gallery'
+        index.features = features
+        return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build an IVF index of the gallery and compare it with the brute force')
+    parser.add_argument('--features_queries', type=str, required=True, help='Features of the queries (.npy)')
+    parser.add_argument('--features_dataset', type=str, required=True, help='Features of the gallery (.npy, memory-mapped)')
+    parser.add_argument('--index', type=str, required=False, help='Path of the index (.npz), loaded if it exists')
+    parser.add_argument('--nlist', type=int, required=False, help='Number of lists (k-means centroids)')
+    parser.add_argument('--nprobe', type=str, required=False, help='Comma-separated numbers of probed lists to compare')
+    parser.add_argument('--k', type=int, required=False, help='Number of results per query')
+    parser.add_argument('--dataset', type=str, required=False, help='Path to the Oxford / Paris directory, to report the mAP')
+    parser.add_argument('--eval_binary', type=str, required=False, help='Path to the compute_ap binary to evaluate Oxford / Paris')
+    parser.add_argument('--cover_dir', type=str, required=False, help='Path to the cover dataset, to report its mAP instead')
+    parser.add_argument('--temp_dir', type=str, required=False, help='Path to a temporary directory to store the scores')
+    parser.set_defaults(index=None, nlist=1024, nprobe='1,2,4,8,16,32,64', k=100, dataset=None, cover_dir=None,
+                        temp_dir='tmp')
+    args = parser.parse_args()
+
+    features_queries = np.load(args.features_queries)
+    features_dataset = np.load(args.features_dataset, mmap_mode='r')
+    t = time.time()
+    if args.index is not None and os.path.exists(args.index):
+        index = IvfIndex.load(args.index, features_dataset)
+    else:
+        index = IvfIndex.train(features_dataset, args.nlist).build(features_dataset)
+        if args.index is not None:
+            index.save(args.index)
+    print("Index of %d lists ready in %.1f s" % (len(index.centroids), time.time() - t))
+    score_fn = None
+    if args.dataset is not None:
+        score_fn = index_eval.oxford_score_fn(args.dataset, args.eval_binary, args.temp_dir)
+    elif args.cover_dir is not None:
+        score_fn = index_eval.cover_score_fn(args.cover_dir)
+    index_eval.benchmark(lambda queries, nprobe: index.search(queries, args.k, nprobe),
+                         [int(v) for v in args.nprobe.split(',')], features_queries, features_dataset, args.k, score_fn)
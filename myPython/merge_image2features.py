@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+# Python script that merges the shards written by convert_image2features(_multires).py --shard i/n into a single
+# 'features.npy' and .txt index, with the same rows as a run over all the images
+
+'''
+usage:
+python ./myPython/merge_image2features.py \
+    --features_npy ~/data/cover/training/features.npy \
+    --features_txt ~/data/cover/training/training.txt \
+    --num_shards 8
+'''
+
+import argparse
+import shard_helper
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the shards of the features')
+    parser.add_argument('--features_npy', type=str, required=True,
+                        help='Path of the features given to the shards (the merged features are saved there)')
+    parser.add_argument('--features_txt', type=str, required=True,
+                        help='Path of the index given to the shards (the merged index is saved there)')
+    parser.add_argument('--num_shards', type=int, required=True, help='Number of shards (n of --shard i/n)')
+    args = parser.parse_args()
+
+    features_npy = args.features_npy if args.features_npy.endswith('.npy') else args.features_npy + '.npy'
+    num = shard_helper.merge_shards(features_npy, args.features_txt, args.num_shards)
+    print("Merged %d shard(s) of %d image(s) into %s and %s" % (args.num_shards, num, features_npy, args.features_txt))
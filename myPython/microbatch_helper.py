@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# Python class that groups the images sent one at a time by concurrent callers (e.g. the threads of
+# retrieval_server.py) into batched forward passes, and returns every caller its own descriptor
+# usage: batcher = MicroBatcher(lambda images, regions: batch_helper.forward_batch(net, images, regions),
+#                               max_batch=16, max_delay_ms=5)
+#        d = batcher.submit(I, R)  # from any thread, blocks until the batch of I went through the network
+#        batcher.stats()  # histograms of the batch sizes and of the queueing delays
+
+'''
+Note:
+    A single thread owns the network. It waits for a first request, then collects the next ones until max_batch
+    requests are queued or max_delay_ms has passed since the first one arrived, so a lone request waits at most
+    max_delay_ms and a busy server runs full batches. The images of a batch with the same shape go through one
+    forward pass, their rois packed with the batch index of every image (batch_helper.pack_regions, the batched
+    form of pack_regions_for_network). An error of the network is raised in the threads of its requests. stats()
+    counts the forward passes by batch size and the requests by queueing delay (time from the arrival to the
+    start of the forward pass).
+'''
+
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+DELAY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500]  # upper bounds of the buckets of the delay histogram
+
+
+class _Request:
+    def __init__(self, I, R):
+        self.I = I
+        self.R = R
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+
+class MicroBatcher:
+    def __init__(self, forward, max_batch=16, max_delay_ms=5.):
+        self.forward = forward  # forward(images, regions) returns one row per image
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000.
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batch_sizes = np.zeros(max_batch + 1, dtype=np.int64)  # number of forward passes of every size
+        self.delays = np.zeros(len(DELAY_BUCKETS_MS) + 1, dtype=np.int64)  # number of requests per delay bucket
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # descriptor of the image I with rois R (as returned by prepare_image_and_grid_regions_for_network)
+    def submit(self, I, R):
+        request = _Request(I, R)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.output
+
+    # first request, then the next ones until max_batch or the deadline of the first one
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = batch[0].arrival + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            start = time.time()
+            groups = OrderedDict()
+            for request in batch:
+                groups.setdefault(request.I.shape, []).append(request)
+            for requests in groups.values():
+                try:
+                    outputs = self.forward([r.I for r in requests], [r.R for r in requests])
+                    for request, output in zip(requests, outputs):
+                        request.output = output
+                except Exception as e:
+                    for request in requests:
+                        request.error = e
+            with self.lock:
+                for requests in groups.values():
+                    self.batch_sizes[len(requests)] += 1
+                for request in batch:
+                    self.delays[np.searchsorted(DELAY_BUCKETS_MS, 1000 * (start - request.arrival), side='right')] += 1
+            for request in batch:
+                request.done.set()
+
+    def stats(self):
+        with self.lock:
+            labels = ['<%gms' % b for b in DELAY_BUCKETS_MS] + ['>=%gms' % DELAY_BUCKETS_MS[-1]]
+            return {'requests': int(self.delays.sum()), 'forward_passes': int(self.batch_sizes.sum()),
+                    'batch_size': OrderedDict((str(s), int(n)) for s, n in enumerate(self.batch_sizes) if n > 0),
+                    'queue_delay': OrderedDict((l, int(n)) for l, n in zip(labels, self.delays))}
@@ -14,6 +14,7 @@ import argparse
 from tqdm import tqdm
 sys.path.append('/home/processyuan/NetworkOptimization/deep-retrieval/myPython')
 from oxford_helper import *
+from extraction_engine import ExtractionEngine, MapWriter
 from sklearn.decomposition import PCA
 from sklearn import preprocessing
 
@@ -96,59 +97,36 @@ if __name__ == '__main__':
         scaler.append(scaler_temp)
         pca.append(pca_temp)
 
+    # PCA-whiten the pooled rois of an image for the k-th branch, then sum up and normalize
+    def pca_rmac(k):
+        def fn(pooled_rois):
+            features_branch_pca = pca[k].transform(scaler[k].transform(pooled_rois))
+            features_branch_pca_norm = features_branch_pca / np.expand_dims(
+                eps + np.sqrt((features_branch_pca ** 2).sum(axis=1)), axis=1)
+            features_branch_rmac = features_branch_pca_norm.sum(axis=0).reshape(1, -1)
+            features_branch_rmac_norm = features_branch_rmac / np.sqrt((features_branch_rmac ** 2).sum(axis=1))[:, None]
+            return features_branch_rmac_norm * dim_branch[k]
+        return fn
+
+    # the master and the pooled rois of all the branches are read from the same forward pass
+    engine = ExtractionEngine(net, [master] + branch, per_roi=branch)
+    scale_master = lambda output: output * dim_master
+
     # First part, queries
-    for i in tqdm(range(N_queries), file=sys.stdout, leave=False, dynamic_ncols=True):
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_query_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward(end=master)
-
-        features_master_queries[i] = np.squeeze(net.blobs[master].data) * dim_master
-        pooled_rois_queries_temp = [np.squeeze(net.blobs[branch[k]].data) for k in range(num_branch)]
-        pooled_rois_queries_scale = [scaler[k].transform(pooled_rois_queries_temp[k]) for k in range(num_branch)]
-        features_branch_queries_pca = [pca[k].transform(pooled_rois_queries_scale[k]) for k in range(num_branch)]
-        features_branch_queries_pca_norm = [features_branch_queries_pca[k] / np.expand_dims(
-            eps + np.sqrt((features_branch_queries_pca[k] ** 2).sum(axis=1)), axis=1)
-                                            for k in range(num_branch)]
-        features_branch_queries_rmac = [features_branch_queries_pca_norm[k].sum(axis=0).reshape(1, -1)
-                                        for k in range(num_branch)]
-
-        features_branch_queries_rmac_norm = [features_branch_queries_rmac[k] /
-                                            np.sqrt((features_branch_queries_rmac[k] ** 2).sum(axis=1))[:, None]
-                                             for k in range(num_branch)]
-        for k in range(num_branch):
-            (features_queries_list[k])[i] = features_branch_queries_rmac_norm[k] * dim_branch[k]
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_query_filename(i) for i in range(N_queries)],
+               [MapWriter(features_master_queries, scale_master)] +
+               [MapWriter(features_queries_list[k], pca_rmac(k)) for k in range(num_branch)])
 
     features_queries_list.append(features_master_queries)
     features_queries = np.hstack((features_queries_list[k] for k in range(num_branch + 1)))
     features_queries /= np.sqrt((features_queries * features_queries).sum(axis=1))[:, None]
 
     # Second part, dataset
-    for i in tqdm(range(N_dataset), file=sys.stdout, leave=False, dynamic_ncols=True):
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward(end=master)
-
-        features_master_dataset[i] = np.squeeze(net.blobs[master].data) * dim_master
-        pooled_rois_dataset_temp = [np.squeeze(net.blobs[branch[k]].data) for k in range(num_branch)]
-        pooled_rois_dataset_scale = [scaler[k].transform(pooled_rois_dataset_temp[k]) for k in range(num_branch)]
-        features_branch_dataset_pca = [pca[k].transform(pooled_rois_dataset_scale[k]) for k in range(num_branch)]
-        features_branch_dataset_pca_norm = [features_branch_dataset_pca[k] / np.expand_dims(
-            eps + np.sqrt((features_branch_dataset_pca[k] ** 2).sum(axis=1)), axis=1)
-                                            for k in range(num_branch)]
-        features_branch_dataset_rmac = [features_branch_dataset_pca_norm[k].sum(axis=0).reshape(1, -1)
-                                        for k in range(num_branch)]
-
-        features_branch_dataset_rmac_norm = [features_branch_dataset_rmac[k] /
-                                             np.sqrt((features_branch_dataset_rmac[k] ** 2).sum(axis=1))[:, None]
-                                             for k in range(num_branch)]
-        for k in range(num_branch):
-            (features_dataset_list[k])[i] = features_branch_dataset_rmac_norm[k] * dim_branch[k]
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_filename(i) for i in range(N_dataset)],
+               [MapWriter(features_master_dataset, scale_master)] +
+               [MapWriter(features_dataset_list[k], pca_rmac(k)) for k in range(num_branch)])
 
     features_dataset_list.append(features_master_dataset)
     features_dataset = np.hstack((features_dataset_list[k] for k in range(num_branch + 1)))
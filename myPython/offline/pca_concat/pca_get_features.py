@@ -13,6 +13,7 @@ from tqdm import tqdm
 import sys
 sys.path.append('/home/processyuan/NetworkOptimization/deep-retrieval/myPython')
 from oxford_helper import *
+from extraction_engine import ExtractionEngine, RoiWriter
 
 if __name__ == '__main__':
 
@@ -58,48 +59,26 @@ if __name__ == '__main__':
 
     N_queries = oxford_dataset.N_queries
     N_dataset = oxford_dataset.N_images
-    pooled_rois_queries_list = []
-    pooled_rois_dataset_list = []
-    for k in range(num_branch):
-        pooled_rois_queries_list.append([])
-        pooled_rois_dataset_list.append([])
+    # all the branches are read from the same forward pass, with one row per roi
+    engine = ExtractionEngine(net, branch, per_roi=branch)
 
     # queries: get ROI-pooling features
-    for i in tqdm(range(N_queries), file=sys.stdout, leave=False, dynamic_ncols=True):
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_query_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward(end=branch[0])
-
-        for k in range(num_branch):
-            pooled_rois_queries_temp = np.squeeze(net.blobs[branch[k]].data)
-            for l in range(pooled_rois_queries_temp.shape[0]):
-                (pooled_rois_queries_list[k]).append(pooled_rois_queries_temp[l, :])
+    pooled_rois_queries_list = [RoiWriter() for k in range(num_branch)]
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_query_filename(i) for i in range(N_queries)], pooled_rois_queries_list)
 
-    pooled_rois_queries = [np.array(pooled_rois_queries_list[k]) for k in range(num_branch)]
+    pooled_rois_queries = [pooled_rois_queries_list[k].result() for k in range(num_branch)]
     pooled_rois_queries_fname = ["{0}{1}_S{2}_L{3}_ROIpooling_branch{4}_queries.npy".
                                      format(args.features_dir, args.dataset_name, S, L, k) for k in range(num_branch)]
     for k in range(num_branch):
         np.save(pooled_rois_queries_fname[k], pooled_rois_queries[k])
 
     # dataset: get ROI-pooling features
-    for i in tqdm(range(N_dataset), file=sys.stdout, leave=False, dynamic_ncols=True):
-        # Load image, process image, get image regions, feed into the network, get descriptor, and store
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward(end=branch[0])
-
-        for k in range(num_branch):
-            pooled_rois_dataset_temp = np.squeeze(net.blobs[branch[k]].data)
-            for l in range(pooled_rois_dataset_temp.shape[0]):
-                (pooled_rois_dataset_list[k]).append(pooled_rois_dataset_temp[l, :])
+    pooled_rois_dataset_list = [RoiWriter() for k in range(num_branch)]
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_filename(i) for i in range(N_dataset)], pooled_rois_dataset_list)
 
-    pooled_rois_dataset = [np.array(pooled_rois_dataset_list[k]) for k in range(num_branch)]
+    pooled_rois_dataset = [pooled_rois_dataset_list[k].result() for k in range(num_branch)]
     pooled_rois_dataset_fname = ["{0}{1}_S{2}_L{3}_ROIpooling_branch{4}_dataset.npy".
                                      format(args.features_dir, args.dataset_name, S, L, k) for k in range(num_branch)]
     for k in range(num_branch):
@@ -11,6 +11,7 @@ import argparse
 from tqdm import tqdm
 sys.path.append('/home/processyuan/code/NetworkOptimization/deep-retrieval/myPython')
 from oxford_helper import *
+from extraction_engine import ExtractionEngine, MapWriter, RoiWriter
 
 if __name__ == '__main__':
 
@@ -56,50 +57,31 @@ if __name__ == '__main__':
 
     N_queries = oxford_dataset.N_queries
     N_dataset = oxford_dataset.N_images
-    pooled_rois_queries_list = []
-    pooled_rois_dataset_list = []
     dim_branch = [net.blobs[branch[k]].data.shape[1] for k in range(num_branch)]
     dim_features = np.sum(dim_branch)
-    for k in range(num_branch):
-        pooled_rois_queries_list.append([])
-        pooled_rois_dataset_list.append([])
+    # all the branches are read from the same forward pass, with one row per roi
+    engine = ExtractionEngine(net, branch, per_roi=branch)
+    scale_by = lambda dim: (lambda output: output * dim)
 
     # queries: get ROI-pooling features
-    for i in tqdm(range(N_queries), file=sys.stdout, leave=False, dynamic_ncols=True):
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_query_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward(end=master)
+    pooled_rois_queries_list = [RoiWriter() for k in range(num_branch)]
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_query_filename(i) for i in range(N_queries)],
+               [MapWriter(pooled_rois_queries_list[k], scale_by(dim_branch[k])) for k in range(num_branch)])
 
-        for k in range(num_branch):
-            pooled_rois_queries_temp = np.squeeze(net.blobs[branch[k]].data) * dim_branch[k]
-            for l in range(pooled_rois_queries_temp.shape[0]):
-                (pooled_rois_queries_list[k]).append(pooled_rois_queries_temp[l, :])
-
-    pooled_rois_queries_temp = [np.array(pooled_rois_queries_list[k]) for k in range(num_branch)]
+    pooled_rois_queries_temp = [pooled_rois_queries_list[k].result() for k in range(num_branch)]
     pooled_rois_queries = np.hstack((pooled_rois_queries_temp[k] for k in range(num_branch)))
     pooled_rois_queries_fname = "{0}{1}_S{2}_L{3}_ROIpooling_queries.npy"\
         .format(args.features_dir, args.dataset_name, S, L)
     np.save(pooled_rois_queries_fname, pooled_rois_queries)
 
     # dataset: get ROI-pooling features
-    for i in tqdm(range(N_dataset), file=sys.stdout, leave=False, dynamic_ncols=True):
-        # Load image, process image, get image regions, feed into the network, get descriptor, and store
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward(end=master)
-
-        for k in range(num_branch):
-            pooled_rois_dataset_temp = np.squeeze(net.blobs[branch[k]].data) * dim_branch[k]
-            for l in range(pooled_rois_dataset_temp.shape[0]):
-                (pooled_rois_dataset_list[k]).append(pooled_rois_dataset_temp[l, :])
+    pooled_rois_dataset_list = [RoiWriter() for k in range(num_branch)]
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_filename(i) for i in range(N_dataset)],
+               [MapWriter(pooled_rois_dataset_list[k], scale_by(dim_branch[k])) for k in range(num_branch)])
 
-    pooled_rois_dataset_temp = [np.array(pooled_rois_dataset_list[k]) for k in range(num_branch)]
+    pooled_rois_dataset_temp = [pooled_rois_dataset_list[k].result() for k in range(num_branch)]
     pooled_rois_dataset = np.hstack((pooled_rois_dataset_temp[k] for k in range(num_branch)))
     pooled_rois_dataset_fname = "{0}{1}_S{2}_L{3}_ROIpooling_dataset.npy" \
         .format(args.features_dir, args.dataset_name, S, L)
@@ -14,6 +14,7 @@ from tqdm import tqdm
 import sys
 sys.path.append('/home/processyuan/code/NetworkOptimization/deep-retrieval/myPython')
 from oxford_helper import *
+from extraction_engine import ExtractionEngine, RoiWriter
 from sklearn.decomposition import PCA
 from sklearn import preprocessing
 
@@ -101,51 +102,36 @@ if __name__ == '__main__':
     np.save("{0}concat_PCA_mean.npy".format(args.features_dir), pca.mean_)
     np.save("{0}concat_PCA_variance.npy".format(args.features_dir), pca.explained_variance_)
 
+    # PCA-whiten the pooled rois of an image (all the branches concatenated), then sum up and normalize
+    def pca_rmac(pooled_rois):
+        pooled_rois_pca = pca.transform(scaler.transform(pooled_rois))
+        features_branch_pca_norm = pooled_rois_pca / np.expand_dims(
+            eps + np.sqrt((pooled_rois_pca ** 2).sum(axis=1)), axis=1)
+        features_branch_rmac = features_branch_pca_norm.sum(axis=0).reshape(1, -1)
+        return features_branch_rmac / (eps + np.sqrt((features_branch_rmac ** 2).sum(axis=1))[:, None])
+
+    # the master and the pooled rois of all the branches are read from the same forward pass
+    engine = ExtractionEngine(net, [master] + branch, per_roi=branch)
+
     # First part, queries
-    for i in tqdm(range(N_queries), file=sys.stdout, leave=False, dynamic_ncols=True):
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_query_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward(end=master)
-
-        features_master_queries[i] = np.squeeze(net.blobs[master].data)
-        pooled_rois_queries_list = [np.squeeze(net.blobs[branch[k]].data) for k in range(num_branch)]
-        pooled_rois_queries = np.hstack((pooled_rois_queries_list[k] for k in range(num_branch)))
-        pooled_rois_queries_scaler = scaler.transform(pooled_rois_queries)
-        pooled_rois_queries_pca = pca.transform(pooled_rois_queries_scaler)
-        features_branch_queries_pca_norm = pooled_rois_queries_pca / np.expand_dims(
-            eps + np.sqrt((pooled_rois_queries_pca ** 2).sum(axis=1)), axis=1)
-        features_branch_queries_rmac = features_branch_queries_pca_norm.sum(axis=0).reshape(1, -1)
-        features_branch_queries_rmac_norm = features_branch_queries_rmac / \
-                                            (eps + np.sqrt((features_branch_queries_rmac ** 2).sum(axis=1))[:, None])
-        features_branch_queries[i] = features_branch_queries_rmac_norm
+    pooled_rois_queries_list = [RoiWriter() for k in range(num_branch)]
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_query_filename(i) for i in range(N_queries)],
+               [features_master_queries] + pooled_rois_queries_list)
+    for i in range(N_queries):
+        features_branch_queries[i] = pca_rmac(np.hstack([pooled_rois_queries_list[k][i] for k in range(num_branch)]))
 
     features_queries = np.dstack((features_master_queries, features_branch_queries)).sum(axis=2)
     # features_queries = features_branch_queries
     features_queries /= np.sqrt((features_queries ** 2).sum(axis=1))[:, None]
 
     # Second part, dataset
-    for i in tqdm(range(N_dataset), file=sys.stdout, leave=False, dynamic_ncols=True):
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward(end=master)
-
-        features_master_dataset[i] = np.squeeze(net.blobs[master].data)
-        pooled_rois_dataset_list = [np.squeeze(net.blobs[branch[k]].data) for k in range(num_branch)]
-        pooled_rois_dataset = np.hstack((pooled_rois_dataset_list[k] for k in range(num_branch)))
-        pooled_rois_dataset_scaler = scaler.transform(pooled_rois_dataset)
-        pooled_rois_dataset_pca = pca.transform(pooled_rois_dataset_scaler)
-        features_branch_dataset_pca_norm = pooled_rois_dataset_pca / np.expand_dims(
-            eps + np.sqrt((pooled_rois_dataset_pca ** 2).sum(axis=1)), axis=1)
-        features_branch_dataset_rmac = features_branch_dataset_pca_norm.sum(axis=0).reshape(1, -1)
-        features_branch_dataset_rmac_norm = features_branch_dataset_rmac / \
-                                            (eps + np.sqrt((features_branch_dataset_rmac ** 2).sum(axis=1))[:, None])
-        features_branch_dataset[i] = features_branch_dataset_rmac_norm
+    pooled_rois_dataset_list = [RoiWriter() for k in range(num_branch)]
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_filename(i) for i in range(N_dataset)],
+               [features_master_dataset] + pooled_rois_dataset_list)
+    for i in range(N_dataset):
+        features_branch_dataset[i] = pca_rmac(np.hstack([pooled_rois_dataset_list[k][i] for k in range(num_branch)]))
 
     features_dataset = np.dstack((features_master_dataset, features_branch_dataset)).sum(axis=2)
     # features_dataset = features_branch_dataset
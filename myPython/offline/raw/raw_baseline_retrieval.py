@@ -15,6 +15,7 @@ import caffe
 import argparse
 from tqdm import tqdm
 from oxford_helper import *
+from extraction_engine import ExtractionEngine, MapWriter
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Evaluate Oxford')
@@ -61,36 +62,22 @@ if __name__ == '__main__':
     features_master_queries = np.zeros((N_queries, dim_master), dtype=np.float32)
     features_master_dataset = np.zeros((N_dataset, dim_master), dtype=np.float32)
 
+    # sum up the pooled rois of an image and normalize
+    def rmac(pooled_rois):
+        features_master_rmac = pooled_rois.sum(axis=0).reshape(-1, dim_master)
+        return features_master_rmac / np.expand_dims(eps + np.sqrt((features_master_rmac ** 2).sum(axis=1)), axis=1)
+
+    engine = ExtractionEngine(net, ['pooled_rois/normalized_flat'], per_roi=['pooled_rois/normalized_flat'])
+
     # queries: get ROI-pooling features
-    for i in tqdm(range(N_queries), file=sys.stdout, leave=False, dynamic_ncols=True):
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_query_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward()
-
-        pooled_rois_master_queries = np.squeeze(net.blobs['pooled_rois/normalized_flat'].data)
-        features_master_rmac = pooled_rois_master_queries.sum(axis=0).reshape(-1, dim_master)
-        features_master_rmac_norm = features_master_rmac / np.expand_dims(
-            eps + np.sqrt((features_master_rmac ** 2).sum(axis=1)), axis=1)
-        features_master_queries[i] = features_master_rmac_norm
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_query_filename(i) for i in range(N_queries)],
+               [MapWriter(features_master_queries, rmac)])
 
     # dataset: get ROI-pooling features
-    for i in tqdm(range(N_dataset), file=sys.stdout, leave=False, dynamic_ncols=True):
-        # Load image, process image, get image regions, feed into the network, get descriptor, and store
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward()
-
-        pooled_rois_master_dataset = np.squeeze(net.blobs['pooled_rois/normalized_flat'].data)
-        features_master_rmac = pooled_rois_master_dataset.sum(axis=0).reshape(-1, dim_master)
-        features_master_rmac_norm = features_master_rmac / np.expand_dims(
-            eps + np.sqrt((features_master_rmac ** 2).sum(axis=1)), axis=1)
-        features_master_dataset[i] = features_master_rmac_norm
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_filename(i) for i in range(N_dataset)],
+               [MapWriter(features_master_dataset, rmac)])
 
     # Compute similarity
     sim = features_master_queries.dot(features_master_dataset.T)
@@ -11,6 +11,7 @@ import caffe
 import argparse
 from tqdm import tqdm
 from oxford_helper import *
+from extraction_engine import ExtractionEngine, MapWriter
 
 if __name__ == '__main__':
 
@@ -65,29 +66,18 @@ if __name__ == '__main__':
     features_queries_list = [np.zeros((N_queries, dim_layers[k]), dtype=np.float32) for k in range(num_layers)]
     features_dataset_list = [np.zeros((N_dataset, dim_layers[k]), dtype=np.float32) for k in range(num_layers)]
 
+    # all the layers are read from the same forward pass
+    engine = ExtractionEngine(net, layers)
+    scale_by = lambda dim: (lambda output: output * dim)
+
     # queries: get ROI-pooling features
-    for i in tqdm(range(N_queries), file=sys.stdout, leave=False, dynamic_ncols=True):
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_query_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward()
-        for k in range(num_layers):
-            (features_queries_list[k])[i] = np.squeeze(net.blobs[layers[k]].data)
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_query_filename(i) for i in range(N_queries)], features_queries_list)
 
     # dataset: get ROI-pooling features
-    for i in tqdm(range(N_dataset), file=sys.stdout, leave=False, dynamic_ncols=True):
-        # Load image, process image, get image regions, feed into the network, get descriptor, and store
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_filename(i))
-
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward()
-        for k in range(num_layers):
-            (features_dataset_list[k])[i] = np.squeeze(net.blobs[layers[k]].data) * dim_layers[k]
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_filename(i) for i in range(N_dataset)],
+               [MapWriter(features_dataset_list[k], scale_by(dim_layers[k])) for k in range(num_layers)])
 
     # Save the ROI-pooled features from middle layers
     pooled_rois_queries_fname = ["{0}{1}_S{2}_L{3}_layer{4}_ROIpooling_queries.npy".
@@ -13,6 +13,7 @@ from tqdm import tqdm
 import sys
 sys.path.append('/home/processyuan/NetworkOptimization/deep-retrieval/myPython')
 from oxford_helper import *
+from extraction_engine import ExtractionEngine, MapWriter
 
 if __name__ == '__main__':
 
@@ -71,34 +72,25 @@ if __name__ == '__main__':
     features_queries_list = [np.zeros((N_queries, dim_branch[k]), dtype=np.float32) for k in range(num_branch)]
     features_dataset_list = [np.zeros((N_dataset, dim_branch[k]), dtype=np.float32) for k in range(num_branch)]
 
+    # the master and all the branches are read from the same forward pass
+    engine = ExtractionEngine(net, [master] + branch)
+    scale_by = lambda dim: (lambda output: output * dim)
+
     # queries: get ROI-pooling features
-    for i in tqdm(range(N_queries), file=sys.stdout, leave=False, dynamic_ncols=True):
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_query_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward(end=master)
-        features_queries_master[i] = np.squeeze(net.blobs[master].data) * dim_master
-        for k in range(num_branch):
-            (features_queries_list[k])[i] = np.squeeze(net.blobs[branch[k]].data) * dim_branch[k]
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_query_filename(i) for i in range(N_queries)],
+               [MapWriter(features_queries_master, scale_by(dim_master))] +
+               [MapWriter(features_queries_list[k], scale_by(dim_branch[k])) for k in range(num_branch)])
 
     features_queries_list.append(features_queries_master)
     features_queries = np.hstack((features_queries_list[k] for k in range(num_branch + 1)))
     features_queries /= np.sqrt((features_queries * features_queries).sum(axis=1))[:, None]
 
     # dataset: get ROI-pooling features
-    for i in tqdm(range(N_dataset), file=sys.stdout, leave=False, dynamic_ncols=True):
-        # Load image, process image, get image regions, feed into the network, get descriptor, and store
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward(end=master)
-        features_dataset_master[i] = np.squeeze(net.blobs[master].data) * dim_master
-        for k in range(num_branch):
-            (features_dataset_list[k])[i] = np.squeeze(net.blobs[branch[k]].data) * dim_branch[k]
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_filename(i) for i in range(N_dataset)],
+               [MapWriter(features_dataset_master, scale_by(dim_master))] +
+               [MapWriter(features_dataset_list[k], scale_by(dim_branch[k])) for k in range(num_branch)])
 
     # Save the ROI-pooled features from middle layers
     features_queries_master_fname = "{0}{1}_S{2}_L{3}_master_queries.npy"\
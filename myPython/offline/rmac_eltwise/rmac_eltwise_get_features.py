@@ -10,6 +10,7 @@ import caffe
 import argparse
 from tqdm import tqdm
 from oxford_helper import *
+from extraction_engine import ExtractionEngine, MapWriter
 
 if __name__ == '__main__':
 
@@ -62,16 +63,14 @@ if __name__ == '__main__':
     rmac_queries_list = [np.zeros((N_queries, dim_branch[k]), dtype=np.float32) for k in range(num_branch)]
     rmac_dataset_list = [np.zeros((N_dataset, dim_branch[k]), dtype=np.float32) for k in range(num_branch)]
 
+    # all the branches are read from the same forward pass
+    engine = ExtractionEngine(net, branch)
+    scale_by = lambda dim: (lambda output: output * dim)
+
     # queries: get concat RMAC features
-    for i in tqdm(range(N_queries), file=sys.stdout, leave=False, dynamic_ncols=True):
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_query_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward(end=master)
-        for k in range(num_branch):
-            (rmac_queries_list[k])[i] = np.squeeze(net.blobs[branch[k]].data) * dim_branch[k]
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_query_filename(i) for i in range(N_queries)],
+               [MapWriter(rmac_queries_list[k], scale_by(dim_branch[k])) for k in range(num_branch)])
 
     rmac_queries = np.hstack((rmac_queries_list[k] for k in range(num_branch)))
     rmac_queries_fname = "{0}{1}_S{2}_L{3}_rmac_queries.npy"\
@@ -79,16 +78,9 @@ if __name__ == '__main__':
     np.save(rmac_queries_fname, rmac_queries)
 
     # dataset: get concat RMAC features
-    for i in tqdm(range(N_dataset), file=sys.stdout, leave=False, dynamic_ncols=True):
-        # Load image, process image, get image regions, feed into the network, get descriptor, and store
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward(end=master)
-        for k in range(num_branch):
-            (rmac_dataset_list[k])[i] = np.squeeze(net.blobs[branch[k]].data) * dim_branch[k]
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_filename(i) for i in range(N_dataset)],
+               [MapWriter(rmac_dataset_list[k], scale_by(dim_branch[k])) for k in range(num_branch)])
 
     rmac_dataset = np.hstack((rmac_dataset_list[k] for k in range(num_branch)))
     rmac_dataset_fname = "{0}{1}_S{2}_L{3}_rmac_dataset.npy" \
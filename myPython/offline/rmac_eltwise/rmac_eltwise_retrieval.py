@@ -12,6 +12,7 @@ import caffe
 import argparse
 from tqdm import tqdm
 from oxford_helper import *
+from extraction_engine import ExtractionEngine
 from sklearn.decomposition import PCA
 from sklearn import preprocessing
 
@@ -92,44 +93,31 @@ if __name__ == '__main__':
     np.save("{0}rmac_PCA_mean.npy".format(args.features_dir), pca.mean_)
     np.save("{0}rmac_PCA_variance.npy".format(args.features_dir), pca.explained_variance_)
 
-    # First part, queries
-    for i in tqdm(range(N_queries), file=sys.stdout, leave=False, dynamic_ncols=True):
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_query_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward(end=master)
-
-        features_master_queries[i] = np.squeeze(net.blobs[master].data)
-        for k in range(num_branch):
-            (rmac_queries_list[k])[i] = np.squeeze(net.blobs[branch[k]].data)
-        features_branch_queries_temp = np.hstack(((rmac_queries_list[k])[i] for k in range(num_branch)))
-        features_branch_queries_scaler = scaler.transform(features_branch_queries_temp.reshape(1, -1))
-        features_branch_queries_pca = pca.transform(features_branch_queries_scaler)
-        features_branch_queries[i] = features_branch_queries_pca / np.expand_dims(
-            eps + np.sqrt((features_branch_queries_pca ** 2).sum(axis=1)), axis=1)
+    # the master and all the branches are read from the same forward pass
+    engine = ExtractionEngine(net, [master] + branch)
+
+    # First part, queries (the PCA is applied to all the rows at once)
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_query_filename(i) for i in range(N_queries)],
+               [features_master_queries] + rmac_queries_list)
+    features_branch_queries_temp = np.hstack((rmac_queries_list[k] for k in range(num_branch)))
+    features_branch_queries_scaler = scaler.transform(features_branch_queries_temp)
+    features_branch_queries_pca = pca.transform(features_branch_queries_scaler)
+    features_branch_queries[:] = features_branch_queries_pca / np.expand_dims(
+        eps + np.sqrt((features_branch_queries_pca ** 2).sum(axis=1)), axis=1)
 
     features_queries = np.dstack((features_master_queries, features_branch_queries)).sum(axis=2)
     features_queries /= np.sqrt((features_queries ** 2).sum(axis=1))[:, None]
 
     # Second part, dataset
-    for i in tqdm(range(N_dataset), file=sys.stdout, leave=False, dynamic_ncols=True):
-        I, R = image_helper.prepare_image_and_grid_regions_for_network(oxford_dataset.get_filename(i))
-        net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        net.blobs['data'].data[:] = I
-        net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        net.blobs['rois'].data[:] = R.astype(np.float32)
-        net.forward(end=master)
-
-        features_master_dataset[i] = np.squeeze(net.blobs[master].data)
-        for k in range(num_branch):
-            (rmac_dataset_list[k])[i] = np.squeeze(net.blobs[branch[k]].data)
-        features_branch_dataset_temp = np.hstack(((rmac_dataset_list[k])[i] for k in range(num_branch)))
-        features_branch_dataset_scaler = scaler.transform(features_branch_dataset_temp.reshape(1, -1))
-        features_branch_dataset_pca = pca.transform(features_branch_dataset_scaler)
-        features_branch_dataset[i] = features_branch_dataset_pca / np.expand_dims(
-            eps + np.sqrt((features_branch_dataset_pca ** 2).sum(axis=1)), axis=1)
+    engine.run(image_helper.prepare_image_and_grid_regions_for_network,
+               [oxford_dataset.get_filename(i) for i in range(N_dataset)],
+               [features_master_dataset] + rmac_dataset_list)
+    features_branch_dataset_temp = np.hstack((rmac_dataset_list[k] for k in range(num_branch)))
+    features_branch_dataset_scaler = scaler.transform(features_branch_dataset_temp)
+    features_branch_dataset_pca = pca.transform(features_branch_dataset_scaler)
+    features_branch_dataset[:] = features_branch_dataset_pca / np.expand_dims(
+        eps + np.sqrt((features_branch_dataset_pca ** 2).sum(axis=1)), axis=1)
 
     features_dataset = np.dstack((features_master_dataset, features_branch_dataset)).sum(axis=2)
     features_dataset /= np.sqrt((features_dataset ** 2).sum(axis=1))[:, None]
@@ -9,6 +9,7 @@ import cv2
 import random
 import subprocess
 import region_generator as rg
+import rank_helper
 from collections import OrderedDict
 
 # resize the image so that the longer side equals the given size
@@ -27,29 +28,60 @@ class ImageHelper:
         self.L = L
         # Load and reshape the means to subtract to the inputs
         self.means = np.array([103.93900299,  116.77899933,  123.68000031], dtype=np.float32)[None, :, None, None]
+        self.regions_cache = {}  # key: (H, W) of the resized image; value: grid regions
 
     def prepare_image_and_grid_regions_for_network(self, fname):
         # Extract image, resize at desired size, and extract roi region if
         # available. Then compute the rmac grid in the net format: ID X Y W H
         I, im_resized = self.load_and_prepare_image(fname)
+        R = self.get_grid_regions_for_network(im_resized)
+        return I, R
+
+    def prepare_image_and_grid_regions_for_network_from_image(self, im):
+        # Same as above for an image already decoded (H x W x 3, BGR as cv2.imread), e.g. received by a server
+        I, im_resized = self.resize_and_prepare_image(im, self.S)
+        R = self.get_grid_regions_for_network(im_resized)
+        return I, R
+
+    def prepare_image_and_grid_regions_for_network_multiscale(self, fname, Ss):
+        # Same as above for every scale in Ss, but the image is read and decoded only once
+        im = cv2.imread(fname)
+        images_and_regions = []
+        for S in Ss:
+            I, im_resized = self.resize_and_prepare_image(im, S)
+            images_and_regions.append((I, self.get_grid_regions_for_network(im_resized)))
+        return images_and_regions
+
+    def get_grid_regions_for_network(self, im_resized):
+        # The grid only depends on the image size, so it is computed once per size and the same (read-only)
+        # array is returned for every image of that size
+        H, W = im_resized.shape[0], im_resized.shape[1]
+        if (H, W) not in self.regions_cache:
+            self.regions_cache[(H, W)] = self.compute_grid_regions_for_network(H, W)
+        return self.regions_cache[(H, W)]
+
+    def compute_grid_regions_for_network(self, H, W):
         if self.L == 0:
             # Encode query in mac format instead of rmac, so only one region
             # Regions are in ID X Y W H format
             R = np.zeros((1, 5), dtype=np.float32)
-            R[0, 3] = im_resized.shape[1] - 1
-            R[0, 4] = im_resized.shape[0] - 1
+            R[0, 3] = W - 1
+            R[0, 4] = H - 1
         else:
             # Get the region coordinates and feed them to the network.
-            all_regions = [rg.get_rmac_region_coordinates(im_resized.shape[0], im_resized.shape[1], self.L)]
+            all_regions = [rg.get_rmac_region_coordinates(H, W, self.L)]
             R = rg.pack_regions_for_network(all_regions)
-        return I, R
+        return R
 
     def load_and_prepare_image(self, fname):
         # Read image, get aspect ratio, and resize such as the largest side equals S
         im = cv2.imread(fname)
+        return self.resize_and_prepare_image(im, self.S)
+
+    def resize_and_prepare_image(self, im, S):
         # Resize
         im_size_hw = np.array(im.shape[0:2])
-        ratio = float(self.S) / np.max(im_size_hw)
+        ratio = float(S) / np.max(im_size_hw)
         new_size = tuple(np.round(im_size_hw * ratio).astype(np.int32))
         im_resized = cv2.resize(im, (new_size[1], new_size[0]))
         # Transpose for network and subtract mean
@@ -104,18 +136,26 @@ class OxfordDataset:
         self.N_images = len(self.img_filenames)
         self.N_queries = len(self.q_index)
 
-    def score(self, sim, temp_dir, eval_bin):
+    def score(self, sim, temp_dir, eval_bin, k=None):
+        # Only the ranks up to the last relevant image count for the AP, so by default the ranking is just that deep
+        # (a given k ranks the top k images only, and the AP of a query with relevant images past k is lower)
+        if k is None:
+            k = rank_helper.rank_depth(sim, [self.relevants[q_name] for q_name in self.q_names])
+        return self.score_ids(rank_helper.top_k(sim, k), temp_dir, eval_bin)
+
+    # Same with the ranked image indices of every query (e.g. the ids of search_helper.search, -1 for no result)
+    def score_ids(self, idx, temp_dir, eval_bin):
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir)
-        idx = np.argsort(sim, axis=1)[:, ::-1]
         maps = [self.score_rnk_partial(i, idx[i], temp_dir, eval_bin) for i in range(len(self.q_names))]
         for i in range(len(self.q_names)):
             print "{0}: {1:.2f}".format(self.q_names[i], 100 * maps[i])
         print 20 * "-"
         print "Mean: {0:.2f}".format(100 * np.mean(maps))
+        return np.mean(maps)
 
     def score_rnk_partial(self, i, idx, temp_dir, eval_bin):
-        rnk = np.array(self.img_filenames)[idx]
+        rnk = np.array(self.img_filenames)[idx[idx >= 0]]
         with open("{0}/{1}.rnk".format(temp_dir, self.q_names[i]), 'w') as f:
             f.write("\n".join(rnk) + "\n")
         cmd = "{0} {1}{2} {3}/{4}.rnk".format(eval_bin, self.lab_root, self.q_names[i], temp_dir, self.q_names[i])
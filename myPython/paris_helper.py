@@ -8,6 +8,7 @@ import cv2
 import numpy as np
 import random
 from region_generator import *
+import rank_helper
 
 
 class ParisDataset:
@@ -197,31 +198,27 @@ class ParisDataset:
         return cv2.imread(fname).transpose(2, 0, 1) - self.mean
 
     # Calculates the value of mAP according to the standard of VOC2010 and later
-    def cal_mAP(self, sim):
+    # only the ranks up to the last answer are needed (k, if given, ranks the top k images only)
+    def cal_mAP(self, sim, k=None):
         assert len(sim.shape) == 2, 'This is a 2-dim similarity matrix'
         assert sim.shape[0] == self.num_queries, 'number of rows should be equal to number of queries'
         assert sim.shape[1] == self.num_dataset, 'number of columns should be equal to number of dataset'
+        return self.cal_mAP_ids(rank_helper.top_k(sim, k if k is not None else rank_helper.rank_depth(sim, self.a_idx)))
+
+    # Same with the ranked dataset indices of every query (e.g. the ids of search_helper.search, -1 for no result):
+    # the answers which are not in the ranking count as never retrieved
+    def cal_mAP_ids(self, idx):
+        assert idx.shape[0] == self.num_queries, 'number of rows should be equal to number of queries'
         q_AP = np.zeros(self.num_queries, dtype=np.float32)
-        idx = np.argsort(sim, axis=1)[:, ::-1]
         for q in range(self.num_queries):
-            cnt_correct_last = 0
             q_ans = self.a_idx[q]
+            # ranks (from 1) of the answers found in the ranking, from a relevance mask of the ranking, and the
+            # precision under the recall of every answer (cumulated number of answers / rank)
+            ranks = np.flatnonzero(np.in1d(idx[q], q_ans))[:len(q_ans)] + 1
             recall = np.zeros(len(q_ans), dtype=np.float32)
-            for d in range(self.num_dataset):
-                top_k = d + 1
-                top_idx = list(idx[q, : top_k])
-                cnt_correct = len([i for i in top_idx if i in q_ans])
-                assert cnt_correct >= cnt_correct_last
-                assert cnt_correct <= len(q_ans)
-                if cnt_correct > cnt_correct_last:
-                    recall[cnt_correct - 1] = float(cnt_correct) / float(top_k)  # precision under the given recall
-                    cnt_correct_last = cnt_correct
-                if cnt_correct == len(q_ans):
-                    break
+            recall[:len(ranks)] = np.arange(1, len(ranks) + 1, dtype=np.float32) / ranks
             # calculates the maximum precision when no less than given recall
-            recall_max = np.zeros(len(q_ans), dtype=np.float32)
-            for r in range(len(q_ans)):
-                recall_max[r] = np.max(recall[r:])
+            recall_max = np.maximum.accumulate(recall[::-1])[::-1]
             q_AP[q] = recall_max.mean(axis=0)
             print("AP of query %s: %f" % (self.q_fname[q], q_AP[q]))
         return q_AP.mean(axis=0) * 100.0
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# Python class of a product-quantized (PQ / OPQ) store of the gallery descriptors: every descriptor is kept as m
+# uint8 codes (one per sub-vector) and the queries are scored against the codes with lookup tables (ADC)
+# usage: store = PqStore.train(features, m=64, opq=True)  # features: gallery descriptors, e.g. memory-mapped
+#        store.add(features)
+#        ids, scores = store.search(features_queries, k=100)  # or store.search(..., rerank=10, features=features)
+#        sim = store.similarity(features_queries)  # for dataset.score(sim, ...) or cData.cal_mAP(sim)
+#        store.save('features.pq.npz')  # and PqStore.load('features.pq.npz')
+
+'''
+Note:
+    The descriptor is split into m sub-vectors of dim / m values, and each sub-vector is replaced by the index of its
+    nearest centroid among 256 (k-means of ivf_helper on the euclidean distance), so a 512-dim float32 descriptor of
+    2 KB takes m bytes (m = 32 to 128 for 64x to 16x less memory). With opq, the descriptors are first rotated by an
+    orthogonal matrix learned by alternating the k-means of the sub-vectors and a Procrustes fit of the rotation to
+    the reconstructed descriptors, which balances the sub-vectors and lowers the quantization error. The similarity
+    of a query to a code is the sum over the sub-vectors of the dot product of the query sub-vector and the centroid,
+    read from a table of m x 256 values computed once per query (asymmetric distance: the query is not quantized).
+    With rerank > 1, the rerank * k best codes are scored again exactly from the float descriptors (which can be a
+    memory-mapped .npy), and only the k best are returned.
+'''
+
+import os
+import time
+import argparse
+import numpy as np
+import rank_helper
+import ivf_helper
+import index_eval
+
+
+class PqStore:
+    def __init__(self, centroids, rotation=None):
+        self.centroids = np.asarray(centroids, dtype=np.float32)  # m x 256 x dsub
+        self.rotation = rotation  # dim x dim, or None for PQ
+        self.m, self.ksub, self.dsub = self.centroids.shape
+        self.codes = np.zeros((0, self.m), dtype=np.uint8)
+
+    @staticmethod
+    def train_pq(X, m, iters=25, seed=0):
+        dsub = X.shape[1] // m
+        return np.stack([ivf_helper.train_kmeans(np.ascontiguousarray(X[:, j * dsub: (j + 1) * dsub]), 256, iters,
+                                                 min(len(X), 65536), seed, spherical=False) for j in range(m)])
+
+    # PQ (or OPQ) trained on at most num_train random rows of features
+    @staticmethod
+    def train(features, m, opq=False, opq_iters=10, num_train=65536, seed=0):
+        assert features.shape[1] % m == 0, 'the dimension should be a multiple of m'
+        rng = np.random.RandomState(seed)
+        rows = np.sort(rng.choice(features.shape[0], min(num_train, features.shape[0]), replace=False))
+        X = np.asarray(features[rows], dtype=np.float32)
+        if not opq:
+            return PqStore(PqStore.train_pq(X, m, seed=seed))
+        rotation = np.eye(X.shape[1], dtype=np.float32)
+        for _ in range(opq_iters):
+            store = PqStore(PqStore.train_pq(X.dot(rotation), m, iters=10, seed=seed), rotation)
+            Y = store.decode(store.encode(X))  # reconstruction in the rotated space
+            U, _, Vt = np.linalg.svd(X.T.dot(Y))
+            rotation = U.dot(Vt).astype(np.float32)
+        return PqStore(PqStore.train_pq(X.dot(rotation), m, seed=seed), rotation)
+
+    def rotate(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        return X.dot(self.rotation) if self.rotation is not None else X
+
+    # m codes of every row of features, by blocks of rows
+    def encode(self, features, block_rows=65536):
+        codes = np.zeros((features.shape[0], self.m), dtype=np.uint8)
+        for start in range(0, features.shape[0], block_rows):
+            X = self.rotate(features[start: start + block_rows])
+            for j in range(self.m):
+                codes[start: start + block_rows, j] = ivf_helper.nearest(
+                    X[:, j * self.dsub: (j + 1) * self.dsub], self.centroids[j], spherical=False)
+        return codes
+
+    # reconstruction of the codes (in the rotated space with opq)
+    def decode(self, codes):
+        return np.hstack([self.centroids[j][codes[:, j]] for j in range(self.m)])
+
+    def add(self, features):
+        self.codes = np.vstack((self.codes, self.encode(features)))
+        return self
+
+    # m x 256 dot products of the sub-vectors of a query with the centroids
+    def lookup_table(self, query):
+        q = self.rotate(query[None, :])[0].reshape(self.m, 1, self.dsub)
+        return (self.centroids * q).sum(axis=2)
+
+    # approximate similarities of the queries to all the codes (n x N)
+    def similarity(self, queries, block_rows=262144):
+        sim = np.zeros((len(queries), len(self.codes)), dtype=np.float32)
+        sub = np.arange(self.m)
+        for q in range(len(queries)):
+            table = self.lookup_table(np.asarray(queries[q], dtype=np.float32))
+            for start in range(0, len(self.codes), block_rows):
+                sim[q, start: start + block_rows] = table[sub, self.codes[start: start + block_rows]].sum(axis=1)
+        return sim
+
+    # ids and scores of the k best codes of every query, re-scored from the float features if rerank > 1
+    def search(self, queries, k, rerank=1, features=None):
+        assert rerank <= 1 or features is not None, 'the float features are needed to re-rank'
+        k = min(k, len(self.codes))
+        ids = np.zeros((len(queries), k), dtype=np.int64)
+        scores = np.zeros((len(queries), k), dtype=np.float32)
+        for q in range(len(queries)):
+            sim = self.similarity(queries[q: q + 1])
+            cand = rank_helper.top_k(sim, k * max(1, rerank))[0]
+            if rerank > 1:
+                cand = np.sort(cand)
+                s = np.asarray(features[cand], dtype=np.float32).dot(np.asarray(queries[q], dtype=np.float32))
+            else:
+                s = sim[0, cand]
+            top = rank_helper.top_k(s[None, :], k)[0]
+            ids[q], scores[q] = cand[top], s[top]
+        return ids, scores
+
+    def save(self, fname):
+        np.savez(fname, centroids=self.centroids, codes=self.codes,
+                 rotation=self.rotation if self.rotation is not None else np.zeros((0, 0), dtype=np.float32))
+
+    @staticmethod
+    def load(fname):
+        data = np.load(fname)
+        store = PqStore(data['centroids'], data['rotation'] if data['rotation'].size > 0 else None)
+        store.codes = data['codes']
+        return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Encode the gallery with PQ / OPQ and compare it with the brute force')
+    parser.add_argument('--features_queries', type=str, required=True, help='Features of the queries (.npy)')
+    parser.add_argument('--features_dataset', type=str, required=True, help='Features of the gallery (.npy, memory-mapped)')
+    parser.add_argument('--store', type=str, required=False, help='Path of the codes (.npz), loaded if it exists')
+    parser.add_argument('--m', type=int, required=False, help='Number of sub-vectors (bytes per descriptor)')
+    parser.add_argument('--opq', dest='opq', action='store_true', help='Learn a rotation of the descriptors (OPQ)')
+    parser.add_argument('--rerank', type=str, required=False, help='Comma-separated re-ranking factors to compare (1 for none)')
+    parser.add_argument('--k', type=int, required=False, help='Number of results per query')
+    parser.add_argument('--dataset', type=str, required=False, help='Path to the Oxford / Paris directory, to report the mAP')
+    parser.add_argument('--eval_binary', type=str, required=False, help='Path to the compute_ap binary to evaluate Oxford / Paris')
+    parser.add_argument('--cover_dir', type=str, required=False, help='Path to the cover dataset, to report its mAP instead')
+    parser.add_argument('--temp_dir', type=str, required=False, help='Path to a temporary directory to store the scores')
+    parser.set_defaults(store=None, m=64, opq=False, rerank='1,4,16', k=100, dataset=None, cover_dir=None,
+                        temp_dir='tmp')
+    args = parser.parse_args()
+
+    features_queries = np.load(args.features_queries)
+    features_dataset = np.load(args.features_dataset, mmap_mode='r')
+    t = time.time()
+    if args.store is not None and os.path.exists(args.store):
+        store = PqStore.load(args.store)
+    else:
+        store = PqStore.train(features_dataset, args.m, args.opq).add(features_dataset)
+        if args.store is not None:
+            store.save(args.store)
+    print("%d codes of %d bytes ready in %.1f s (%dx smaller than float32)" % (
+        len(store.codes), store.m, time.time() - t, 4 * features_dataset.shape[1] // store.m))
+    score_fn = None
+    if args.dataset is not None:
+        score_fn = index_eval.oxford_score_fn(args.dataset, args.eval_binary, args.temp_dir)
+    elif args.cover_dir is not None:
+        score_fn = index_eval.cover_score_fn(args.cover_dir)
+    if score_fn is not None:
+        # mAP of the approximate similarities to the whole gallery, as with the brute force
+        sim = store.similarity(features_queries)
+        print("mAP of the ADC similarities: %.2f" % (100 * score_fn(index_eval.sim_to_ids(sim))))
+    index_eval.benchmark(lambda queries, rerank: store.search(queries, args.k, rerank, features_dataset),
+                         [int(v) for v in args.rerank.split(',')], features_queries, features_dataset, args.k, score_fn)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Python class that decodes and prepares the images in background threads while the network is running
+# usage: for I, R in Prefetcher(image_helper.prepare_image_and_grid_regions_for_network, fnames, num_workers=4):
+#            ...
+
+'''
+Note:
+    cv2.imread and cv2.resize release the GIL, so a few threads are enough to keep the network busy.
+    Results are yielded in the same order as the items, whatever the order the workers finish in, so the i-th
+    feature still corresponds to the i-th image. At most 'queue_size' items are prepared ahead of the consumer.
+'''
+
+import sys
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class _Slot:
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Prefetcher:
+    def __init__(self, load_fn, items, num_workers=4, queue_size=16):
+        assert num_workers > 0, 'at least one worker is needed'
+        self.load_fn = load_fn
+        self.items = items
+        self.num_workers = num_workers
+        self.queue_size = max(queue_size, num_workers)
+        self.timeout = 0.1  # seconds, so that the main thread can still be interrupted by Ctrl-C
+
+    def __iter__(self):
+        slots = queue.Queue(maxsize=self.queue_size)  # slots in the order of the items
+        tasks = queue.Queue()  # slots waiting for a worker
+        stop = threading.Event()
+
+        def feed():
+            for item in self.items:
+                slot = _Slot(item)
+                while not stop.is_set():
+                    try:
+                        slots.put(slot, timeout=self.timeout)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    break
+                tasks.put(slot)
+            for _ in range(self.num_workers):
+                tasks.put(None)
+            if not stop.is_set():
+                slots.put(None)
+
+        def work():
+            while True:
+                slot = tasks.get()
+                if slot is None:
+                    break
+                if not stop.is_set():
+                    try:
+                        slot.result = self.load_fn(slot.item)
+                    except Exception:
+                        slot.error = sys.exc_info()[1]
+                slot.done.set()
+
+        threads = [threading.Thread(target=feed)] + [threading.Thread(target=work) for _ in range(self.num_workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        try:
+            while True:
+                try:
+                    slot = slots.get(timeout=self.timeout)
+                except queue.Empty:
+                    continue
+                if slot is None:
+                    break
+                while not slot.done.wait(self.timeout):
+                    pass
+                if slot.error is not None:
+                    raise slot.error
+                yield slot.result
+        finally:
+            # release the feeder if the consumer stops early
+            stop.set()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+# Python functions that store the descriptors as float16 or int8 (with a scale per dimension) instead of float32, and
+# search them block by block without converting the whole gallery back
+# usage: save_quantized('features.int8.npy', np.load('features.npy', mmap_mode='r'), 'int8')
+#        data, scale = load_quantized('features.int8.npy')  # data is memory-mapped, scale is None for float16
+#        ids, scores = search_helper.search(features_queries, data, k=100, scale=scale)
+#        python ./myPython/quant_helper.py --features_queries q.npy --features_dataset features.npy --dataset ...
+
+'''
+Note:
+    float16 halves the size of the descriptors and int8 divides it by 4. The int8 value of a dimension d is
+    round(x_d / scale_d) with scale_d = max |x_d| / 127 over the gallery, so a descriptor is x = scale * q, and its
+    dot product with a query y is the dot product of (y * scale) with q: the scale goes into the queries and the
+    gallery tiles are only cast to float32 (the accumulation is done in float32). The scales are saved next to the
+    data, in '<name>.scale.npy' for 'features.int8.npy'. Run this script to write the quantized galleries and
+    compare the recall and the Oxford / Paris mAP of float16 and int8 with float32.
+'''
+
+import os
+import argparse
+import numpy as np
+import search_helper
+import index_eval
+
+
+def scale_fname(fname):
+    return os.path.splitext(fname)[0] + '.scale.npy'
+
+
+# scale per dimension of the int8 values (max of |features| / 127 over the rows, by blocks)
+def int8_scale(features, block_rows=65536):
+    amax = np.zeros(features.shape[1], dtype=np.float32)
+    for start in range(0, features.shape[0], block_rows):
+        amax = np.maximum(amax, np.abs(np.asarray(features[start: start + block_rows], dtype=np.float32)).max(axis=0))
+    return np.maximum(amax, 1e-12) / 127.0
+
+
+def quantize(X, dtype, scale=None):
+    if dtype == 'float16':
+        return np.asarray(X, dtype=np.float16)
+    return np.clip(np.round(np.asarray(X, dtype=np.float32) / scale), -127, 127).astype(np.int8)
+
+
+def dequantize(data, scale=None):
+    data = np.asarray(data, dtype=np.float32)
+    return data * scale if scale is not None else data
+
+
+# write features (any 2-dim array, e.g. memory-mapped float32) as dtype ('float16' or 'int8') into fname
+def save_quantized(fname, features, dtype, block_rows=65536):
+    assert dtype in ('float16', 'int8'), 'dtype should be float16 or int8'
+    scale = int8_scale(features, block_rows) if dtype == 'int8' else None
+    tmp_fname = fname + '.tmp.npy'
+    data = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=np.dtype(dtype), shape=features.shape)
+    for start in range(0, features.shape[0], block_rows):
+        data[start: start + block_rows] = quantize(features[start: start + block_rows], dtype, scale)
+    data.flush()
+    del data
+    if scale is not None:
+        np.save(scale_fname(fname), scale)
+    elif os.path.exists(scale_fname(fname)):
+        os.remove(scale_fname(fname))
+    os.rename(tmp_fname, fname)
+
+
+# (memory-mapped data, scale or None) of a file written by save_quantized (or of a float32 .npy)
+def load_quantized(fname):
+    data = np.load(fname, mmap_mode='r')
+    scale = np.load(scale_fname(fname)) if data.dtype == np.int8 else None
+    return data, scale
+
+
+# dense similarities of the queries to the quantized gallery (n x N), computed by tiles of the gallery
+def similarity(queries, data, scale=None, mem_mb=256):
+    queries = np.asarray(queries, dtype=np.float32) * (scale if scale is not None else 1)
+    sim = np.zeros((len(queries), data.shape[0]), dtype=np.float32)
+    _, tile_rows = search_helper.tile_sizes(len(queries), data.shape[0], data.shape[1], 1, mem_mb)
+    for start, tile in search_helper.iter_tiles(data, tile_rows):
+        sim[:, start: start + len(tile)] = queries.dot(tile.T)
+    return sim
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantize the gallery to float16 / int8 and compare it with float32')
+    parser.add_argument('--features_queries', type=str, required=True, help='Features of the queries (.npy)')
+    parser.add_argument('--features_dataset', type=str, required=True, help='Features of the gallery (.npy, float32)')
+    parser.add_argument('--dtypes', type=str, required=False, help='Comma-separated storage types to compare')
+    parser.add_argument('--k', type=int, required=False, help='Number of results per query for the recall')
+    parser.add_argument('--dataset', type=str, required=False, help='Path to the Oxford / Paris directory, to report the mAP')
+    parser.add_argument('--eval_binary', type=str, required=False, help='Path to the compute_ap binary to evaluate Oxford / Paris')
+    parser.add_argument('--temp_dir', type=str, required=False, help='Path to a temporary directory to store the scores')
+    parser.set_defaults(dtypes='float16,int8', k=100, dataset=None, temp_dir='tmp')
+    args = parser.parse_args()
+
+    features_queries = np.load(args.features_queries)
+    features_dataset = np.load(args.features_dataset, mmap_mode='r')
+    score_fn = None
+    if args.dataset is not None:
+        score_fn = index_eval.oxford_score_fn(args.dataset, args.eval_binary, args.temp_dir)
+    # the quantized galleries are written next to the float32 one, e.g. 'features.int8.npy'
+    galleries = {}
+    for dtype in args.dtypes.split(','):
+        fname = '{0}.{1}.npy'.format(os.path.splitext(args.features_dataset)[0], dtype)
+        save_quantized(fname, features_dataset, dtype)
+        galleries[dtype] = load_quantized(fname)
+        print("%s: %s (%.1f MB instead of %.1f MB)" % (dtype, fname, os.path.getsize(fname) / 1048576.0,
+                                                     os.path.getsize(args.features_dataset) / 1048576.0))
+
+    def search_fn(queries, dtype):
+        data, scale = galleries[dtype]
+        return search_helper.search(queries, data, args.k, scale=scale)
+    index_eval.benchmark(search_fn, args.dtypes.split(','), features_queries, features_dataset, args.k)
+    if score_fn is not None:
+        # mAP of the full ranking, as with the brute force of test.py
+        map_float = score_fn(index_eval.sim_to_ids(similarity(features_queries, features_dataset)))
+        for dtype in args.dtypes.split(','):
+            map_dtype = score_fn(index_eval.sim_to_ids(similarity(features_queries, *galleries[dtype])))
+            print("%s: mAP %.2f, float32: %.2f, delta %+.2f" % (dtype, 100 * map_dtype, 100 * map_float,
+                                                               100 * (map_dtype - map_float)))
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+# Python functions that rank the dataset images for every query (most similar first) without sorting the whole
+# similarity matrix
+# usage: idx = top_k(sim, 100)  # idx[q] = indices of the 100 images most similar to query q, best first
+#        idx = top_k(sim, rank_depth(sim, relevants))  # deep enough to rank every relevant image of every query
+
+'''
+Note:
+    np.argpartition finds the k largest entries of every row in linear time and only these k entries are sorted, so
+    a query costs O(N + k log k) instead of the O(N log N) of a full np.argsort. k as large as the dataset gives the
+    full ranking. Images with equal similarities may come in another order than with np.argsort(sim)[:, ::-1].
+    An AP only depends on the ranks up to the last relevant image, so with k = rank_depth(sim, relevants) the AP is
+    exactly the one of the full ranking, and a smaller k gives a lower bound of it.
+'''
+
+import numpy as np
+
+
+# indices of the k largest entries of every row of sim, largest first
+def top_k(sim, k):
+    assert len(sim.shape) == 2, 'This is a 2-dim similarity matrix'
+    N = sim.shape[1]
+    k = min(int(k), N)
+    assert k > 0, 'k should be positive'
+    if k == N:
+        return np.argsort(sim, axis=1)[:, ::-1]
+    idx = np.argpartition(sim, N - k, axis=1)[:, N - k:]
+    rows = np.arange(sim.shape[0])[:, None]
+    order = np.argsort(sim[rows, idx], axis=1)[:, ::-1]
+    return idx[rows, order]
+
+
+# smallest k such that top_k(sim, k) contains all the relevants[q] (list of column indices) of every row q
+def rank_depth(sim, relevants):
+    depth = 1
+    for q, relevant in enumerate(relevants):
+        if len(relevant) > 0:
+            depth = max(depth, int(np.count_nonzero(sim[q] >= sim[q, relevant].min())))
+    return depth
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+# Python script of a long-lived retrieval server: the network is loaded once and the index of the gallery (written by
+# feature_index.py) is opened once, then every request sends an image and gets its top k gallery images
+
+'''
+usage:
+python ./myPython/retrieval_server.py \
+    --proto ./proto/deploy_resnet101_normpython.prototxt \
+    --weights ./caffemodel/deep_image_retrieval_model.caffemodel \
+    --index_file ~/data/cover/training/features.fidx \
+    --image_root /data \
+    --port 8080  # or --unix_socket /tmp/retrieval.sock
+requests:
+curl -X POST --data-binary @query.jpg 'http://127.0.0.1:8080/search?k=10'  # image in the body
+curl 'http://127.0.0.1:8080/search?path=/data/query.jpg&k=10'  # image read by the server (under --image_root)
+curl 'http://127.0.0.1:8080/health'
+curl 'http://127.0.0.1:8080/stats'  # with --max_batch > 1: histograms of the batch sizes and queueing delays
+curl --unix-socket /tmp/retrieval.sock 'http://localhost/search?path=/data/query.jpg'
+answer: {"results": [{"id": "image_name", "score": 0.93}, ...], "ms": 41.2}
+'''
+
+'''
+Note:
+    The image goes through oxford_helper.ImageHelper (resized so that its larger side is S, ImageNet means
+    subtracted, rigid grid of L levels), as prepare_image_and_grid_regions_for_network does for the evaluation,
+    so the descriptors match the ones of the gallery if it was extracted the same way. The network is shared by the
+    threads of the server and runs one forward pass at a time; with --max_batch > 1, the concurrent requests are
+    grouped into batched forward passes by microbatch_helper (waiting at most --max_delay_ms). The search is the
+    tiled brute-force search of search_helper over the memory-mapped vectors of the index (float32, float16 or int8). The index should come from
+    the same model: the server refuses to start if the model fingerprint of the index is not the one of the network.
+    The requests by path only read the files under --image_root (relative paths are taken from it, symbolic links
+    are resolved), and are refused (403) without it. A k that is not a positive integer gets a 400, and a failure of
+    the network or of the search a 500, both with a JSON {"error": ...} body.
+'''
+
+import os
+import sys
+import json
+import time
+import threading
+import argparse
+import numpy as np
+import caffe
+import cv2
+from oxford_helper import ImageHelper
+import batch_helper
+import search_helper
+import feature_index
+import descriptor_cache
+import microbatch_helper
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import urlparse, parse_qs
+
+
+# descriptors of decoded images, computed by the network shared by the threads of the server
+# (one image per forward pass, or micro-batches of up to max_batch concurrent images)
+class Embedder:
+    def __init__(self, net, image_helper, end_layer='rmac/normalized', max_batch=1, max_delay_ms=5.):
+        self.net = net
+        self.image_helper = image_helper
+        self.end_layer = end_layer
+        self.inputs = batch_helper.InputBlobs()
+        self.lock = threading.Lock()
+        self.batcher = None
+        if max_batch > 1:
+            self.batcher = microbatch_helper.MicroBatcher(self.forward, max_batch, max_delay_ms)
+
+    def forward(self, images, regions):
+        return batch_helper.forward_batch(self.net, images, regions, self.end_layer, self.inputs)
+
+    def embed(self, im):
+        I, R = self.image_helper.prepare_image_and_grid_regions_for_network_from_image(im)
+        if self.batcher is not None:
+            d = self.batcher.submit(I, R)
+        else:
+            with self.lock:
+                d = self.forward([I], [R])[0]
+        return d / np.sqrt((d * d).sum())
+
+
+# top k (image name, score) of descriptors in the index
+class Searcher:
+    def __init__(self, index, mem_mb=256):
+        self.index = index
+        self.mem_mb = mem_mb
+
+    def search(self, descriptors, k):
+        ids, scores = search_helper.search(descriptors, self.index.vectors, k, self.mem_mb, self.index.scale)
+        return [[(self.index.name(i), float(s)) for i, s in zip(ids_q, scores_q) if i >= 0]
+                for ids_q, scores_q in zip(ids, scores)]
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/health':
+            index = self.server.searcher.index
+            return self.reply(200, {'count': index.count, 'dim': index.dim, 'dtype': index.dtype,
+                                    'model_fingerprint': index.model_fingerprint})
+        if url.path == '/stats':
+            batcher = self.server.embedder.batcher
+            return self.reply(200, batcher.stats() if batcher is not None else {})
+        if url.path == '/search' and 'path' in query:
+            path = self.image_path(query['path'][0])
+            if path is None:
+                return self.reply(403, {'error': 'images can only be read by path under the --image_root of the server'})
+            return self.search(cv2.imread(path), query)
+        self.reply(404, {'error': 'unknown request %s' % self.path})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/search':
+            return self.reply(404, {'error': 'unknown request %s' % self.path})
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.search(cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR), parse_qs(url.query))
+
+    # real path of a requested image, or None if the server has no image root or the image is not under it
+    def image_path(self, path):
+        if self.server.image_root is None:
+            return None
+        root = os.path.realpath(self.server.image_root)
+        path = os.path.realpath(os.path.join(root, path))
+        if path != root and not path.startswith(root.rstrip(os.sep) + os.sep):
+            return None
+        return path
+
+    def search(self, im, query):
+        try:
+            k = int(query.get('k', [self.server.k])[0])
+        except ValueError:
+            k = 0
+        if k <= 0:
+            return self.reply(400, {'error': 'k must be a positive integer'})
+        if im is None:
+            return self.reply(400, {'error': 'the image could not be read'})
+        t = time.time()
+        try:
+            d = self.server.embedder.embed(im)
+            results = self.server.searcher.search(d[None, :], k)[0]
+        except Exception as e:
+            self.log_error("search failed: %r", e)
+            return self.reply(500, {'error': str(e)})
+        self.reply(200, {'results': [{'id': name, 'score': score} for name, score in results],
+                         'ms': 1000 * (time.time() - t)})
+
+    def reply(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # the clients of a unix socket have no address
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        sys.stderr.write("%s - [%s] %s\n" % (self.address_string(), self.log_date_time_string(), format % args))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+# image_root: directory of the images that can be requested by path (None: requests by path refused)
+def make_server(embedder, searcher, k, host='127.0.0.1', port=8080, unix_socket=None, image_root=None):
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.embedder = embedder
+    server.searcher = searcher
+    server.k = k
+    server.image_root = image_root
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the top k gallery images of query images')
+    parser.add_argument('--gpu', type=int, required=False, help='GPU ID to use (e.g. 0)')
+    parser.add_argument('--cpu', dest='cpu', action='store_true', help='Run the network on the CPU')
+    parser.add_argument('--S', type=int, required=False, help='Resize larger side of image to S pixels (e.g. 800)')
+    parser.add_argument('--L', type=int, required=False, help='Use L spatial levels (e.g. 2)')
+    parser.add_argument('--proto', type=str, required=True, help='Path to the prototxt file')
+    parser.add_argument('--weights', type=str, required=True, help='Path to the caffemodel file')
+    parser.add_argument('--end', type=str, required=False, help='Name of the output layer')
+    parser.add_argument('--index_file', type=str, required=True, help='Index of the gallery written by feature_index.py')
+    parser.add_argument('--k', type=int, required=False, help='Default number of results per query')
+    parser.add_argument('--mem_mb', type=int, required=False, help='Memory budget in MB of the search by tiles')
+    parser.add_argument('--max_batch', type=int, required=False, help='Maximum number of concurrent images per forward pass')
+    parser.add_argument('--max_delay_ms', type=float, required=False, help='Maximum time a request waits for a batch to fill')
+    parser.add_argument('--host', type=str, required=False, help='Address to listen on')
+    parser.add_argument('--port', type=int, required=False, help='Port to listen on')
+    parser.add_argument('--unix_socket', type=str, required=False, help='Path of a unix socket to listen on instead')
+    parser.add_argument('--image_root', type=str, required=False, help='Directory of the images that can be requested by path')
+    parser.set_defaults(gpu=0, cpu=False, S=800, L=2, end='rmac/normalized', k=10, mem_mb=256, max_batch=1,
+                        max_delay_ms=5., host='127.0.0.1', port=8080, unix_socket=None,
+                        image_root=None)
+    args = parser.parse_args()
+
+    # Configure caffe and load the network once
+    if args.cpu:
+        caffe.set_mode_cpu()
+    else:
+        caffe.set_device(args.gpu)
+        caffe.set_mode_gpu()
+    net = caffe.Net(args.proto, args.weights, caffe.TEST)
+
+    index = feature_index.FeatureIndex(args.index_file)
+    model_fp = descriptor_cache.model_fingerprint(args.proto, args.weights)
+    assert not index.model_fingerprint or index.model_fingerprint == model_fp, \
+        '%s was not extracted with this model' % args.index_file
+    embedder = Embedder(net, ImageHelper(args.S, args.L), args.end, args.max_batch, args.max_delay_ms)
+    server = make_server(embedder, Searcher(index, args.mem_mb), args.k, args.host, args.port, args.unix_socket,
+                         args.image_root)
+    print("Serving %d images of %s on %s" % (index.count, args.index_file,
+                                            args.unix_socket or '%s:%d' % (args.host, args.port)))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
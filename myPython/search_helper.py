@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# Python functions that search the k most similar gallery images of every query (dot product of the descriptors)
+# tile by tile, without building the whole N_queries x N_dataset similarity matrix
+# usage: gallery = np.load('features.npy', mmap_mode='r')  # or any 2-dim array
+#        ids, scores = search(features_queries, gallery, k=100, mem_mb=256)
+#        ids[q] = rows of the k most similar gallery images of query q, best first, and scores[q] their similarities
+#        ids, scores = search(features_queries, gallery, k=100, threshold=0.65)  # only the results scoring >= 0.65
+#        cData.cal_mAP_ids(ids), dataset.score_ids(ids, temp_dir, eval_bin)  # metrics of the dataset helpers
+#        offsets, ids, scores = range_search(features_queries, gallery, threshold=0.65)  # all the results >= 0.65
+#        ids[offsets[q]: offsets[q + 1]] = rows of the gallery images of query q with a similarity >= 0.65, best first
+
+'''
+Note:
+    The gallery is read tile by tile (a memory-mapped .npy is read from the disk exactly once), and every tile is
+    multiplied with blocks of queries. The top k of every block of similarities is merged into a running top k per
+    query, so the memory holds a gallery tile, a block of similarities and the n x k results, whatever the sizes of
+    the gallery and of the queries. tile_sizes splits mem_mb between the tile and the block of similarities. Queries
+    with less than k gallery images (or less than k results >= threshold) get -1 ids and -inf scores at the end; a
+    block of similarities without any value >= threshold is skipped before its top k. The gallery can be stored in
+    float16 or int8 (see quant_helper): the tiles are cast to float32, and the int8 scale of every dimension goes
+    into the queries. The metrics of the dataset helpers take these ids (cal_mAP_ids, cal_precision_ids, score_ids)
+    as well as a dense similarity matrix.
+    range_search has no k: it returns every result >= threshold, in CSR arrays (offsets of the queries into ids and
+    scores). A block of similarities only gives the indices of its values >= threshold (np.nonzero of the mask), so
+    the memory is a gallery tile, a block of similarities and the matches, not the size of the gallery. The matches
+    of a query are sorted by decreasing similarity at the end. dedup_helper does the same for a gallery against
+    itself, on the upper triangle of the similarities only.
+'''
+
+import argparse
+import numpy as np
+import rank_helper
+
+
+# (queries per block, gallery images per tile) such that a float32 tile and a block of similarities fit in mem_mb
+def tile_sizes(num_queries, num_gallery, dim, k, mem_mb=256):
+    budget = mem_mb * 1024 * 1024 // 4  # in float32
+    # a quarter for the gallery tile, the rest for the similarities (and the candidates of the merge)
+    tile_rows = int(min(num_gallery, max(k, budget // 4 // dim)))
+    block_rows = int(min(num_queries, max(1, budget * 3 // 4 // (tile_rows + 2 * k))))
+    return max(block_rows, 1), max(tile_rows, 1)
+
+
+# (start row, float32 copy of the rows) of every tile of the gallery
+def iter_tiles(gallery, tile_rows):
+    for start in range(0, gallery.shape[0], tile_rows):
+        yield start, np.ascontiguousarray(gallery[start: start + tile_rows], dtype=np.float32)
+
+
+# merge the candidates (scores, ids) of a tile into the running top k of a block of queries
+def merge_top_k(scores, ids, tile_scores, tile_ids, k):
+    scores = np.hstack((scores, tile_scores))
+    ids = np.hstack((ids, tile_ids))
+    rows = np.arange(scores.shape[0])[:, None]
+    idx = rank_helper.top_k(scores, k)
+    return scores[rows, idx], ids[rows, idx]
+
+
+# k most similar rows of gallery (times scale if given) for every row of queries, as (ids, scores) of shape n x k,
+# keeping only the similarities >= threshold if given
+def search(queries, gallery, k, mem_mb=256, scale=None, threshold=None):
+    assert queries.shape[1] == gallery.shape[1], 'queries and gallery should have the same dimension'
+    if scale is not None:
+        queries = np.asarray(queries, dtype=np.float32) * scale
+    num_queries = queries.shape[0]
+    block_rows, tile_rows = tile_sizes(num_queries, gallery.shape[0], gallery.shape[1], k, mem_mb)
+    scores = np.full((num_queries, k), -np.inf, dtype=np.float32)
+    ids = np.full((num_queries, k), -1, dtype=np.int64)
+    for start, tile in iter_tiles(gallery, tile_rows):
+        k_tile = min(k, tile.shape[0])
+        for q in range(0, num_queries, block_rows):
+            Q = np.asarray(queries[q: q + block_rows], dtype=np.float32)
+            sim = Q.dot(tile.T)
+            if threshold is not None and not (sim >= threshold).any():
+                continue
+            rows = np.arange(sim.shape[0])[:, None]
+            idx = rank_helper.top_k(sim, k_tile)
+            tile_scores, tile_ids = sim[rows, idx], idx + start
+            if threshold is not None:
+                below = tile_scores < threshold
+                tile_scores[below], tile_ids[below] = -np.inf, -1
+            scores[q: q + block_rows], ids[q: q + block_rows] = merge_top_k(
+                scores[q: q + block_rows], ids[q: q + block_rows], tile_scores, tile_ids, k)
+    return ids, scores
+
+
+# all the rows of gallery (times scale if given) with a similarity >= threshold for every row of queries, as CSR
+# arrays (offsets, ids, scores): the results of query q are ids[offsets[q]: offsets[q + 1]], best first
+def range_search(queries, gallery, threshold, mem_mb=256, scale=None):
+    assert queries.shape[1] == gallery.shape[1], 'queries and gallery should have the same dimension'
+    if scale is not None:
+        queries = np.asarray(queries, dtype=np.float32) * scale
+    num_queries = queries.shape[0]
+    block_rows, tile_rows = tile_sizes(num_queries, gallery.shape[0], gallery.shape[1], 1, mem_mb)
+    matches_q, matches_ids, matches_scores = [], [], []
+    for start, tile in iter_tiles(gallery, tile_rows):
+        for q in range(0, num_queries, block_rows):
+            sim = np.asarray(queries[q: q + block_rows], dtype=np.float32).dot(tile.T)
+            rows, cols = np.nonzero(sim >= threshold)
+            if len(rows) > 0:
+                matches_q.append(rows + q)
+                matches_ids.append(cols + start)
+                matches_scores.append(sim[rows, cols])
+    if not matches_q:
+        return np.zeros(num_queries + 1, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    matches_q, matches_ids, matches_scores = np.hstack(matches_q), np.hstack(matches_ids), np.hstack(matches_scores)
+    order = np.lexsort((-matches_scores, matches_q))
+    offsets = np.r_[0, np.cumsum(np.bincount(matches_q, minlength=num_queries))].astype(np.int64)
+    return offsets, matches_ids[order].astype(np.int64), matches_scores[order]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search the top k gallery images of every query')
+    parser.add_argument('--queries_npy', type=str, required=True, help='Features of the queries (.npy)')
+    parser.add_argument('--gallery_npy', type=str, required=True, help='Features of the gallery (.npy, memory-mapped)')
+    parser.add_argument('--output', type=str, required=True, help='Path of the results (.npz with ids and scores, and offsets with --range)')
+    parser.add_argument('--k', type=int, required=False, help='Number of results per query')
+    parser.add_argument('--mem_mb', type=int, required=False, help='Memory budget of the search in MB')
+    parser.add_argument('--threshold', type=float, required=False, help='Keep only the results with a similarity >= threshold')
+    parser.add_argument('--range', dest='range', action='store_true', help='Return all the results >= threshold instead of the top k')
+    parser.set_defaults(k=100, mem_mb=256, threshold=None, range=False)
+    args = parser.parse_args()
+
+    # a float16 / int8 gallery of quant_helper is searched with its scale
+    import quant_helper
+    gallery, scale = quant_helper.load_quantized(args.gallery_npy)
+    if args.range:
+        assert args.threshold is not None, '--range needs a --threshold'
+        offsets, ids, scores = range_search(np.load(args.queries_npy, mmap_mode='r'), gallery, args.threshold,
+                                            args.mem_mb, scale)
+        np.savez(args.output, offsets=offsets, ids=ids, scores=scores)
+        print("Saved the %d results >= %g of %d queries into %s" % (len(ids), args.threshold, len(offsets) - 1,
+                                                                   args.output))
+    else:
+        ids, scores = search(np.load(args.queries_npy, mmap_mode='r'), gallery, args.k, args.mem_mb, scale,
+                             args.threshold)
+        np.savez(args.output, ids=ids, scores=scores)
+        print("Saved the top %d of %d queries into %s" % (args.k, ids.shape[0], args.output))
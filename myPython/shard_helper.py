@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# Python functions that split the image list of convert_image2features(_multires).py into shards and merge the
+# features of the shards back into a single 'features.npy' and index file
+# usage: i, n = parse_shard('2/8')
+#        images = sorted(os.listdir(img_dir))[shard_slice(len(images), i, n)]
+#        ... extract into shard_fname(features_npy, i, n) and shard_fname(features_txt, i, n) ...
+#        merge_shards(features_npy, features_txt, n)  # or python ./myPython/merge_image2features.py
+
+'''
+Note:
+    The images are sorted by name and the i-th shard (0 <= i < n) is the i-th contiguous block of the sorted list,
+    so the shards only depend on the list of images, not on the machine or the order of os.listdir, and the
+    concatenation of the shards in order gives the same rows as a single run over all the images. The index file of
+    a shard has one 'image_name row' line per image, with the row in the shard. The merge renumbers the rows
+    in the order of the shards.
+'''
+
+import os
+import numpy as np
+
+
+# '2/8' -> (2, 8)
+def parse_shard(shard):
+    i, n = [int(v) for v in shard.split('/')]
+    assert 0 <= i < n, 'shard should be i/n with 0 <= i < n, got %s' % shard
+    return i, n
+
+
+# rows of the i-th shard out of n
+def shard_slice(num, i, n):
+    return slice(num * i // n, num * (i + 1) // n)
+
+
+# 'features.npy' -> 'features.shard2of8.npy', 'training.txt' -> 'training.shard2of8.txt'
+def shard_fname(fname, i, n):
+    root, ext = os.path.splitext(fname)
+    return '{0}.shard{1}of{2}{3}'.format(root, i, n, ext)
+
+
+# index lines of a shard (or of the merged file) as a list of image names, in the order of the rows
+def read_index(fname):
+    names = []
+    for line in open(fname, 'r'):
+        line = line.rstrip('\n')
+        if line:
+            name, row = line.rsplit(' ', 1)
+            assert int(row) == len(names), 'rows of %s are not in order' % fname
+            names.append(name)
+    return names
+
+
+def write_index(fname, names):
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        for idx, name in enumerate(names):
+            f.write(name + ' ' + str(idx) + '\n')
+    os.rename(tmp_fname, fname)
+
+
+# concatenate the n shards of features_npy/features_txt into features_npy/features_txt
+def merge_shards(features_npy, features_txt, n):
+    shards = [np.load(shard_fname(features_npy, i, n), mmap_mode='r') for i in range(n)]
+    names = []
+    for i in range(n):
+        names_shard = read_index(shard_fname(features_txt, i, n))
+        assert len(names_shard) == shards[i].shape[0], 'index and features of shard %d do not match' % i
+        names.extend(names_shard)
+    assert len(set(names)) == len(names), 'the shards overlap'
+    assert len(set(s.shape[1] for s in shards)) == 1, 'the shards have different dimensions'
+    # the shards are copied one after another into a memory-mapped file, which is renamed once complete
+    tmp_fname = features_npy + '.tmp.npy'
+    features = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=shards[0].dtype,
+                                         shape=(len(names), shards[0].shape[1]))
+    start = 0
+    for shard in shards:
+        features[start: start + shard.shape[0]] = shard
+        start += shard.shape[0]
+    features.flush()
+    del features
+    os.rename(tmp_fname, features_npy)
+    write_index(features_txt, names)
+    return len(names)
@@ -6,6 +6,36 @@ import sys
 import caffe
 from tqdm import tqdm
 from cover_helper import *
+import batch_helper
+import descriptor_cache
+import cpu_helper
+import search_helper
+
+
+# Extract the features of all the scales in one sweep (every image decoded once). With a descriptor cache, only the
+# images which are not in the cache yet (new or changed images, or all of them for a new model) go through the network
+def extract_multiscale_features(cData, img_dir, fnames, Ss, net, output_layer, args):
+    dim_features = net.blobs[output_layer].data.shape[1]
+    features_list = [np.zeros((len(fnames), dim_features), dtype=np.float32) for S in Ss]
+    outputs = features_list
+    rows = np.arange(len(fnames))
+    if args.cache_dir:
+        digests = descriptor_cache.file_digests([os.path.join(cData.clean_dir, img_dir, fname) for fname in fnames],
+                                                args.num_workers)
+        outputs = [descriptor_cache.CachedWriter(features, descriptor_cache.DescriptorCache(
+            args.cache_dir, args.model_fingerprint, S, cData.L, output_layer, dim_features, 'cover_mean'), digests)
+            for features, S in zip(features_list, Ss)]
+        filled = [o.fill(rows) for o in outputs]
+        for missing, num_hits in filled:
+            print("Descriptor cache: %d/%d image(s) found" % (num_hits, num_hits + len(missing)))
+        rows = reduce(np.union1d, [missing for missing, _ in filled])
+    batch_helper.extract_rmac_features_multiscale(
+        net, lambda fname: cData.prepare_image_and_grid_regions_for_network_multiscale(img_dir, fname, Ss),
+        [fnames[i] for i in rows], outputs, output_layer, args.batch_size, args.num_workers, rows)
+    if args.cache_dir:
+        for o in outputs:
+            o.close()
+    return features_list
 
 
 if __name__ == '__main__':
@@ -18,7 +48,24 @@ if __name__ == '__main__':
                         help='Path to a temporary directory to store features and ranking')
     parser.add_argument('--end', type=str, required=False, help='Define the output layer of the net')
     parser.add_argument('--multires', dest='multires', action='store_true', help='Enable multiresolution features')
+    parser.add_argument('--batch_size', type=int, required=False, help='Number of images of the same shape per forward pass')
+    parser.add_argument('--num_workers', type=int, required=False, help='Number of threads decoding images ahead of the network')
+    parser.add_argument('--cache_dir', type=str, required=False, help='Path to a descriptor cache shared between runs')
+    parser.add_argument('--cpu', dest='cpu', action='store_true', help='Run the network on the CPU with several worker processes')
+    parser.add_argument('--cpu_workers', type=int, required=False, help='Number of worker processes with --cpu (default: number of cores / cpu_threads)')
+    parser.add_argument('--cpu_threads', type=int, required=False, help='Number of BLAS threads of every worker process with --cpu')
+    parser.add_argument('--k', type=int, required=False, help='Rank only the top k dataset images of every query, searched by blocks (default: exact ranking; the answers past k count as not retrieved)')
+    parser.add_argument('--threshold', type=float, required=False, help='With --k, rank only the dataset images with a similarity >= threshold')
+    parser.add_argument('--mem_mb', type=int, required=False, help='Memory budget in MB of the search by blocks')
+    parser.add_argument('--no_save_results', dest='save_results', action='store_false', help='Do not save sim.npy (or results.npz with --k) into temp_dir')
+    parser.set_defaults(k=None)
+    parser.set_defaults(save_results=True)
+    parser.set_defaults(threshold=None)
+    parser.set_defaults(mem_mb=256)
     parser.set_defaults(gpu=0)
+    parser.set_defaults(cpu=False)
+    parser.set_defaults(cpu_workers=0)
+    parser.set_defaults(cpu_threads=1)
     parser.set_defaults(proto='/home/processyuan/code/NetworkOptimization/deep-retrieval/'
                               'proto/deploy_resnet101.prototxt')
     parser.set_defaults(weights='/home/processyuan/code/NetworkOptimization/deep-retrieval/'
@@ -27,12 +74,22 @@ if __name__ == '__main__':
     parser.set_defaults(temp_dir='/home/processyuan/code/NetworkOptimization/deep-retrieval/eval/temp/')
     parser.set_defaults(end='rmac/normalized')
     parser.set_defaults(multires=False)
+    parser.set_defaults(batch_size=8)
+    parser.set_defaults(num_workers=4)
     args = parser.parse_args()
 
     # Configure caffe and load the network ResNet-101
-    caffe.set_device(args.gpu)
-    caffe.set_mode_gpu()
+    if args.cpu:
+        caffe.set_mode_cpu()
+    else:
+        caffe.set_device(args.gpu)
+        caffe.set_mode_gpu()
     net = caffe.Net(args.proto, args.weights, caffe.TEST)
+    if args.cpu:
+        # the features are extracted by worker processes, each of them with its own network
+        net = cpu_helper.CpuNets(net, args.proto, args.weights, args.cpu_workers, args.cpu_threads)
+    if args.cache_dir:
+        args.model_fingerprint = descriptor_cache.model_fingerprint(args.proto, args.weights)
 
     # Load the cover dataset
     cData = CoverDataset(args.dataset)
@@ -40,23 +97,11 @@ if __name__ == '__main__':
 
     # Output of ResNet-101
     output_layer = args.end  # suppose that the layer name is always the same as the blob name
-    dim_features = net.blobs[output_layer].data.shape[1]
-    features_queries = np.zeros((cData.num_queries, dim_features), dtype=np.float32)
-    features_dataset = np.zeros((cData.num_dataset, dim_features), dtype=np.float32)
-
     Ss = [496] if not args.multires else [248, 496, 744]  # multi-resolution of (256, 512, 768)
 
     # First part, queries
-    for S in Ss:
-        for k in tqdm(range(cData.num_queries), file=sys.stdout, leave=False, dynamic_ncols=True):
-            cData.S = S
-            img, reg = cData.prepare_image_and_grid_regions_for_network('queries', cData.q_fname[k])
-            net.blobs['data'].reshape(img.shape[0], int(img.shape[1]), int(img.shape[2]), int(img.shape[3]))
-            net.blobs['data'].data[:] = img
-            net.blobs['rois'].reshape(reg.shape[0], reg.shape[1])
-            net.blobs['rois'].data[:] = reg.astype(np.float32)
-            net.forward(end=output_layer)
-            features_queries[k] = np.squeeze(net.blobs[output_layer].data)
+    features_queries_list = extract_multiscale_features(cData, 'queries', cData.q_fname, Ss, net, output_layer, args)
+    for S, features_queries in zip(Ss, features_queries_list):
         features_queries_fname = os.path.join(args.temp_dir, "queries_S{0}.npy".format(S))
         np.save(features_queries_fname, features_queries)
     features_queries = np.dstack(
@@ -64,27 +109,32 @@ if __name__ == '__main__':
     # np.save(os.path.join(args.temp_dir, 'queries_baseline.npy'), features_queries)
 
     # Second part, dataset
-    for S in Ss:
-        for k in tqdm(range(cData.num_dataset), file=sys.stdout, leave=False, dynamic_ncols=True):
-            cData.S = S
-            img, reg = cData.prepare_image_and_grid_regions_for_network('dataset', cData.dataset[k])
-            net.blobs['data'].reshape(img.shape[0], int(img.shape[1]), int(img.shape[2]), int(img.shape[3]))
-            net.blobs['data'].data[:] = img
-            net.blobs['rois'].reshape(reg.shape[0], reg.shape[1])
-            net.blobs['rois'].data[:] = reg.astype(np.float32)
-            net.forward(end=output_layer)
-            features_dataset[k] = np.squeeze(net.blobs[output_layer].data)
+    features_dataset_list = extract_multiscale_features(cData, 'dataset', cData.dataset, Ss, net, output_layer, args)
+    for S, features_dataset in zip(Ss, features_dataset_list):
         features_dataset_fname = os.path.join(args.temp_dir, "dataset_S{0}.npy".format(S))
         np.save(features_dataset_fname, features_dataset)
     features_dataset = np.dstack(
         [np.load(os.path.join(args.temp_dir, "dataset_S{0}.npy".format(S))) for S in Ss]).sum(axis=2)
     # np.save(os.path.join(args.temp_dir, 'dataset_baseline.npy'), features_dataset)
 
-    # Compute similarity
-    sim = features_queries.dot(features_dataset.T)
-    np.save(os.path.join(args.temp_dir, 'sim.npy'), sim)
-    # sim = np.load(os.path.join(args.temp_dir, 'sim.npy'))  # test
+    assert args.k is not None or args.threshold is None, '--threshold needs --k'
+    if args.k is None:
+        # Compute similarity
+        sim = features_queries.dot(features_dataset.T)
+        if args.save_results:
+            np.save(os.path.join(args.temp_dir, 'sim.npy'), sim)
+        # sim = np.load(os.path.join(args.temp_dir, 'sim.npy'))  # test
+
+        # Calculates the precision and mAP
+        print('precision: %f' % cData.cal_precision(sim, output_img=True))
+        print('mAP: %f' % cData.cal_mAP(sim))
+    else:
+        # Top k of every query, searched by blocks (no num_queries x num_dataset similarity matrix)
+        ids, scores = search_helper.search(features_queries, features_dataset, args.k, args.mem_mb,
+                                           threshold=args.threshold)
+        if args.save_results:
+            np.savez(os.path.join(args.temp_dir, 'results.npz'), ids=ids, scores=scores)
 
-    # Calculates the precision and mAP
-    print('precision: %f' % cData.cal_precision(sim, output_img=True))
-    print('mAP: %f' % cData.cal_mAP(sim))
+        # Calculates the precision and mAP
+        print('precision: %f' % cData.cal_precision_ids(ids, output_img=True))
+        print('mAP: %f' % cData.cal_mAP_ids(ids))
@@ -12,6 +12,13 @@ from tqdm import tqdm
 import os
 from collections import OrderedDict
 import subprocess
+import batch_helper
+import feature_store
+import descriptor_cache
+import cpu_helper
+import rank_helper
+import expansion_helper
+import search_helper
 
 
 class ImageHelper:
@@ -19,22 +26,44 @@ class ImageHelper:
         self.S = S
         self.L = L
         self.means = means
+        self.regions_cache = {}  # key: (H, W) of the resized image; value: grid regions
 
     def prepare_image_and_grid_regions_for_network(self, fname):
         # Extract image, resize at desired size, and extract roi region if
         # available. Then compute the rmac grid in the net format: ID X Y W H
         I, im_resized = self.load_and_prepare_image(fname)
+        R = self.get_grid_regions_for_network(im_resized)
+        return I, R
+
+    def prepare_image_and_grid_regions_for_network_multiscale(self, fname, Ss):
+        # Same as above for every scale in Ss, but the image is read and decoded only once
+        im = cv2.imread(fname)
+        images_and_regions = []
+        for S in Ss:
+            I, im_resized = self.resize_and_prepare_image(im, S)
+            images_and_regions.append((I, self.get_grid_regions_for_network(im_resized)))
+        return images_and_regions
+
+    def get_grid_regions_for_network(self, im_resized):
+        # The grid only depends on the image size, so it is computed once per size and the same (read-only)
+        # array is returned for every image of that size
+        H, W = im_resized.shape[0], im_resized.shape[1]
+        if (H, W) not in self.regions_cache:
+            self.regions_cache[(H, W)] = self.compute_grid_regions_for_network(H, W)
+        return self.regions_cache[(H, W)]
+
+    def compute_grid_regions_for_network(self, H, W):
         if self.L == 0:
             # Encode query in mac format instead of rmac, so only one region
             # Regions are in ID X Y W H format
             R = np.zeros((1, 5), dtype=np.float32)
-            R[0, 3] = im_resized.shape[1] - 1
-            R[0, 4] = im_resized.shape[0] - 1
+            R[0, 3] = W - 1
+            R[0, 4] = H - 1
         else:
             # Get the region coordinates and feed them to the network.
-            all_regions = [self.get_rmac_region_coordinates(im_resized.shape[0], im_resized.shape[1], self.L)]
+            all_regions = [self.get_rmac_region_coordinates(H, W, self.L)]
             R = self.pack_regions_for_network(all_regions)
-        return I, R
+        return R
 
     def get_rmac_features(self, I, R, net, end_layer):
         net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
@@ -44,11 +73,29 @@ class ImageHelper:
         net.forward(end=end_layer)
         return np.squeeze(net.blobs[end_layer].data)
 
+    def get_rmac_features_batch(self, fnames, net, end_layer, features, batch_size=1, num_workers=0):
+        # Images with the same resized shape are stacked into one data blob (up to batch_size)
+        # and the descriptor of fnames[i] is stored into features[i]. With num_workers > 0 the images
+        # are decoded and resized by background threads while the network is running
+        return self.get_rmac_features_multiscale(fnames, [self.S], net, end_layer, [features], batch_size,
+                                                 num_workers)[0]
+
+    def get_rmac_features_multiscale(self, fnames, Ss, net, end_layer, features_list, batch_size=1, num_workers=0,
+                                     rows=None):
+        # The descriptor of fnames[i] at scale Ss[k] is stored into features_list[k][i] (or features_list[k][rows[i]]),
+        # with a single sweep over the images
+        load_fn = lambda fname: self.prepare_image_and_grid_regions_for_network_multiscale(fname, Ss)
+        return batch_helper.extract_rmac_features_multiscale(net, load_fn, fnames, features_list, end_layer,
+                                                             batch_size, num_workers, rows)
+
     def load_and_prepare_image(self, fname):
         # Read image, get aspect ratio, and resize such as the largest side equals S
         im = cv2.imread(fname)
+        return self.resize_and_prepare_image(im, self.S)
+
+    def resize_and_prepare_image(self, im, S):
         im_size_hw = np.array(im.shape[0:2])
-        ratio = float(self.S) / np.max(im_size_hw)
+        ratio = float(S) / np.max(im_size_hw)
         new_size = tuple(np.round(im_size_hw * ratio).astype(np.int32))
         im_resized = cv2.resize(im, (new_size[1], new_size[0]))
         # Transpose for network and subtract mean
@@ -198,18 +245,26 @@ class Dataset:
         self.N_images = len(self.img_filenames)
         self.N_queries = len(self.q_index)
 
-    def score(self, sim, temp_dir, eval_bin):
+    def score(self, sim, temp_dir, eval_bin, k=None):
+        # Only the ranks up to the last relevant image count for the AP, so by default the ranking is just that deep
+        # (a given k ranks the top k images only, and the AP of a query with relevant images past k is lower)
+        if k is None:
+            k = rank_helper.rank_depth(sim, [self.relevants[q_name] for q_name in self.q_names])
+        return self.score_ids(rank_helper.top_k(sim, k), temp_dir, eval_bin)
+
+    # Same with the ranked image indices of every query (e.g. the ids of search_helper.search, -1 for no result)
+    def score_ids(self, idx, temp_dir, eval_bin):
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir)
-        idx = np.argsort(sim, axis=1)[:, ::-1]
         maps = [self.score_rnk_partial(i, idx[i], temp_dir, eval_bin) for i in range(len(self.q_names))]
         for i in range(len(self.q_names)):
             print "{0}: {1:.2f}".format(self.q_names[i], 100 * maps[i])
         print 20 * "-"
         print "Mean: {0:.2f}".format(100 * np.mean(maps))
+        return np.mean(maps)
 
     def score_rnk_partial(self, i, idx, temp_dir, eval_bin):
-        rnk = np.array(self.img_filenames)[idx]
+        rnk = np.array(self.img_filenames)[idx[idx >= 0]]
         with open("{0}/{1}.rnk".format(temp_dir, self.q_names[i]), 'w') as f:
             f.write("\n".join(rnk)+"\n")
         cmd = "{0} {1}{2} {3}/{4}.rnk".format(eval_bin, self.lab_root, self.q_names[i], temp_dir, self.q_names[i])
@@ -228,44 +283,54 @@ class Dataset:
         return self.q_roi[self.q_names[i]]
 
 
+def extract_multiscale_features(fnames, part, Ss, image_helper, net, args):
+    # Extract the scales whose features are not cached yet in a single sweep over the images
+    # (each image is decoded once), save one file per scale, then sum the scales and normalize.
+    # Features are written into memory-mapped files with checkpoints, so an interrupted run
+    # resumes from the rows already done. With a descriptor cache, the files are always rebuilt from the
+    # cache, so only new or changed images (or all of them for a new model) go through the network
+    out_fnames = ["{0}/{1}_S{2}_L{3}_{4}.npy".format(args.temp_dir, args.dataset_name, S, args.L, part) for S in Ss]
+    Ss_missing = [S for S, out_fname in zip(Ss, out_fnames) if not os.path.exists(out_fname) or args.cache_dir]
+    if len(Ss_missing) > 0:
+        dim_features = net.blobs[args.end].data.shape[1]
+        writers = [feature_store.ResumableFeatures(out_fnames[Ss.index(S)], len(fnames), dim_features)
+                   for S in Ss_missing]
+        rows = reduce(np.union1d, [w.pending() for w in writers])
+        outputs = writers
+        if args.cache_dir:
+            # the grid of this script is computed on the original image, hence its own preprocessing tag
+            digests = descriptor_cache.file_digests(fnames, args.num_workers)
+            outputs = [descriptor_cache.CachedWriter(w, descriptor_cache.DescriptorCache(
+                args.cache_dir, args.model_fingerprint, S, args.L, args.end, dim_features, 'imagenet_means_original_grid'),
+                digests) for w, S in zip(writers, Ss_missing)]
+            filled = [o.fill(w.pending()) for o, w in zip(outputs, writers)]
+            for missing, num_hits in filled:
+                print("Descriptor cache: %d/%d image(s) found" % (num_hits, num_hits + len(missing)))
+            rows = reduce(np.union1d, [missing for missing, _ in filled])
+        # Load image, process image, get image regions, feed into the network, get descriptor, and store
+        image_helper.get_rmac_features_multiscale([fnames[i] for i in rows], Ss_missing, net, args.end, outputs,
+                                                  args.batch_size, args.num_workers, rows)
+        if args.cache_dir:
+            for o in outputs:
+                o.close()
+        for w in writers:
+            w.finish()
+    features = np.dstack([np.load(out_fname) for out_fname in out_fnames]).sum(axis=2)
+    features /= np.sqrt((features * features).sum(axis=1))[:, None]
+    return features
+
+
 def extract_features(dataset, image_helper, net, args):
     # Ss = [args.S-256, args.S, args.S+256]
     Ss = [args.S]
     # First part, queries
-    for S in Ss:
-        # Set the scale of the image helper
-        image_helper.S = S
-        out_queries_fname = "{0}/{1}_S{2}_L{3}_queries.npy".format(args.temp_dir, args.dataset_name, S, args.L)
-        if not os.path.exists(out_queries_fname):
-            dim_features = net.blobs[args.end].data.shape[1]
-            N_queries = dataset.N_queries
-            features_queries = np.zeros((N_queries, dim_features), dtype=np.float32)
-            for i in tqdm(range(N_queries), file=sys.stdout, leave=False, dynamic_ncols=True):
-                # Load image, process image, get image regions, feed into the network, get descriptor, and store
-                # I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_query_filename(i), roi=dataset.get_query_roi(i))
-                I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_query_filename(i))
-                features_queries[i] = image_helper.get_rmac_features(I, R, net, args.end)
-            np.save(out_queries_fname, features_queries)
-    features_queries = np.dstack([np.load("{0}/{1}_S{2}_L{3}_queries.npy".format(args.temp_dir, args.dataset_name, S, args.L)) for S in Ss]).sum(axis=2)
-    features_queries /= np.sqrt((features_queries * features_queries).sum(axis=1))[:, None]
+    # I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_query_filename(i), roi=dataset.get_query_roi(i))
+    queries_fname = [dataset.get_query_filename(i) for i in range(dataset.N_queries)]
+    features_queries = extract_multiscale_features(queries_fname, 'queries', Ss, image_helper, net, args)
 
     # Second part, dataset
-    for S in Ss:
-        image_helper.S = S
-        out_dataset_fname = "{0}/{1}_S{2}_L{3}_dataset.npy".format(args.temp_dir, args.dataset_name, S, args.L)
-        if not os.path.exists(out_dataset_fname):
-            dim_features = net.blobs[args.end].data.shape[1]
-            N_dataset = dataset.N_images
-            features_dataset = np.zeros((N_dataset, dim_features), dtype=np.float32)
-            for i in tqdm(range(N_dataset), file=sys.stdout, leave=False, dynamic_ncols=True):
-                # Load image, process image, get image regions, feed into the network, get descriptor, and store
-                I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_filename(i))
-                features_dataset[i] = image_helper.get_rmac_features(I, R, net, args.end)
-            np.save(out_dataset_fname, features_dataset)
-    features_dataset = np.dstack([np.load("{0}/{1}_S{2}_L{3}_dataset.npy".format(args.temp_dir, args.dataset_name, S, args.L)) for S in Ss]).sum(axis=2)
-    features_dataset /= np.sqrt((features_dataset * features_dataset).sum(axis=1))[:, None]
-    # Restore the original scale
-    image_helper.S = args.S
+    dataset_fname = [dataset.get_filename(i) for i in range(dataset.N_images)]
+    features_dataset = extract_multiscale_features(dataset_fname, 'dataset', Ss, image_helper, net, args)
     return features_queries, features_dataset
 
 
@@ -282,7 +347,19 @@ if __name__ == '__main__':
     parser.add_argument('--temp_dir', type=str, required=False, help='Path to a temporary directory to store features and scores')
     parser.add_argument('--aqe', type=int, required=False, help='Average query expansion with k neighbors')
     parser.add_argument('--dbe', type=int, required=False, help='Database expansion with k neighbors')
+    parser.add_argument('--aqe_alpha', type=float, required=False, help='Weight the AQE neighbors by their similarity to the power alpha (0 for the plain average)')
+    parser.add_argument('--aqe_rounds', type=int, required=False, help='Number of rounds of query expansion')
+    parser.set_defaults(aqe_alpha=0., aqe_rounds=1)
+    parser.add_argument('--mem_mb', type=int, required=False, help='Memory budget in MB of the similarity search by blocks (DBE and AQE)')
+    parser.set_defaults(mem_mb=256)
+    parser.add_argument('--k', type=int, required=False, help='Rank only the top k images of every query, searched by blocks (default: exact full ranking)')
     parser.add_argument('--end', type=str, required=False, help='Name of the output layer')
+    parser.add_argument('--batch_size', type=int, required=False, help='Number of images of the same shape per forward pass')
+    parser.add_argument('--num_workers', type=int, required=False, help='Number of threads decoding images ahead of the network')
+    parser.add_argument('--cache_dir', type=str, required=False, help='Path to a descriptor cache shared between runs, keyed by image content and model')
+    parser.add_argument('--cpu', dest='cpu', action='store_true', help='Run the network on the CPU with several worker processes')
+    parser.add_argument('--cpu_workers', type=int, required=False, help='Number of worker processes with --cpu (default: number of cores / cpu_threads)')
+    parser.add_argument('--cpu_threads', type=int, required=False, help='Number of BLAS threads of every worker process with --cpu')
     parser.set_defaults(dataset_name='Oxford')
     parser.set_defaults(dataset='/home/processyuan/data/Oxford/uni-oxford/')
     parser.set_defaults(eval_binary='/home/processyuan/code/NetworkOptimization/deep-retrieval/eval/compute_ap')
@@ -291,6 +368,11 @@ if __name__ == '__main__':
     parser.set_defaults(S=512)
     parser.set_defaults(L=2)
     parser.set_defaults(gpu=0)
+    parser.set_defaults(cpu=False)
+    parser.set_defaults(cpu_workers=0)
+    parser.set_defaults(cpu_threads=1)
+    parser.set_defaults(batch_size=1)
+    parser.set_defaults(num_workers=4)
     args = parser.parse_args()
 
     if not os.path.exists(args.temp_dir):
@@ -300,9 +382,17 @@ if __name__ == '__main__':
     args.means = np.array([103.93900299,  116.77899933,  123.68000031], dtype=np.float32)[None, :, None, None]
 
     # Configure caffe and load the network
-    caffe.set_device(args.gpu)
-    caffe.set_mode_gpu()
+    if args.cpu:
+        caffe.set_mode_cpu()
+    else:
+        caffe.set_device(args.gpu)
+        caffe.set_mode_gpu()
     net = caffe.Net(args.proto, args.weights, caffe.TEST)
+    if args.cpu:
+        # the features are extracted by worker processes, each of them with its own network
+        net = cpu_helper.CpuNets(net, args.proto, args.weights, args.cpu_workers, args.cpu_threads)
+    if args.cache_dir:
+        args.model_fingerprint = descriptor_cache.model_fingerprint(args.proto, args.weights)
 
     # Load the dataset and the image helper
     dataset = Dataset(args.dataset, args.eval_binary)
@@ -317,31 +407,27 @@ if __name__ == '__main__':
 
     # Database side expansion?
     if args.dbe is not None and args.dbe > 0:
-        # Extend the database features
-        # With larger datasets this has to be done in a batched way.
-        # and using smarter ways than sorting to take the top k results.
-        # For 5k images, not really a problem to do it by brute force
-        X = features_dataset.dot(features_dataset.T)
-        idx = np.argsort(X, axis=1)[:, ::-1]
-        weights = np.hstack(([1], (args.dbe - np.arange(0, args.dbe)) / float(args.dbe)))
-        weights_sum = weights.sum()
-        features_dataset = np.vstack([np.dot(weights, features_dataset[idx[i, :args.dbe + 1], :]) / weights_sum for i in range(len(features_dataset))])
-
-    # Compute similarity
-    sim = features_queries.dot(features_dataset.T)
-    # sim = features_queries_clipped.dot(features_dataset_clipped.T)
+        # Extend the database features, from a neighbor graph found by blocks (no N x N similarities),
+        # and keep them in temp_dir for the next runs with the same features
+        features_dataset = expansion_helper.database_side_expansion(
+            features_dataset, args.dbe, "{0}/{1}_dataset_dbe{2}.npy".format(args.temp_dir, args.dataset_name, args.dbe),
+            args.mem_mb)
 
     # Average query expansion?
     if args.aqe is not None and args.aqe > 0:
-        # Sort the results to get the nearest neighbors, compute average
-        # representations, and query again.
+        # Take the top k results as nearest neighbors, compute (alpha-weighted) average
+        # representations, and query again (for every round).
         # No need to L2-normalize as we are on the query side, so it doesn't
         # affect the ranking
-        idx = np.argsort(sim, axis=1)[:, ::-1]
-        features_queries = np.vstack([np.vstack((features_queries[i], features_dataset[idx[i, :args.aqe]])).mean(axis=0) for i in range(len(features_queries))])
-        #for i in range(features_queries.shape[0]):
-        #    features_queries[i] = np.vstack((features_queries[i], features_dataset[idx[i, :args.aqe]])).mean(axis=0)
-        sim = features_queries.dot(features_dataset.T)
+        features_queries = expansion_helper.average_query_expansion(
+            features_queries, features_dataset, args.aqe, args.aqe_alpha, args.aqe_rounds, args.mem_mb)
 
     # Score
-    dataset.score(sim, args.temp_dir, args.eval_binary)
+    if args.k is not None:
+        # top k of every query only, without the N_queries x N_images similarity matrix
+        ids, scores = search_helper.search(features_queries, features_dataset, args.k, args.mem_mb)
+        dataset.score_ids(ids, args.temp_dir, args.eval_binary)
+    else:
+        sim = features_queries.dot(features_dataset.T)
+        # sim = features_queries_clipped.dot(features_dataset_clipped.T)
+        dataset.score(sim, args.temp_dir, args.eval_binary)
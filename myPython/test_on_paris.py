@@ -6,6 +6,7 @@ import sys
 import caffe
 from tqdm import tqdm
 from paris_helper import *
+import search_helper
 
 
 if __name__ == '__main__':
@@ -17,6 +18,14 @@ if __name__ == '__main__':
     parser.add_argument('--temp_dir', type=str, required=False,
                         help='Path to a temporary directory to store features and ranking')
     parser.add_argument('--end', type=str, required=False, help='Define the output layer of the net')
+    parser.add_argument('--k', type=int, required=False, help='Rank only the top k dataset images of every query, searched by blocks (default: exact ranking; the answers past k count as not retrieved)')
+    parser.add_argument('--threshold', type=float, required=False, help='With --k, rank only the dataset images with a similarity >= threshold')
+    parser.add_argument('--mem_mb', type=int, required=False, help='Memory budget in MB of the search by blocks')
+    parser.add_argument('--save_results', dest='save_results', action='store_true', help='Save sim.npy (or results.npz with --k) into temp_dir')
+    parser.set_defaults(k=None)
+    parser.set_defaults(save_results=False)
+    parser.set_defaults(threshold=None)
+    parser.set_defaults(mem_mb=256)
     parser.set_defaults(gpu=0)
     parser.set_defaults(proto='/home/processyuan/code/NetworkOptimization/deep-retrieval/'
                               'proto/deploy_resnet101.prototxt')
@@ -63,10 +72,22 @@ if __name__ == '__main__':
         net.forward(end=output_layer)
         features_dataset[k] = np.squeeze(net.blobs[output_layer].data)
 
-    # Compute similarity
-    sim = features_queries.dot(features_dataset.T)
-    # np.save(os.path.join(args.temp_dir, 'sim.npy'), sim)
-    # sim = np.load(os.path.join(args.temp_dir, 'sim.npy'))  # test
+    assert args.k is not None or args.threshold is None, '--threshold needs --k'
+    if args.k is None:
+        # Compute similarity
+        sim = features_queries.dot(features_dataset.T)
+        if args.save_results:
+            np.save(os.path.join(args.temp_dir, 'sim.npy'), sim)
+        # sim = np.load(os.path.join(args.temp_dir, 'sim.npy'))  # test
 
-    # Calculates the precision and mAP
-    print('mAP: %f' % pData.cal_mAP(sim))
+        # Calculates the precision and mAP
+        print('mAP: %f' % pData.cal_mAP(sim))
+    else:
+        # Top k of every query, searched by blocks (no num_queries x num_dataset similarity matrix)
+        ids, scores = search_helper.search(features_queries, features_dataset, args.k, args.mem_mb,
+                                           threshold=args.threshold)
+        if args.save_results:
+            np.savez(os.path.join(args.temp_dir, 'results.npz'), ids=ids, scores=scores)
+
+        # Calculates the precision and mAP
+        print('mAP: %f' % pData.cal_mAP_ids(ids))